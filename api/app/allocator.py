@@ -0,0 +1,147 @@
+# Deterministic IP/subnet allocation for a GNS3 topology.
+#
+# This replaces the stage-3 LLM call ("assign an IP address and subnet mask to every connected
+# port") with a graph walk: ports joined by a link, directly or through L2 switches, form one
+# broadcast domain, and every domain gets the smallest subnet that fits it, carved out of a
+# pool in a fixed order. The same topology therefore always gets the same plan.
+import ipaddress
+from functools import lru_cache
+from typing import Dict, List, Optional, Union
+
+from api.app import config
+from api.app.topology import L2_NODE_TYPES, Port, Topology, load_topology
+
+# Node types that get the first addresses of a subnet (they act as the default gateway).
+GATEWAY_NODE_TYPES = {"dynamips", "iou", "qemu"}
+
+
+def broadcast_domains(topology: Topology) -> List[List[Port]]:
+    """Group connected L3 ports into broadcast domains, treating L2 switches as transparent.
+
+    Each domain is a list of ports. Domains without any L3 port are left out.
+    """
+    parent: Dict[tuple, tuple] = {}
+
+    def find(key):
+        parent.setdefault(key, key)
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    members: Dict[tuple, Port] = {}
+    for link in topology.links:
+        keys = []
+        for port in link.ends:
+            if port.node.node_type in L2_NODE_TYPES:
+                keys.append(("l2", port.node.node_id))
+            else:
+                key = ("l3", port)
+                members[key] = port
+                keys.append(key)
+        for key in keys:
+            find(key)
+        for key in keys[1:]:
+            parent[find(key)] = find(keys[0])
+
+    domains: Dict[tuple, List[Port]] = {}
+    for key, member in members.items():
+        domains.setdefault(find(key), []).append(member)
+    return list(domains.values())
+
+
+def prefix_length(hosts: int) -> int:
+    """Smallest prefix length whose subnet holds `hosts` addresses (at least a /30)."""
+    prefix = 30
+    while prefix > 0 and 2 ** (32 - prefix) - 2 < hosts:
+        prefix -= 1
+    return prefix
+
+
+def allocate_ips(topology: Union[str, dict, Topology], pool: Optional[str] = None, previous: Optional[dict] = None) -> dict:
+    """Assign an IP address and subnet mask to every connected L3 port.
+
+    Returns the same shape as `port_identification_parser` does for the LLM stage,
+    i.e. {"port_info": [{"device", "port", "ip", "subnet"}, ...]}.
+
+    With `previous` (an earlier plan of the same lab), a broadcast domain whose ports all sat
+    on one subnet keeps that subnet and its addresses, so editing one link does not renumber
+    the rest of the topology.
+    """
+    topology = load_topology(topology)
+    sticky = None
+    if previous:
+        sticky = tuple(sorted(
+            (entry["device"], entry["port"], entry["ip"], entry["subnet"])
+            for entry in previous.get("port_info", [])
+            if entry.get("device") and entry.get("port") and entry.get("ip") and entry.get("subnet")
+        ))
+    return {"port_info": [dict(entry) for entry in _allocate(topology, pool or config.IP_POOL, sticky)]}
+
+
+def _previous_subnet(domain: List[Port], previous: Dict[tuple, tuple]):
+    """The one subnet every previously addressed port of `domain` was on, if there is one."""
+    subnets = set()
+    for port in domain:
+        entry = previous.get((port.node.name, port.name))
+        if entry:
+            try:
+                subnets.add(ipaddress.ip_interface(f"{entry[0]}/{entry[1]}").network)
+            except ValueError:
+                return None
+    return subnets.pop() if len(subnets) == 1 else None
+
+
+# Topologies compare (and hash) by content, so an identical topology hits the cache.
+@lru_cache(maxsize=128)
+def _allocate(topology: Topology, pool: str, sticky: Optional[tuple] = None) -> tuple:
+    network = ipaddress.ip_network(pool)
+    previous = {(device, port): (ip, subnet) for device, port, ip, subnet in sticky or ()}
+
+    def sort_key(port):
+        return (port.node.node_type not in GATEWAY_NODE_TYPES, port.node.name, port.name)
+
+    domains = [sorted(domain, key=sort_key) for domain in broadcast_domains(topology)]
+    # Biggest subnets first keeps every block aligned; ties are broken by member names.
+    domains.sort(key=lambda domain: (prefix_length(len(domain)), [sort_key(port) for port in domain]))
+
+    assigned = {}
+    taken = []
+    fresh = []
+    # Domains that still fit on their previous subnet keep it, and their ports keep their addresses.
+    for domain in domains:
+        subnet = _previous_subnet(domain, previous)
+        if (subnet is None or not subnet.subnet_of(network) or subnet.num_addresses - 2 < len(domain)
+                or any(subnet.overlaps(other) for other in taken)):
+            fresh.append(domain)
+            continue
+        taken.append(subnet)
+        kept = {previous[(port.node.name, port.name)][0] for port in domain if (port.node.name, port.name) in previous}
+        free = (str(address) for address in subnet.hosts() if str(address) not in kept)
+        for port in domain:
+            entry = previous.get((port.node.name, port.name))
+            assigned[port] = (entry[0] if entry else next(free), str(subnet.netmask))
+
+    cursor = int(network.network_address)
+    for domain in fresh:
+        size = 2 ** (32 - prefix_length(len(domain)))
+        while True:
+            cursor = -(-cursor // size) * size
+            subnet = ipaddress.ip_network((cursor, prefix_length(len(domain))))
+            if not subnet.subnet_of(network):
+                raise ValueError(f"IP pool {pool} is too small for this topology")
+            clash = next((other for other in taken if subnet.overlaps(other)), None)
+            if clash is None:
+                break
+            cursor = int(clash.broadcast_address) + 1
+        cursor = int(subnet.broadcast_address) + 1
+        for port, address in zip(domain, subnet.hosts()):
+            assigned[port] = (str(address), str(subnet.netmask))
+
+    # Report ports in topology order so the plan reads like the topology itself.
+    return tuple(
+        (("device", node.name), ("port", port.name), ("ip", assigned[port][0]), ("subnet", assigned[port][1]))
+        for node in topology.nodes
+        for port in node.ports
+        if port in assigned
+    )
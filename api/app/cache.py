@@ -0,0 +1,184 @@
+# Caches shared by the chains.
+#
+# LRUCache is a small thread-safe in-memory LRU with an optional TTL.
+# TieredLLMCache plugs into langchain's global LLM cache: every ChatOpenAI/OpenAI call first
+# looks in the in-memory LRU, then in a SQLite file that survives restarts, and only then
+# goes to OpenAI. All chains run at temperature 0, so a cached answer is as good as a new one.
+import contextvars
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Hashable, Optional
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded mapping that drops the least recently used entry (and entries older than `ttl` seconds)."""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            value, stored_at = item
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteStore:
+    """Persistent key/value tier with TTL and a row limit."""
+
+    def __init__(self, path: str, ttl: Optional[float] = None, max_rows: int = 100_000):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)")
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, stored_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, stored_at = row
+        if self.ttl is not None and time.time() - stored_at > self.ttl:
+            return None
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO llm_cache (key, value, stored_at) VALUES (?, ?, ?)", (key, value, time.time()))
+            self._writes += 1
+            # Evicting on every write would be wasteful; once in a while is enough.
+            if self._writes % 100 == 0:
+                self._evict()
+
+    def _evict(self) -> None:
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM llm_cache WHERE stored_at < ?", (time.time() - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_rows,),
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+
+
+_bypass: contextvars.ContextVar[bool] = contextvars.ContextVar("llm_cache_bypass", default=False)
+
+
+@contextmanager
+def bypass_llm_cache(bypass: bool = True):
+    """Within this block (and the tasks it starts), LLM calls neither read nor fill the cache."""
+    token = _bypass.set(bypass)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def llm_cache_bypassed() -> bool:
+    return _bypass.get()
+
+
+def _normalize(prompt: str) -> str:
+    # Trailing spaces before a (possibly JSON-escaped) newline never change the answer.
+    return re.sub(r"[ \t]+(?=\n|\\n)", "", prompt).strip()
+
+
+class TieredLLMCache(BaseCache):
+    """langchain LLM cache backed by an in-memory LRU and an optional SQLite file."""
+
+    def __init__(self, maxsize: int = 1024, path: Optional[str] = None, ttl: Optional[float] = None, max_rows: int = 100_000):
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.disk = SQLiteStore(path, ttl=ttl, max_rows=max_rows) if path else None
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.bypassed = 0
+
+    @staticmethod
+    def key(prompt: str, llm_string: str) -> str:
+        """The model name and parameters are part of `llm_string`."""
+        return hashlib.sha256(f"{llm_string}\x00{_normalize(prompt)}".encode()).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        if _bypass.get():
+            self.bypassed += 1
+            return None
+        key = self.key(prompt, llm_string)
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits["memory"] += 1
+            return value
+        if self.disk is not None:
+            stored = self.disk.get(key)
+            if stored is not None:
+                value = loads(stored)
+                self.memory.set(key, value)
+                self.hits["disk"] += 1
+                return value
+        self.misses += 1
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if _bypass.get():
+            return
+        key = self.key(prompt, llm_string)
+        self.memory.set(key, return_val)
+        if self.disk is not None:
+            self.disk.set(key, dumps(return_val))
+
+    def clear(self, **kwargs: Any) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "memory_entries": len(self.memory),
+        }
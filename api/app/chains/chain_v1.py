@@ -1,35 +1,20 @@
 
 from operator import itemgetter
-from typing import List, Tuple
 
-from langchain.chat_models import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate
 from langchain.prompts.prompt import PromptTemplate
-from langchain.schema import format_document
 from langchain.schema.output_parser import StrOutputParser
 from langchain.schema.runnable import RunnableParallel, RunnableLambda
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores.faiss import FAISS
 
 from dotenv import load_dotenv; load_dotenv()
 
-from api.app.utils import output_parser
+from api.app.utils import output_parser, format_chat_history
+from api.app.llm import chat_model
+from api.app.topology import topology_json
+from api.app.retrieval import get_retriever
+from api.app.prompts import DOCUMENTS, HISTORY, TOPOLOGY, budgeted
 
-model_name = "BAAI/bge-base-en-v1.5"
-model_kwargs = { "device": "cuda" }
-encode_kwargs = { "normalize_embeddings": True } # use cosine similarity
-embedding = HuggingFaceEmbeddings(
-    model_name=model_name,
-    model_kwargs=model_kwargs,
-    encode_kwargs=encode_kwargs,
-)
-
-f_search = "faiss"
-store_name = f"api/db/{f_search}"
-
-docsearch = FAISS.load_local(store_name, embeddings=embedding)
-
-retriever = docsearch.as_retriever()
+retriever = get_retriever()
 
 
 # _TEMPLATE = """Given the following conversation and a follow up question, rephrase the 
@@ -53,59 +38,40 @@ ANSWER_TEMPLATE = """You are an expert at configuring network opeartion.
 Get context with network topology and suggest only CLI command for achieveing question's requirements. (Never include plantext answer)
 {format_instructions}
 
-Question: {question} 
-
 Network topology: {topology}
 
 Context: {context}
 
+Question: {question} 
+
 Answer:"""
 ANSWER_PROMPT = ChatPromptTemplate.from_template(
     ANSWER_TEMPLATE,
     partial_variables={"format_instructions": output_parser.get_format_instructions()}
 )
 
-DEFAULT_DOCUMENT_PROMPT = PromptTemplate.from_template(template="{page_content}")
-
-
-def _combine_documents(
-    docs, document_prompt=DEFAULT_DOCUMENT_PROMPT, document_separator="\n\n"
-):
-    """Combine documents into a single string."""
-    doc_strings = [format_document(doc, document_prompt) for doc in docs]
-    return document_separator.join(doc_strings)
-
-
-def _format_chat_history(chat_history: List[Tuple]) -> str:
-    """Format chat history into a string."""
-    buffer = ""
-    for dialogue_turn in chat_history:
-        human = "Human: " + dialogue_turn[0]
-        ai = "Assistant: " + dialogue_turn[1]
-        buffer += "\n" + "\n".join([human, ai])
-    if buffer == "":
-        buffer = "None"
-    return buffer
-
 
 chain = (
     RunnableParallel({
         "standalone_question": RunnableParallel({
-            "chat_history": itemgetter("chat_history") | RunnableLambda(_format_chat_history),
+            "chat_history": itemgetter("chat_history") | RunnableLambda(format_chat_history),
             "question": itemgetter("question"),
-            "topology": itemgetter("topology"),
+            "topology": itemgetter("topology") | RunnableLambda(topology_json),
         }) 
+        | budgeted("v1", "condense", CONDENSE_QUESTION_PROMPT, "gpt-3.5-turbo", { "chat_history": HISTORY, "topology": TOPOLOGY })
         | CONDENSE_QUESTION_PROMPT
-        | ChatOpenAI(temperature=0)
+        | chat_model()
         | StrOutputParser(),
-        "topology": itemgetter("topology"),
+        "topology": itemgetter("topology") | RunnableLambda(topology_json),
     }) 
     | {
-        "context": itemgetter("standalone_question") | retriever | _combine_documents,
+        # The retrieved documents, best first: the budget drops the last ones when they do not fit.
+        "context": itemgetter("standalone_question") | retriever,
         "question": itemgetter("standalone_question"),
         "topology": itemgetter("topology"),
     }
+    | budgeted("v1", "answer", ANSWER_PROMPT, "gpt-3.5-turbo", { "context": DOCUMENTS, "topology": TOPOLOGY })
     | ANSWER_PROMPT
-    | ChatOpenAI(temperature=0)
+    | chat_model()
     | output_parser
 )
\ No newline at end of file
@@ -1,35 +1,16 @@
 from operator import itemgetter
-from typing import List, Tuple
 
-from langchain.llms.openai import OpenAI
 from langchain.prompts.prompt import PromptTemplate
-from langchain.schema import format_document
 from langchain.schema.output_parser import StrOutputParser
 from langchain.schema.runnable import RunnableLambda
 
 from dotenv import load_dotenv; load_dotenv()
 
-from api.app.utils import output_parser
-
-def load_retriever():
-    from langchain_community.embeddings import HuggingFaceEmbeddings
-    from langchain.vectorstores.faiss import FAISS
-    
-    model_name = "BAAI/bge-base-en-v1.5"
-    model_kwargs = { "device": "cuda" }
-    encode_kwargs = { "normalize_embeddings": True } # use cosine similarity
-    embedding = HuggingFaceEmbeddings(
-        model_name=model_name,
-        model_kwargs=model_kwargs,
-        encode_kwargs=encode_kwargs,
-    )
-    f_search = "faiss"
-    store_name = f"api/db/{f_search}"
-
-    docsearch = FAISS.load_local(store_name, embeddings=embedding)
-
-    retriever = docsearch.as_retriever()
-    return retriever
+from api.app.utils import output_parser, format_chat_history
+from api.app.llm import completion_model
+from api.app.topology import topology_json
+from api.app.retrieval import get_retriever
+from api.app.prompts import DOCUMENTS, HISTORY, TOPOLOGY, budgeted
 
 _TEMPLATE_FOR_QUERY = """I collected several guide documents for configuring Cisco or Juniper switches,
 In order for a language model-based retriever to extract meaningful documents, you must create the right query.
@@ -39,7 +20,11 @@ Please refer to the information below and create an appropriate query.
 - Current question: {question}"""
 PROMPT_FOR_QUERY = PromptTemplate.from_template(_TEMPLATE_FOR_QUERY)
 
-_TEMPLATE_FOR_ANSWER = """I have the following Network Topology.
+_TEMPLATE_FOR_ANSWER = """Solve the current question about the network topology below, using the previous chatting history and the document below.
+
+{format_instructions}
+
+I have the following Network Topology.
 
 - Network Topology: {network_topology}
 
@@ -54,47 +39,31 @@ The problems we are currently trying to solve are as follows.
 Below is a document that may help solve the problem.
 
 - document : {document}
-
-{format_instructions}
 """
 PROMPT_FOR_ANSWER = PromptTemplate.from_template(
     _TEMPLATE_FOR_ANSWER,
     partial_variables={"format_instructions": output_parser.get_format_instructions()}
 )
 
-def _combine_documents(docs, document_separator="\n\n") -> str:
-    doc_strings = [format_document(doc, PromptTemplate.from_template(template="{page_content}")) for doc in docs]
-    return document_separator.join(doc_strings)
-
-def _format_chat_history(chat_history: List[Tuple]) -> str:
-    """Format chat history into a string."""
-    buffer = ""
-    for dialogue_turn in chat_history:
-        human = "Human: " + dialogue_turn[0]
-        ai = "Assistant: " + dialogue_turn[1]
-        buffer += "\n" + "\n".join([human, ai])
-    if buffer == "":
-        buffer = "None"
-    return buffer
-
-retriever = load_retriever()
+retriever = get_retriever()
 
 chain = (
     {
-        "network_topology": itemgetter("topology"),
-        "chat_history": itemgetter("chat_history") | RunnableLambda(_format_chat_history),
+        "network_topology": itemgetter("topology") | RunnableLambda(topology_json),
+        "chat_history": itemgetter("chat_history") | RunnableLambda(format_chat_history),
         "question": itemgetter("question"),
         "document": {
-            "chat_history": itemgetter("chat_history") | RunnableLambda(_format_chat_history),
+            "chat_history": itemgetter("chat_history") | RunnableLambda(format_chat_history),
             "question": itemgetter("question"),
         } 
+        | budgeted("v2", "query", PROMPT_FOR_QUERY, "gpt-3.5-turbo-instruct", { "chat_history": HISTORY })
         | PROMPT_FOR_QUERY
-        | OpenAI(model="gpt-3.5-turbo-instruct", temperature=0)
+        | completion_model("gpt-3.5-turbo-instruct")
         | StrOutputParser()
-        | retriever
-        | _combine_documents,
+        | retriever,  # best first: the budget drops the last ones when they do not fit
     }
+    | budgeted("v2", "answer", PROMPT_FOR_ANSWER, "gpt-3.5-turbo-instruct", { "chat_history": HISTORY, "document": DOCUMENTS, "network_topology": TOPOLOGY })
     | PROMPT_FOR_ANSWER 
-    | OpenAI(model="gpt-3.5-turbo-instruct", temperature=0)
+    | completion_model("gpt-3.5-turbo-instruct")
     | output_parser
 )
\ No newline at end of file
@@ -1,7 +1,5 @@
 from operator import itemgetter
-from typing import List, Tuple
 
-from langchain.llms.openai import OpenAI
 from langchain.prompts.prompt import PromptTemplate
 from langchain.schema import format_document
 from langchain.schema.output_parser import StrOutputParser
@@ -9,27 +7,10 @@ from langchain.schema.runnable import RunnableLambda
 
 from dotenv import load_dotenv; load_dotenv()
 
-from api.app.utils import output_parser
-
-def load_retriever():
-    from langchain_community.embeddings import HuggingFaceEmbeddings
-    from langchain.vectorstores.faiss import FAISS
-    
-    model_name = "BAAI/bge-base-en-v1.5"
-    model_kwargs = { "device": "cuda" }
-    encode_kwargs = { "normalize_embeddings": True } # use cosine similarity
-    embedding = HuggingFaceEmbeddings(
-        model_name=model_name,
-        model_kwargs=model_kwargs,
-        encode_kwargs=encode_kwargs,
-    )
-    f_search = "faiss"
-    store_name = f"api/db/{f_search}"
-
-    docsearch = FAISS.load_local(store_name, embeddings=embedding)
-
-    retriever = docsearch.as_retriever()
-    return retriever
+from api.app.utils import output_parser, format_chat_history
+from api.app.llm import chat_model
+from api.app.topology import topology_json
+from api.app.prompts import HISTORY, TOPOLOGY, budgeted
 
 _TEMPLATE_FOR_QUERY = """I collected several guide documents for configuring Cisco or Juniper switches,
 In order for a language model-based retriever to extract meaningful documents, you must create the right query.
@@ -39,7 +20,11 @@ Please refer to the information below and create an appropriate query.
 - Current question: {question}"""
 PROMPT_FOR_QUERY = PromptTemplate.from_template(_TEMPLATE_FOR_QUERY)
 
-_TEMPLATE_FOR_ANSWER = """I have the following Network Topology.
+_TEMPLATE_FOR_ANSWER = """Solve the current question about the network topology below, using the previous chatting history.
+
+{format_instructions}
+
+I have the following Network Topology.
 
 - Network Topology: {network_topology}
 
@@ -50,8 +35,6 @@ And, the following information was exchanged through previous chatting.
 The problems we are currently trying to solve are as follows.
 
 - Current question: {question}
-
-{format_instructions}
 """
 PROMPT_FOR_ANSWER = PromptTemplate.from_template(
     _TEMPLATE_FOR_ANSWER,
@@ -59,28 +42,14 @@ PROMPT_FOR_ANSWER = PromptTemplate.from_template(
 )
 
 
-def _format_chat_history(chat_history: List[Tuple]) -> str:
-    """Format chat history into a string."""
-    buffer = ""
-    for dialogue_turn in chat_history:
-        human = "Human: " + dialogue_turn[0]
-        ai = "Assistant: " + dialogue_turn[1]
-        buffer += "\n" + "\n".join([human, ai])
-    if buffer == "":
-        buffer = "None"
-    return buffer
-
-retriever = load_retriever()
-
-from langchain_community.chat_models import ChatOpenAI
-
 chain = (
     {
-        "network_topology": itemgetter("topology"),
-        "chat_history": itemgetter("chat_history") | RunnableLambda(_format_chat_history),
+        "network_topology": itemgetter("topology") | RunnableLambda(topology_json),
+        "chat_history": itemgetter("chat_history") | RunnableLambda(format_chat_history),
         "question": itemgetter("question"),
     }
+    | budgeted("v3", "answer", PROMPT_FOR_ANSWER, "gpt-3.5-turbo", { "chat_history": HISTORY, "network_topology": TOPOLOGY })
     | PROMPT_FOR_ANSWER 
-    | ChatOpenAI(model="gpt-3.5-turbo", temperature=0)
+    | chat_model("gpt-3.5-turbo")
     | output_parser
 )
\ No newline at end of file
@@ -10,9 +10,7 @@
 # 3. Output을 구조화한다.
 # 3-1. Json Array 형태로 각 device의 command를 저장한다.
 from operator import itemgetter
-from typing import List, Tuple
 
-from langchain.llms.openai import OpenAI
 from langchain.prompts.prompt import PromptTemplate
 from langchain.schema import format_document
 from langchain.schema.output_parser import StrOutputParser
@@ -20,9 +18,16 @@ from langchain.schema.runnable import RunnableLambda
 
 from dotenv import load_dotenv; load_dotenv()
 
-from api.app.utils import output_parser, network_topology_parser
+from api.app.utils import output_parser, network_topology_parser, port_identification_parser, format_chat_history
+from api.app.llm import chat_model
+from api.app.validation import REPAIR_TEMPLATE
+from api.app.prompts import HISTORY, TOPOLOGY, budgeted
 
-_TEMPLATE_FOR_ALLOCATE_IP = """I have the following Network Topology.
+_TEMPLATE_FOR_ALLOCATE_IP = """Can you allocate IP addresses and subnet masks to each device's port of the Network Topology below? and, add this information to the "Network Topology" formatted with JSON?
+
+{format_instructions}
+
+I have the following Network Topology.
 
 - Network Topology: {network_topology}
 
@@ -34,10 +39,6 @@ The problems we are currently trying to solve are as follows.
 
 - Current question: {question}
 
-Can you allocate IP addresses and subnet masks to each device's port? and, add this information to the "Network Topology" formatted with JSON?
-
-{format_instructions}
-
 - Network Topology:"""
 
 PROMPT_FOR_ALLOCATE_IP = PromptTemplate.from_template(
@@ -48,7 +49,39 @@ PROMPT_FOR_ALLOCATE_IP = PromptTemplate.from_template(
 )
 
 
-_TEMPLATE_FOR_ANSWER = """I have the following Network Topology.
+# The IP plan alone, for the sliced device calls (the plan is read with port_identification_parser,
+# so it does not depend on how the LLM would name the keys of an annotated topology).
+_TEMPLATE_FOR_PORT_PLAN = """Can you allocate IP addresses and subnet masks to each device's port of the Network Topology below? and, list the device, port, ip address and subnet mask of every connected port formatted with JSON?
+
+{format_instructions}
+
+I have the following Network Topology.
+
+- Network Topology: {network_topology}
+
+And, the following information was exchanged through previous chatting.
+
+- Previous Chatting History: {chat_history}
+
+The problems we are currently trying to solve are as follows.
+
+- Current question: {question}
+"""
+
+PROMPT_FOR_PORT_PLAN = PromptTemplate.from_template(
+    _TEMPLATE_FOR_PORT_PLAN,
+    partial_variables={
+        "format_instructions": port_identification_parser.get_format_instructions(),
+    }
+)
+
+
+# The same for an edited lab (see api.app.incremental.updated_plan): only the ports without an address.
+_TEMPLATE_FOR_PORT_PLAN_UPDATE = """The Network Topology below was edited after its IP plan was made. The ports of the Current IP Plan keep their IP address and subnet mask. Can you allocate an IP address and subnet mask to each of the New Ports below only? A new port on a network segment that already has addresses gets an unused address of that subnet, and a new segment gets a subnet that no other port uses.
+
+{format_instructions}
+
+I have the following Network Topology.
 
 - Network Topology: {network_topology}
 
@@ -60,9 +93,35 @@ The problems we are currently trying to solve are as follows.
 
 - Current question: {question}
 
+- Current IP Plan: {current_plan}
+- New Ports: {new_ports}
+"""
+
+PROMPT_FOR_PORT_PLAN_UPDATE = PromptTemplate.from_template(
+    _TEMPLATE_FOR_PORT_PLAN_UPDATE,
+    partial_variables={
+        "format_instructions": port_identification_parser.get_format_instructions(),
+    }
+)
+
+
+_TEMPLATE_FOR_ANSWER = """Solve the current question about the network topology below, using the previous chatting history.
+
 {format_instructions}
 
 {output_examples}
+
+I have the following Network Topology.
+
+- Network Topology: {network_topology}
+
+And, the following information was exchanged through previous chatting.
+
+- Previous Chatting History: {chat_history}
+
+The problems we are currently trying to solve are as follows.
+
+- Current question: {question}
 """
 
 PROMPT_FOR_ANSWER = PromptTemplate.from_template(
@@ -78,51 +137,206 @@ PROMPT_FOR_ANSWER = PromptTemplate.from_template(
     }
 )
 
-def _format_chat_history(chat_history: List[Tuple]) -> str:
-    """Format chat history into a string."""
-    buffer = ""
-    for dialogue_turn in chat_history:
-        human = "Human: " + dialogue_turn[0]
-        ai = "Assistant: " + dialogue_turn[1]
-        buffer += "\n" + "\n".join([human, ai])
-    if buffer == "":
-        buffer = "None"
-    return buffer
-
-from langchain_community.chat_models import ChatOpenAI
-
 chain = (
     {
         "network_topology": {
             "network_topology": itemgetter("topology"),
-            "chat_history": itemgetter("chat_history") | RunnableLambda(_format_chat_history),
+            "chat_history": itemgetter("chat_history") | RunnableLambda(format_chat_history),
             "question": itemgetter("question"),
-        } | PROMPT_FOR_ALLOCATE_IP | ChatOpenAI(model="gpt-3.5-turbo", temperature=0) | network_topology_parser,
-        "chat_history": itemgetter("chat_history") | RunnableLambda(_format_chat_history),
+        } | budgeted("v4", "ip_plan", PROMPT_FOR_ALLOCATE_IP, "gpt-3.5-turbo", { "chat_history": HISTORY, "network_topology": TOPOLOGY }) | PROMPT_FOR_ALLOCATE_IP | chat_model("gpt-3.5-turbo") | network_topology_parser,
+        "chat_history": itemgetter("chat_history") | RunnableLambda(format_chat_history),
         "question": itemgetter("question"),
     }
+    | budgeted("v4", "answer", PROMPT_FOR_ANSWER, "gpt-3.5-turbo", { "chat_history": HISTORY })
     | PROMPT_FOR_ANSWER 
-    | ChatOpenAI(model="gpt-3.5-turbo", temperature=0)
+    | chat_model("gpt-3.5-turbo")
     | output_parser
 )
 first_chain = (
     {
         "network_topology": itemgetter("topology"),
-        "chat_history": itemgetter("chat_history") | RunnableLambda(_format_chat_history),
+        "chat_history": itemgetter("chat_history") | RunnableLambda(format_chat_history),
+        "question": itemgetter("question"),
+    }
+    | budgeted("v4", "ip_plan", PROMPT_FOR_PORT_PLAN, "gpt-3.5-turbo", { "chat_history": HISTORY, "network_topology": TOPOLOGY })
+    | PROMPT_FOR_PORT_PLAN
+    | chat_model("gpt-3.5-turbo")
+    | port_identification_parser
+)
+
+update_chain = (
+    {
+        "network_topology": itemgetter("topology"),
+        "chat_history": itemgetter("chat_history") | RunnableLambda(format_chat_history),
         "question": itemgetter("question"),
+        "current_plan": itemgetter("current_plan"),
+        "new_ports": itemgetter("new_ports"),
     }
-    | PROMPT_FOR_ALLOCATE_IP 
-    | ChatOpenAI(model="gpt-3.5-turbo", temperature=0) 
-    | network_topology_parser
+    | budgeted("v4", "ip_plan", PROMPT_FOR_PORT_PLAN_UPDATE, "gpt-3.5-turbo", { "chat_history": HISTORY, "network_topology": TOPOLOGY })
+    | PROMPT_FOR_PORT_PLAN_UPDATE
+    | chat_model("gpt-3.5-turbo")
+    | port_identification_parser
 )
 
 second_chain = (
     {
         "network_topology": itemgetter("topology"),
-        "chat_history": itemgetter("chat_history") | RunnableLambda(_format_chat_history),
+        "chat_history": itemgetter("chat_history") | RunnableLambda(format_chat_history),
         "question": itemgetter("question"),
     }
+    | budgeted("v4", "device", PROMPT_FOR_ANSWER, "gpt-3.5-turbo", { "chat_history": HISTORY })
     | PROMPT_FOR_ANSWER 
-    | ChatOpenAI(model="gpt-3.5-turbo", temperature=0)
+    | chat_model("gpt-3.5-turbo")
+    | output_parser
+)
+
+REPAIR_PROMPT = PromptTemplate.from_template(REPAIR_TEMPLATE, partial_variables={"format_instructions": output_parser.get_format_instructions()})
+repair_chain = (
+    budgeted("v4", "repair", REPAIR_PROMPT, "gpt-3.5-turbo")
+    | REPAIR_PROMPT
+    | chat_model("gpt-3.5-turbo", json_mode=True)
     | output_parser
-)
\ No newline at end of file
+)
+
+import asyncio
+import json
+import time
+from typing import List, Optional
+from api.app import config as settings
+from api.app.metrics import record_stage, timed, timed_call
+from api.app.validation import checked, event_fields, record_saved_calls
+from api.app.utils import ChatRequest
+from api.app.allocator import allocate_ips
+from api.app.executor import SharedCalls, as_completed_bounded, gather_bounded
+from api.app.slicing import TopologySlicer
+from api.app.topology import load_topology
+from api.app.incremental import diff_topologies, fingerprint, is_empty, sessions, updated_plan
+
+async def configure_device(version: str, request: dict, view: str, node, slicer: TopologySlicer, validate: bool):
+    """(response, validation report) of one device, checked and repaired (see api.app.validation) unless `validate` is off."""
+    question = request["question"] + f" for this purpose, how can I configure device {node.name}?"
+    generate = lambda: second_chain.ainvoke({ **request, "topology": view, "question": question })
+    if not validate:
+        return await generate(), {}
+    return await checked(version, node, slicer, generate, lambda previous_output, problems: repair_chain.ainvoke({ "device_name": node.name, "request": request["question"], "device_view": view, "previous_output": previous_output, "problems": problems }))
+
+# 1. get ip addresses for every port (locally or from the LLM)
+# 2. ask for each device's configuration, yielding each one as soon as it is done
+#    (with a session_id, only the devices whose slice or question changed since the last request)
+# 3. check each answer and ask again for the broken ones, alone
+async def astream(input: ChatRequest, config: Optional[dict] = None):
+    started = time.perf_counter()
+    configurable = (config or {}).get("configurable", {})
+    session = sessions.get("v4", configurable.get("session_id"))
+    network_topology = load_topology(input.topology)
+    request = { **input.dict(), "topology": network_topology.json }
+    diff = None
+    if session is not None and session.topology is not None:
+        diff = diff_topologies(session.topology, network_topology)
+        yield { "stage": "diff", "output": diff }
+
+    previous_plan = session.port_identification if session is not None else None
+    with timed("v4", "ip_plan"):
+        if configurable.get("ip_allocation", settings.IP_ALLOCATION) == "graph":
+            port_identification = allocate_ips(network_topology, configurable.get("ip_pool"), previous_plan)
+        elif previous_plan is not None and is_empty(diff) and session.question == input.question:
+            port_identification = previous_plan
+        elif previous_plan is not None and not is_empty(diff):
+            # The ports whose link did not change keep their addresses; only the others are asked for.
+            port_identification = await updated_plan(session.topology, network_topology, previous_plan, lambda current_plan, new_ports: update_chain.ainvoke({
+                **request, "current_plan": json.dumps(current_plan), "new_ports": json.dumps(new_ports),
+            }))
+        else:
+            port_identification = await first_chain.ainvoke(request)
+    yield { "stage": "ip_plan", "output": port_identification }
+
+    # Each device gets its own slice of the topology instead of the whole graph.
+    fan_out = time.perf_counter()
+    slicer = TopologySlicer(network_topology, port_identification)
+    node_info = slicer.topology.nodes
+    views = [slicer.view_json(node.name) for node in node_info]
+    keys = [fingerprint(input.question, view) for view in views]
+    devices, pending = {}, []
+    for index, node in enumerate(node_info):
+        response = session.response(node.name, keys[index]) if session is not None else None
+        if response is not None:
+            devices[node.name] = (keys[index], response)
+            yield { "stage": "device", "index": index, "output": response, "reused": True }
+        else:
+            pending.append(index)
+    validate = configurable.get("validation", settings.VALIDATION)
+    repair_calls = 0
+    async for position, (response, report) in as_completed_bounded([
+        lambda index=index: timed_call("v4", "device", configure_device("v4", request, views[index], node_info[index], slicer, validate), per_request=False)
+        for index in pending
+    ]):
+        index = pending[position]
+        repair_calls += report.get("repair_calls", 0)
+        if not report.get("invalid"):
+            devices[node_info[index].name] = (keys[index], response)
+        yield { "stage": "device", "index": index, "output": response, **event_fields(report) }
+    record_saved_calls("v4", len(pending), repair_calls)
+    record_stage("v4", "devices", time.perf_counter() - fan_out)
+
+    if session is not None:
+        session.topology, session.question = network_topology, input.question
+        session.port_identification, session.devices = port_identification, devices
+        sessions.save("v4", configurable["session_id"], session)
+    record_stage("v4", "total", time.perf_counter() - started)
+
+async def invoke(input: ChatRequest, config: Optional[dict] = None):
+    """Device configurations in node_info order."""
+    outputs = {}
+    async for event in astream(input, config):
+        if event["stage"] == "device":
+            outputs[event["index"]] = event["output"]
+    return [outputs[index] for index in sorted(outputs)]
+
+async def abatch(inputs: List[ChatRequest], configs: Optional[List[Optional[dict]]] = None):
+    """Device configurations for several requests, in input order.
+
+    Requests about the same topology share its parsing and IP plan, and identical device
+    prompts are sent once. All per-device calls of the batch go through one bounded pool.
+    """
+    started = time.perf_counter()
+    configs = configs or [None] * len(inputs)
+    shared = SharedCalls()
+    plans, slicers = {}, {}
+
+    async def prepare(input: ChatRequest, config: Optional[dict]):
+        configurable = (config or {}).get("configurable", {})
+        network_topology = load_topology(input.topology)
+        request = { **input.dict(), "topology": network_topology.json }
+        topology_key = network_topology.hash
+        if configurable.get("ip_allocation", settings.IP_ALLOCATION) == "graph":
+            plan_key = ("graph", topology_key, configurable.get("ip_pool"))
+            if plan_key not in plans:
+                plans[plan_key] = allocate_ips(network_topology, configurable.get("ip_pool"))
+            port_identification = plans[plan_key]
+        else:
+            plan_key = ("llm", topology_key, fingerprint(input.chat_history, input.question))
+            port_identification = await shared(plan_key, lambda: first_chain.ainvoke(request))
+        if plan_key not in slicers:
+            slicers[plan_key] = TopologySlicer(network_topology, port_identification)
+        return request, slicers[plan_key], configurable.get("validation", settings.VALIDATION)
+
+    with timed("v4_batch", "prepare"):
+        prepared = await asyncio.gather(*(prepare(input, config) for input, config in zip(inputs, configs)))
+
+    # One pool for every device of every request; identical prompts are only sent once.
+    jobs, factories, outputs = {}, [], []
+    for request, slicer, validate in prepared:
+        keys = []
+        for node in slicer.topology.nodes:
+            view = slicer.view_json(node.name)
+            key = fingerprint(request["chat_history"], request["question"], view, validate)
+            if key not in jobs:
+                jobs[key] = len(factories)
+                factories.append(lambda request=request, view=view, node=node, slicer=slicer, validate=validate: configure_device("v4_batch", request, view, node, slicer, validate))
+            keys.append(jobs[key])
+        outputs.append(keys)
+    with timed("v4_batch", "devices"):
+        responses = await gather_bounded(factories, settings.BATCH_DEVICE_CONCURRENCY)
+    record_saved_calls("v4_batch", len(factories), sum(report.get("repair_calls", 0) for _, report in responses))
+    record_stage("v4_batch", "total", time.perf_counter() - started)
+    return [[responses[job][0] for job in keys] for keys in outputs]
@@ -20,33 +20,32 @@ If the content of a previous conversation is as follows, summarize the content i
 
 - Previous conversation: {prev_conversation}"""
 
-SECOND_STEP_TEMPLATE = INSTRUCTION + '\n' + """You are currently in stage 2.
+FIRST_STEP_UPDATE_TEMPLATE = INSTRUCTION + '\n' + """You are currently in stage 1.
 
-A summary of the previous conversation follows:
+The conversation so far has been summarized as follows. Update the summary with the new exchange and write it in one paragraph.
 
 - Summary of previous conversation: {prev_conversation_summary}
+- New exchange: {new_conversation}"""
 
-The current network topology is as follows.
+SECOND_STEP_TEMPLATE = INSTRUCTION + '\n' + """You are currently in stage 2.
 
-- network topology : {network_topology}
+You will be given the current network topology, a summary of the previous conversation and my current requirements. Please suggest how to design the overall network.
 
-Currently my requirements are:
-
-- Current conversation content: {question}
+The current network topology is as follows.
 
-At this time, please suggest how to design the overall network."""
+- network topology : {network_topology}
 
-THIRD_STEP_TEMPLATE = INSTRUCTION + '\n' + """You are currently in stage 3.
+A summary of the previous conversation follows:
 
-Details on the overall network design are as follows.
+- Summary of previous conversation: {prev_conversation_summary}
 
-- Network design: {design_of_network}
+Currently my requirements are:
 
-The current network topology is as follows.
+- Current conversation content: {question}"""
 
-- network topology : {network_topology}
+THIRD_STEP_TEMPLATE = INSTRUCTION + '\n' + """You are currently in stage 3.
 
-Assign an appropriate IP address and subnet mask to the every connected port of each device.
+Assign an appropriate IP address and subnet mask to the every connected port of each device of the network topology given below, according to the overall network design given below.
 
 You should consider the following points.
 
@@ -66,25 +65,53 @@ If using DHCP, configure it correctly to avoid assigning an IP address that is a
 Consider how your network topology (the arrangement and connection of network devices) influences your IP addressing scheme.
 ```
 
-{format_instructions}"""
+{format_instructions}
 
-FOURTH_STEP_TEMPLATE = INSTRUCTION + '\n' + """You are currently in stage 4.
+The current network topology is as follows.
+
+- network topology : {network_topology}
 
 Details on the overall network design are as follows.
 
-- Network design: {design_of_network}
+- Network design: {design_of_network}"""
+
+# Stage 3 for an edited lab (see api.app.incremental.updated_plan): only the ports without an address.
+THIRD_STEP_UPDATE_TEMPLATE = INSTRUCTION + '\n' + """You are currently in stage 3.
+
+The network topology given below was edited after its IP plan was made. The ports of the current IP plan keep their ip address and subnet mask.
+Assign an appropriate IP address and subnet mask to each of the new ports given below only, according to the overall network design given below. A new port on a network segment that already has addresses gets an unused address of that subnet; a new segment gets a subnet that no other port uses.
+
+{format_instructions}
 
 The current network topology is as follows.
 
-- network topology: {network_topology}
-- ip address / subnet mask : {port_identification}
+- network topology : {network_topology}
+
+Details on the overall network design are as follows.
+
+- Network design: {design_of_network}
+
+- current IP plan: {current_plan}
+- new ports: {new_ports}"""
+
+FOURTH_STEP_TEMPLATE = INSTRUCTION + '\n' + """You are currently in stage 4.
 
-The node_name that you need to configure is {device_name}.
-Create a CLI command according to the above design. In this step, you should assign the ip address and subnet mask to the every port of the device.
+You will be given the overall network design, the part of the network topology around one device (its connected ports with their ip address / subnet mask, neighbours and subnets) and the node_name of that device.
+Create a CLI command for that device according to the design. In this step, you should assign the ip address and subnet mask to the every port of the device.
 
 {format_instructions}
 
-{example_command}"""
+{example_command}
+
+Details on the overall network design are as follows.
+
+- Network design: {design_of_network}
+
+The part of the network topology around the device is as follows.
+
+- device view: {device_view}
+
+The node_name that you need to configure is {device_name}."""
 
 OUTPUT_EXAMPLE_COMMAND = """Below are examples of creation.
 
@@ -97,47 +124,382 @@ OUTPUT_EXAMPLE_COMMAND = """Below are examples of creation.
 # 2. Create Prompt
 from langchain.prompts.prompt import PromptTemplate
 from api.app.utils import output_parser, port_identification_parser
+from api.app.validation import REPAIR_TEMPLATE
 
 first_step_prompt = PromptTemplate.from_template(FIRST_STEP_TEMPLATE)
+first_step_update_prompt = PromptTemplate.from_template(FIRST_STEP_UPDATE_TEMPLATE)
 second_step_prompt = PromptTemplate.from_template(SECOND_STEP_TEMPLATE)
 third_step_prompt = PromptTemplate.from_template(THIRD_STEP_TEMPLATE, partial_variables={"format_instructions": port_identification_parser.get_format_instructions()})
+third_step_update_prompt = PromptTemplate.from_template(THIRD_STEP_UPDATE_TEMPLATE, partial_variables={"format_instructions": port_identification_parser.get_format_instructions()})
 forth_step_prompt = PromptTemplate.from_template(FOURTH_STEP_TEMPLATE, partial_variables={"format_instructions": output_parser.get_format_instructions(), "example_command": OUTPUT_EXAMPLE_COMMAND})
+repair_step_prompt = PromptTemplate.from_template(REPAIR_TEMPLATE, partial_variables={"format_instructions": output_parser.get_format_instructions()})
 
 # 3. Create Chain
-from langchain_community.chat_models import ChatOpenAI
+from api.app.llm import chat_model
 from langchain.schema.output_parser import StrOutputParser
+from api.app.prompts import HISTORY, TOPOLOGY, budgeted
+
+MODEL = "gpt-3.5-turbo-1106"
 
-first_step_chain = first_step_prompt | ChatOpenAI(model="gpt-3.5-turbo-1106", temperature=0) | StrOutputParser()
-second_step_chain = second_step_prompt | ChatOpenAI(model="gpt-3.5-turbo-1106", temperature=0) | StrOutputParser()
-third_step_chain = third_step_prompt | ChatOpenAI(model="gpt-3.5-turbo-1106", temperature=0) | port_identification_parser
-fourth_step_chain = forth_step_prompt | ChatOpenAI(model="gpt-3.5-turbo-1106", temperature=0) | output_parser
+# Each prompt is fitted into its stage's token budget first (see api.app.prompts).
+first_step_chain = budgeted("v5", "summary", first_step_prompt, MODEL, { "prev_conversation": HISTORY }) | first_step_prompt | chat_model(MODEL) | StrOutputParser()
+first_step_update_chain = budgeted("v5", "summary_update", first_step_update_prompt, MODEL, { "new_conversation": HISTORY }) | first_step_update_prompt | chat_model(MODEL) | StrOutputParser()
+second_step_chain = budgeted("v5", "design", second_step_prompt, MODEL, { "network_topology": TOPOLOGY }) | second_step_prompt | chat_model(MODEL) | StrOutputParser()
+third_step_chain = budgeted("v5", "ip_plan", third_step_prompt, MODEL, { "network_topology": TOPOLOGY }) | third_step_prompt | chat_model(MODEL) | port_identification_parser
+# The same call, streamed: its answer is parsed as it arrives (see stream_ip_plan).
+third_step_stream = budgeted("v5", "ip_plan", third_step_prompt, MODEL, { "network_topology": TOPOLOGY }) | third_step_prompt | chat_model(MODEL)
+third_step_update_chain = budgeted("v5", "ip_plan", third_step_update_prompt, MODEL, { "network_topology": TOPOLOGY }) | third_step_update_prompt | chat_model(MODEL) | port_identification_parser
+fourth_step_chain = budgeted("v5", "device", forth_step_prompt, MODEL) | forth_step_prompt | chat_model(MODEL) | output_parser
+repair_step_chain = budgeted("v5", "repair", repair_step_prompt, MODEL) | repair_step_prompt | chat_model(MODEL, json_mode=True) | output_parser
 
 
 ## 4. Create Invoke Function
 
 import asyncio
 import json
-from api.app.utils import ChatRequest
-
-async def invoke(input: ChatRequest):
-    if len(input.chat_history) != 0:
-        prev_conversation_summary = first_step_chain.invoke({ "prev_conversation": input.chat_history })
-    else:
-        prev_conversation_summary = "It dose not exist."
-    input.topology = json.loads(input.topology)
-    design_of_network = second_step_chain.invoke({ "prev_conversation_summary": prev_conversation_summary, "network_topology": input.topology, "question": input.question })
-    port_identification = third_step_chain.invoke({ "design_of_network": design_of_network, "network_topology": input.topology })
-    
-    node_info = input.topology["node_info"]
-    async_list = []
-    for node in node_info:
-        # if node["node_type"] == "ethernet_switch":
-        #     continue
-        node_response = fourth_step_chain.ainvoke({ "design_of_network": design_of_network, "network_topology": input.topology, "port_identification": port_identification, "device_name": node["node_name"] })
-        async_list.append(node_response)
-    finished, _ = await asyncio.wait(async_list, return_when=asyncio.ALL_COMPLETED)
-    print([f.result() for f in finished])
-    return [f.result() for f in finished]
+import logging
+import time
+from typing import Callable, List, Optional
+from api.app import config as settings
+from api.app.metrics import DEVICE_ANSWERS, record_stage, timed, timed_call
+from api.app.utils import ChatRequest, PortInfoScanner, format_chat_history
+from api.app.summary import ConversationSummaries, prefix_hashes
+from api.app.allocator import allocate_ips
+from api.app.executor import SharedCalls, StageGraph, TaskPool, gather_bounded
+from api.app.slicing import TopologySlicer
+from api.app.topology import load_topology
+from api.app.intent import device_scope, skipped_response
+from api.app.cli_templates import CliRenderer, design_spec
+from api.app.validation import checked, event_fields, record_saved_calls
+from api.app.incremental import diff_topologies, fingerprint, is_empty, sessions, updated_plan
+
+logger = logging.getLogger(__name__)
+
+conversation_summaries = ConversationSummaries(settings.SUMMARY_CACHE_SIZE)
+
+async def summarize_conversation(chat_history) -> str:
+    """Stage 1, reusing the summary of the conversation up to the previous turn when there is one."""
+    return await conversation_summaries.summarize(
+        chat_history,
+        lambda history: first_step_chain.ainvoke({ "prev_conversation": format_chat_history(history) }),
+        lambda summary, turns: first_step_update_chain.ainvoke({ "prev_conversation_summary": summary, "new_conversation": format_chat_history(turns) }),
+    )
+
+def scope_of(network_topology, question: str, design_of_network: str, configurable: dict) -> dict:
+    """The devices stage 4 has to call the LLM for (see api.app.intent.device_scope)."""
+    return device_scope(network_topology, question, design_of_network, configurable.get("device_pruning", None if settings.DEVICE_PRUNING else False))
+
+def renderer_of(slicer: TopologySlicer, question: str, design_of_network: str, configurable: dict) -> Optional[CliRenderer]:
+    """Renders the devices the CLI templates cover (see api.app.cli_templates), unless switched off."""
+    if not configurable.get("cli_templates", settings.CLI_TEMPLATES):
+        return None
+    return CliRenderer(slicer, design_spec(design_of_network, question, [node.name for node in slicer.topology.nodes]))
+
+async def configure_device(version: str, design_of_network: str, view: str, node, slicer: TopologySlicer, validate: bool):
+    """(response, validation report) of the stage-4 call for one device, checked and repaired
+    (see api.app.validation) unless `validate` is off."""
+    generate = lambda: fourth_step_chain.ainvoke({ "design_of_network": design_of_network, "device_view": view, "device_name": node.name })
+    if not validate:
+        return await generate(), {}
+    return await checked(version, node, slicer, generate, lambda previous_output, problems: repair_step_chain.ainvoke({ "device_name": node.name, "request": design_of_network, "device_view": view, "previous_output": previous_output, "problems": problems }))
+
+async def stream_ip_plan(design_of_network: str, network_topology, on_entry: Callable[[dict], None]) -> dict:
+    """Stage 3 through the LLM, streamed: `on_entry` gets each entry of the plan as soon as it is
+    complete; returns the whole plan, parsed once the answer is in."""
+    scanner, text = PortInfoScanner(), []
+    async for chunk in third_step_stream.astream({ "design_of_network": design_of_network, "network_topology": network_topology.json }):
+        text.append(chunk.content)
+        for entry in scanner.feed(chunk.content):
+            on_entry(entry)
+    return port_identification_parser.parse("".join(text))
+
+async def update_ip_plan(design_of_network: str, network_topology, previous_topology, previous_plan: dict) -> dict:
+    """Stage 3 through the LLM for an edited lab: only the ports whose link changed are asked for."""
+    return await updated_plan(previous_topology, network_topology, previous_plan, lambda current_plan, new_ports: third_step_update_chain.ainvoke({
+        "design_of_network": design_of_network, "network_topology": network_topology.json,
+        "current_plan": json.dumps(current_plan), "new_ports": json.dumps(new_ports),
+    }))
+
+async def astream(input: ChatRequest, config: Optional[dict] = None):
+    """Run the four stages, yielding an event as soon as each stage (and then each device) is done.
+
+    With a session_id in the run config, answers of devices whose inputs did not change since the
+    session's previous request are reused (their events carry "reused": True). Devices outside the
+    scope of the question (see api.app.intent) are answered locally ("skipped": True), and so are
+    the devices the CLI templates can render ("rendered": True). The other answers are checked and,
+    when broken, repaired on their own ("repaired": True, or "invalid": True with their "problems").
+
+    Stages start as soon as their inputs are ready: the topology is parsed, and addressed by the
+    graph allocator, while the conversation is summarized. When the IP plan comes from the LLM, its
+    answer is streamed and a device's stage-4 call starts once every address its view shows is in
+    (see TopologySlicer.waiting_for), so "scope" and "device" events can come before "ip_plan".
+    """
+    started = time.perf_counter()
+    configurable = (config or {}).get("configurable", {})
+    session = sessions.get("v5", configurable.get("session_id"))
+    history = fingerprint(input.chat_history)
+    reused = set()
+    ip_allocation = configurable.get("ip_allocation", settings.IP_ALLOCATION)
+    previous_plan = session.port_identification if session is not None else None
+
+    async def summarize():
+        if len(input.chat_history) == 0:
+            return "It dose not exist."
+        with timed("v5", "summary"):
+            return await summarize_conversation(input.chat_history)
+
+    async def parse():
+        return load_topology(input.topology)
+
+    async def compare(network_topology):
+        if session is None or session.topology is None:
+            return None
+        return diff_topologies(session.topology, network_topology)
+
+    async def design(prev_conversation_summary, network_topology, diff):
+        # Only the same question about the same lab and conversation keeps its design; after an edit
+        # the design is made again, and the device fingerprints tell which answers still hold.
+        if (session is not None and session.design is not None and diff is not None and is_empty(diff)
+                and session.question == input.question and session.history == history and session.summary == prev_conversation_summary):
+            reused.add("design")
+            return session.design
+        with timed("v5", "design"):
+            return await second_step_chain.ainvoke({ "prev_conversation_summary": prev_conversation_summary, "network_topology": network_topology.json, "question": input.question })
+
+    async def allocate(network_topology):
+        with timed("v5", "ip_plan"):
+            return allocate_ips(network_topology, configurable.get("ip_pool"), previous_plan)
+
+    # Every stage is awaited so that a single request never blocks the event loop.
+    graph = StageGraph()
+    graph.add("summary", summarize)
+    graph.add("topology", parse)
+    graph.add("diff", compare, "topology")
+    graph.add("design", design, "summary", "topology", "diff")
+    if ip_allocation == "graph":
+        # The allocator only needs the topology.
+        graph.add("ip_plan", allocate, "topology")
+    pool = TaskPool()
+    try:
+        prev_conversation_summary = await graph["summary"]
+        yield { "stage": "summary", "output": prev_conversation_summary }
+
+        network_topology = await graph["topology"]
+        diff = await graph["diff"]
+        if diff is not None:
+            yield { "stage": "diff", "output": diff }
+
+        design_of_network = await graph["design"]
+        yield { "stage": "design", "output": design_of_network, **({ "reused": True } if "design" in reused else {}) }
+
+        port_identification = None
+        if ip_allocation == "graph":
+            port_identification = await graph["ip_plan"]
+        elif previous_plan is not None and diff is not None and is_empty(diff) and design_of_network == session.design:
+            port_identification = previous_plan
+        elif previous_plan is not None and diff is not None and not is_empty(diff):
+            # The ports whose link did not change keep their addresses, so their devices' views do too.
+            with timed("v5", "ip_plan"):
+                port_identification = await update_ip_plan(design_of_network, network_topology, session.topology, previous_plan)
+        streamed = port_identification is None and configurable.get("stream_ip_plan", settings.STREAM_IP_PLAN)
+        if port_identification is None and not streamed:
+            with timed("v5", "ip_plan"):
+                port_identification = await third_step_chain.ainvoke({ "design_of_network": design_of_network, "network_topology": network_topology.json })
+        if not streamed:
+            yield { "stage": "ip_plan", "output": port_identification }
+
+        scope = scope_of(network_topology, input.question, design_of_network, configurable)
+        yield { "stage": "scope", "output": scope }
+
+        # Fan out one call per device in scope (bounded per request and per process).
+        # Each device only sees its own slice of the topology and the IP plan.
+        fan_out = time.perf_counter()
+        slicer = TopologySlicer(network_topology, port_identification or {})
+        renderer = renderer_of(slicer, input.question, design_of_network, configurable)
+        node_info = network_topology.nodes
+        in_scope = set(scope["devices"]) if scope["devices"] is not None else None
+        validate = configurable.get("validation", settings.VALIDATION)
+        views, keys = {}, {}
+        devices, pending = {}, []
+
+        def start(index: int) -> None:
+            """Answers a device in scope whose view is final: by the templates, the session or the LLM."""
+            node = node_info[index]
+            views[index] = slicer.view_json(node.name)
+            keys[index] = fingerprint(design_of_network, views[index])
+            response = renderer.render(node.name) if renderer is not None else None
+            if response is not None:
+                devices[node.name] = (keys[index], response)
+                DEVICE_ANSWERS.inc(version="v5", source="template")
+                pool.put(index, { "stage": "device", "index": index, "output": response, "rendered": True })
+                return
+            response = session.response(node.name, keys[index]) if session is not None else None
+            if response is not None:
+                devices[node.name] = (keys[index], response)
+                DEVICE_ANSWERS.inc(version="v5", source="reused")
+                pool.put(index, { "stage": "device", "index": index, "output": response, "reused": True })
+                return
+            pending.append(index)
+            pool.submit(index, lambda: timed_call("v5", "device", configure_device("v5", design_of_network, views[index], node, slicer, validate), per_request=False))
+
+        # While the plan streams in, devices wait for the ports their view shows (watchers: port -> devices).
+        # The templates need the whole plan (static routes), and so do L2 devices.
+        waiting, watchers, deferred = {}, {}, []
+        for index, node in enumerate(node_info):
+            if in_scope is not None and node.name not in in_scope:
+                DEVICE_ANSWERS.inc(version="v5", source="skipped")
+                pool.put(index, { "stage": "device", "index": index, "output": skipped_response(node.name), "skipped": True })
+                continue
+            if streamed:
+                ports = slicer.waiting_for(node.name)
+                if ports is None or (renderer is not None and renderer.covers(node.name)):
+                    deferred.append(index)
+                    continue
+                if ports:
+                    waiting[index] = set(ports)
+                    for port in ports:
+                        watchers.setdefault(port, []).append(index)
+                    continue
+            start(index)
+
+        def on_entry(entry: dict) -> None:
+            streamed_entries.append(entry)
+            port = slicer.add(entry)
+            for index in watchers.pop(port, []):
+                waiting[index].discard(port)
+                if not waiting[index]:
+                    del waiting[index]
+                    start(index)
+
+        async def plan() -> None:
+            nonlocal port_identification
+            try:
+                with timed("v5", "ip_plan"):
+                    port_identification = await stream_ip_plan(design_of_network, network_topology, on_entry)
+                entries = port_identification.get("port_info", [])
+                if entries[:len(streamed_entries)] == streamed_entries:
+                    for entry in entries[len(streamed_entries):]:
+                        on_entry(entry)
+                else:
+                    logger.warning("v5: the streamed IP plan differs from the parsed answer; devices already started kept the streamed one")
+                pool.put("ip_plan", { "stage": "ip_plan", "output": port_identification })
+                for index in sorted(deferred + list(waiting)):
+                    start(index)
+                pool.close()
+            except Exception as error:
+                pool.fail(error)
+
+        streamed_entries: List[dict] = []
+        if streamed:
+            graph.add("stream_ip_plan", plan)
+        else:
+            pool.close()
+        repair_calls = 0
+        async for index, result in pool.results():
+            if isinstance(result, dict):  # a ready event
+                yield result
+                continue
+            response, report = result
+            repair_calls += report.get("repair_calls", 0)
+            if not report.get("invalid"):
+                devices[node_info[index].name] = (keys[index], response)
+            DEVICE_ANSWERS.inc(version="v5", source="llm")
+            yield { "stage": "device", "index": index, "output": response, **event_fields(report) }
+        record_saved_calls("v5", len(pending), repair_calls)
+        record_stage("v5", "devices", time.perf_counter() - fan_out)
+
+        if session is not None:
+            session.topology, session.question, session.design = network_topology, input.question, design_of_network
+            session.summary, session.history = prev_conversation_summary, history
+            session.port_identification, session.devices = port_identification, devices
+            sessions.save("v5", configurable["session_id"], session)
+        record_stage("v5", "total", time.perf_counter() - started)
+    finally:
+        graph.cancel()
+        pool.cancel()
+
+async def invoke(input: ChatRequest, config: Optional[dict] = None):
+    """Device configurations in node_info order."""
+    outputs = {}
+    async for event in astream(input, config):
+        if event["stage"] == "device":
+            outputs[event["index"]] = event["output"]
+    return [outputs[index] for index in sorted(outputs)]
+
+async def abatch(inputs: List[ChatRequest], configs: Optional[List[Optional[dict]]] = None):
+    """Device configurations for several requests, in input order.
+
+    Requests about the same topology share its parsing and IP plan, identical conversations
+    share one summary, identical (summary, topology, question) share one design, and identical
+    device prompts are sent once. All stage-4 calls of the batch go through one bounded pool;
+    devices out of scope or covered by the CLI templates never reach it.
+    """
+    started = time.perf_counter()
+    configs = configs or [None] * len(inputs)
+    shared = SharedCalls()
+    plans, slicers = {}, {}
+
+    async def prepare(input: ChatRequest, config: Optional[dict]):
+        configurable = (config or {}).get("configurable", {})
+        if len(input.chat_history) != 0:
+            history = prefix_hashes(input.chat_history)[-1]
+            prev_conversation_summary = await shared(("summary", history), lambda: summarize_conversation(input.chat_history))
+        else:
+            prev_conversation_summary = "It dose not exist."
+
+        network_topology = load_topology(input.topology)
+        topology_key = network_topology.hash
+        design_of_network = await shared(
+            ("design", prev_conversation_summary, topology_key, input.question),
+            lambda: second_step_chain.ainvoke({ "prev_conversation_summary": prev_conversation_summary, "network_topology": network_topology.json, "question": input.question }),
+        )
+
+        if configurable.get("ip_allocation", settings.IP_ALLOCATION) == "graph":
+            plan_key = ("graph", topology_key, configurable.get("ip_pool"))
+            if plan_key not in plans:
+                plans[plan_key] = allocate_ips(network_topology, configurable.get("ip_pool"))
+            port_identification = plans[plan_key]
+        else:
+            plan_key = ("llm", topology_key, design_of_network)
+            port_identification = await shared(plan_key, lambda: third_step_chain.ainvoke({ "design_of_network": design_of_network, "network_topology": network_topology.json }))
+        if plan_key not in slicers:
+            slicers[plan_key] = TopologySlicer(network_topology, port_identification)
+        scope = scope_of(network_topology, input.question, design_of_network, configurable)
+        renderer = renderer_of(slicers[plan_key], input.question, design_of_network, configurable)
+        validate = configurable.get("validation", settings.VALIDATION)
+        return design_of_network, slicers[plan_key], scope["devices"], renderer, validate
+
+    with timed("v5_batch", "prepare"):
+        prepared = await asyncio.gather(*(prepare(input, config) for input, config in zip(inputs, configs)))
+
+    # One pool for every device in scope that the templates do not render; identical prompts are only sent once.
+    jobs, factories, outputs = {}, [], []
+    for design_of_network, slicer, in_scope, renderer, validate in prepared:
+        keys = []
+        in_scope = set(in_scope) if in_scope is not None else None
+        for node in slicer.topology.nodes:
+            if in_scope is not None and node.name not in in_scope:
+                DEVICE_ANSWERS.inc(version="v5_batch", source="skipped")
+                keys.append(skipped_response(node.name))
+                continue
+            response = renderer.render(node.name) if renderer is not None else None
+            if response is not None:
+                DEVICE_ANSWERS.inc(version="v5_batch", source="template")
+                keys.append(response)
+                continue
+            DEVICE_ANSWERS.inc(version="v5_batch", source="llm")
+            view = slicer.view_json(node.name)
+            key = fingerprint(design_of_network, view, validate)
+            if key not in jobs:
+                jobs[key] = len(factories)
+                factories.append(lambda design_of_network=design_of_network, view=view, node=node, slicer=slicer, validate=validate: configure_device("v5_batch", design_of_network, view, node, slicer, validate))
+            keys.append(jobs[key])
+        outputs.append(keys)
+    with timed("v5_batch", "devices"):
+        responses = await gather_bounded(factories, settings.BATCH_DEVICE_CONCURRENCY)
+    record_saved_calls("v5_batch", len(factories), sum(report.get("repair_calls", 0) for _, report in responses))
+    record_stage("v5_batch", "total", time.perf_counter() - started)
+    return [[responses[job][0] if isinstance(job, int) else job for job in keys] for keys in outputs]
 
 # 5. Test
 
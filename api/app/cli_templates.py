@@ -0,0 +1,220 @@
+# Local rendering of the stage-4 CLI commands for routine designs.
+#
+# Most of what stage 4 writes is mechanical: `ip <addr> /<len> <gw>` on a VPCS,
+# `interface ... ip address ... no shutdown` on a router, then static routes or OSPF network
+# statements (the shapes of OUTPUT_EXAMPLE_COMMAND in chain_v5). When the design asks for nothing
+# more than addressing, static routing or single-area OSPF, those commands are rendered here from
+# the IP plan and the links, in the stage-4 output format, and only the devices the templates do
+# not cover (other node types, or designs that ask for anything more) still go to the LLM.
+#
+# The design of stage 2 is free text, so `design_spec` only lets the templates render when every
+# word of the design and the question is one it recognises: addressing, static routing and
+# single-area OSPF terms, plain English, and names and addresses. Anything else (a route-map, an
+# ACL, an MTU, a description, ...) sends every device to the LLM, so no requirement is dropped.
+import ipaddress
+import re
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set
+
+from api.app.allocator import GATEWAY_NODE_TYPES
+from api.app.intent import SKIPPED_COMMENT
+from api.app.slicing import TopologySlicer
+from api.app.topology import L2_NODE_TYPES, Node, Port
+
+# Requirements the templates carry out, as words (and the few phrases whose words are not
+# recognised alone: "default route" needs the LLM, "default gateway" does not).
+RECOGNISED_PHRASES = re.compile(
+    r"\b(default[- ]gateways?|subnet[- ]masks?|no shutdown|router ospf|next[- ]hops?)\b", re.IGNORECASE
+)
+REQUIREMENT_WORDS = frozenset("""
+    ip ipv4 address addresses addressing addressed assign assigns assigned assigning assignment allocate allocated allocation
+    subnet subnets subnetted subnetting mask masks netmask cidr prefix length network networks interface interfaces port ports
+    link links linked connect connects connected connecting connection connections connectivity ospf area backbone process
+    advertise advertises advertised advertising neighbor neighbors neighbour neighbours adjacency adjacencies static route routes
+    routed routing router routers gateway gateways hop hops device devices pc pcs host hosts vpcs switch switches hub hubs node
+    nodes lab topology gns3 cisco ios enable configure configures configured configuring configuration configurations config
+    command commands ping pings pinging reach reaches reachable reachability communicate communication traffic lan lans segment
+    segments subnetwork remote local directly protocol private range scheme plan design blueprint requirement requirements
+    """.split())
+ENGLISH_WORDS = frozenset("""
+    a an the this that these those it its they them their there here we our us you your i me my
+    and or but so then than also as if when where which who what how why while because since
+    to of in on at by for from with without into onto over under between through via across within per about
+    is are was were be been being has have had do does did will would should shall can could may might must need needs needed
+    each every all both any some other others another same different unique one two three four five first second third last
+    following follows follow below above given current currently new existing overall entire whole
+    use uses used using make makes made set sets setting add adds added adding create creates created run runs running
+    ensure ensures sure work works working allow allows able provide provides provided meet meets keep apply applied include includes including
+    properly correctly accordingly respectively appropriate appropriately suitable simple simply just well please
+    example e g eg ie etc such like way step steps stage part side end
+    """.split())
+WORD = re.compile(r"[a-z]+")
+AREA = re.compile(r"\barea\s+(\d+(?:\.\d+){0,3})\b", re.IGNORECASE)
+OSPF = re.compile(r"\bospf\b", re.IGNORECASE)
+# "route-map" is not a route.
+ROUTING = re.compile(r"(?<![\w-])rout(e|es|ing)(?![\w-])", re.IGNORECASE)
+
+VPCS_TYPES = {"vpcs"}
+ROUTER_TYPES = {"dynamips"}
+
+
+def unrecognised(text: str, names: Iterable[str] = ()) -> Set[str]:
+    """The words of `text` that are not in the templates' vocabulary (nor one of `names`)."""
+    known = REQUIREMENT_WORDS | ENGLISH_WORDS | {word for name in names for word in WORD.findall(name.lower())}
+    text = RECOGNISED_PHRASES.sub(" ", text)
+    # Anything with a digit is a name, an address or a number ("R1", "Gi0/0", "10.0.0.0/24").
+    text = " ".join(token for token in text.split() if not any(char.isdigit() for char in token))
+    return {word for word in WORD.findall(text.lower()) if len(word) > 1 and word not in known}
+
+
+def design_spec(design: str, question: str = "", names: Iterable[str] = ()) -> dict:
+    """What the design asks for, as far as the templates are concerned:
+
+    {"routing": "ospf" | "static" | "none", "area": str, "covers": node types the templates may render}.
+    `names` are the lab's node names, which the design may mention.
+    """
+    text = f"{question}\n{design or ''}"
+    areas = set(AREA.findall(text))
+    if OSPF.search(text):
+        routing = "ospf"
+    elif ROUTING.search(text):
+        routing = "static"
+    else:
+        routing = "none"
+    covers: Set[str] = set()
+    if not unrecognised(text, names):
+        covers |= VPCS_TYPES | L2_NODE_TYPES
+        if len(areas) <= 1:
+            covers |= ROUTER_TYPES
+    return { "routing": routing, "area": areas.pop() if areas else "0", "covers": covers }
+
+
+def _interface(entry: Optional[dict]) -> Optional[ipaddress.IPv4Interface]:
+    try:
+        interface = ipaddress.ip_interface(f"{entry['ip']}/{entry['subnet']}")
+    except (KeyError, TypeError, ValueError):
+        return None
+    return interface if interface.version == 4 else None
+
+
+class CliRenderer:
+    """Renders the stage-4 answer of the devices a design spec covers, from one slicer's plan."""
+
+    def __init__(self, slicer: TopologySlicer, spec: dict):
+        self.slicer = slicer
+        self.topology = slicer.topology
+        self.spec = spec
+        self._routes: Optional[Dict[str, List[tuple]]] = None
+
+    def covers(self, device_name: str) -> bool:
+        node = self.topology.by_name.get(device_name)
+        return node is not None and node.node_type in self.spec["covers"]
+
+    def render(self, device_name: str) -> Optional[dict]:
+        """The device's {"device", "command", "comment"}, or None when it needs the LLM."""
+        if not self.covers(device_name):
+            return None
+        node = self.topology.by_name[device_name]
+        if node.node_type in L2_NODE_TYPES:
+            # GNS3's built-in switches and hubs have no CLI: untagged ports need nothing.
+            return { "device": device_name, "command": "", "comment": SKIPPED_COMMENT }
+        interfaces = []
+        for port in node.ports:
+            if self.topology.peer(port) is None:
+                continue
+            interface = _interface(self.slicer.addresses.get(port))
+            if interface is None:  # a connected port the plan did not address
+                return None
+            interfaces.append((port, interface))
+        if node.node_type in VPCS_TYPES:
+            return self._vpcs(node, interfaces)
+        return self._router(node, interfaces)
+
+    def _vpcs(self, node: Node, interfaces: List[tuple]) -> Optional[dict]:
+        if len(interfaces) > 1:
+            return None
+        if not interfaces:
+            return { "device": node.name, "command": "", "comment": SKIPPED_COMMENT }
+        port, interface = interfaces[0]
+        gateway = self._gateway(port, interface)
+        command = f"ip {interface.ip} /{interface.network.prefixlen}" + (f" {gateway}" if gateway else "")
+        comment = f"configure {node.name} ip address" + (" and default gateway address" if gateway else "")
+        return { "device": node.name, "command": command, "comment": comment }
+
+    def _gateway(self, port: Port, interface: ipaddress.IPv4Interface) -> Optional[str]:
+        """The first router address on the host's subnet (the allocator gives routers the first addresses)."""
+        for other in self.slicer.segments.get(port, []):
+            if other is port or other.node.node_type not in GATEWAY_NODE_TYPES:
+                continue
+            address = _interface(self.slicer.addresses.get(other))
+            if address is not None and address.network == interface.network:
+                return str(address.ip)
+        return None
+
+    def _router(self, node: Node, interfaces: List[tuple]) -> dict:
+        if not interfaces:
+            return { "device": node.name, "command": "", "comment": SKIPPED_COMMENT }
+        lines = ["enable", "configure terminal"]
+        for port, interface in interfaces:
+            lines += [f"interface {port.name}", f"ip address {interface.ip} {interface.netmask}", "no shutdown"]
+        lines.append("exit")
+        comment = f"set the ip address of {node.name} on {', '.join(port.name for port, _ in interfaces)}"
+        if self.spec["routing"] == "ospf":
+            lines.append("router ospf 1")
+            for network in dict.fromkeys(interface.network for _, interface in interfaces):
+                lines.append(f"network {network.network_address} {network.hostmask} area {self.spec['area']}")
+            lines.append("exit")
+            comment += f" and configure OSPF routing in area {self.spec['area']}"
+        elif self.spec["routing"] == "static":
+            routes = self.routes().get(node.name, [])
+            lines += [f"ip route {network.network_address} {network.netmask} {next_hop}" for network, next_hop in routes]
+            if routes:
+                comment += f" and add static routes to {len(routes)} remote subnet{'s' if len(routes) != 1 else ''}"
+        lines += ["exit", "copy running-config startup-config", "exit"]
+        return { "device": node.name, "command": "\n".join(lines), "comment": comment + "." }
+
+    def routes(self) -> Dict[str, List[tuple]]:
+        """Static routes of every router: router name -> [(remote subnet, next-hop address)].
+
+        A breadth-first walk over the routers, where two routers are neighbours when they share a
+        subnet, gives each router the shortest way (fewest router hops) to every subnet it is not on.
+        """
+        if self._routes is not None:
+            return self._routes
+        # Router name -> {subnet: address of its port there}, and subnet -> routers on it.
+        attached: Dict[str, Dict[ipaddress.IPv4Network, str]] = {}
+        members: Dict[ipaddress.IPv4Network, List[str]] = {}
+        subnets: List[ipaddress.IPv4Network] = []
+        for node in self.topology.nodes:
+            for port in node.ports:
+                interface = _interface(self.slicer.addresses.get(port))
+                if interface is None or self.topology.peer(port) is None:
+                    continue
+                if interface.network not in members:
+                    members[interface.network] = []
+                    subnets.append(interface.network)
+                if node.node_type in GATEWAY_NODE_TYPES:
+                    attached.setdefault(node.name, {})[interface.network] = str(interface.ip)
+                    if node.name not in members[interface.network]:
+                        members[interface.network].append(node.name)
+
+        self._routes = {}
+        for router in attached:
+            # first_hop[other router] = the address of the neighbour to send its traffic to.
+            first_hop: Dict[str, str] = {router: ""}
+            queue = deque([router])
+            while queue:
+                current = queue.popleft()
+                for network in attached[current]:
+                    for neighbour in members[network]:
+                        if neighbour not in first_hop:
+                            first_hop[neighbour] = first_hop[current] or attached[neighbour][network]
+                            queue.append(neighbour)
+            # Each remote subnet goes through the closest router on it (routers come out of the walk nearest first).
+            via: Dict[ipaddress.IPv4Network, str] = {}
+            for member in first_hop:
+                for network in attached[member]:
+                    if network not in attached[router]:
+                        via.setdefault(network, first_hop[member])
+            self._routes[router] = [(network, via[network]) for network in subnets if network in via]
+        return self._routes
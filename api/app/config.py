@@ -0,0 +1,142 @@
+# Runtime settings for the API server.
+# Every value can be overridden from the environment (or the .env file).
+import os
+
+from dotenv import load_dotenv; load_dotenv()
+
+# Stage-4 (per-device) fan-out limits for /v4 and /v5.
+# DEVICE_CONCURRENCY bounds a single request, GLOBAL_DEVICE_CONCURRENCY bounds the whole process.
+DEVICE_CONCURRENCY = int(os.getenv("SWITCH_DEVICE_CONCURRENCY", "8"))
+GLOBAL_DEVICE_CONCURRENCY = int(os.getenv("SWITCH_GLOBAL_DEVICE_CONCURRENCY", "32"))
+
+# How stage 3 assigns IP addresses: "llm" (the stage-3 prompt, as before) or "graph" (local
+# allocator, no stage-3 call). A request can override it with {"config": {"configurable": {"ip_allocation": ...}}}.
+IP_ALLOCATION = os.getenv("SWITCH_IP_ALLOCATION", "llm")
+# Address pool the graph allocator carves subnets from.
+IP_POOL = os.getenv("SWITCH_IP_POOL", "192.168.0.0/16")
+# With "llm", stream the stage-3 answer and start each device's stage-4 call as soon as the
+# addresses it sees are in, instead of after the whole plan (configurable: "stream_ip_plan").
+# Streamed answers are not served from the LLM response cache.
+STREAM_IP_PLAN = os.getenv("SWITCH_STREAM_IP_PLAN", "1") != "0"
+
+# LLM response cache: an in-memory LRU in front of a SQLite file (set the path to "" for memory only).
+LLM_CACHE = os.getenv("SWITCH_LLM_CACHE", "1") != "0"
+LLM_CACHE_SIZE = int(os.getenv("SWITCH_LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_PATH = os.getenv("SWITCH_LLM_CACHE_PATH", "api/db/llm_cache.sqlite")
+LLM_CACHE_TTL = float(os.getenv("SWITCH_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ROWS = int(os.getenv("SWITCH_LLM_CACHE_MAX_ROWS", "100000"))
+
+# Chain versions to mount, and whether to load them in the background right after startup
+# (otherwise each one is loaded by its first request).
+ENABLED_VERSIONS = [version.strip() for version in os.getenv("SWITCH_ENABLED_VERSIONS", "v1,v2,v3,v4,v5").split(",") if version.strip()]
+WARM_UP = os.getenv("SWITCH_WARM_UP", "1") != "0"
+
+# Retrieval resources of the RAG chains ("auto" picks cuda when available, else cpu).
+EMBEDDING_MODEL = os.getenv("SWITCH_EMBEDDING_MODEL", "BAAI/bge-base-en-v1.5")
+EMBEDDING_DEVICE = os.getenv("SWITCH_EMBEDDING_DEVICE", "auto")
+FAISS_PATH = os.getenv("SWITCH_FAISS_PATH", "api/db/faiss")
+# Embedding backend: "torch" (sentence-transformers), "onnx" or "onnx-int8" (ONNX Runtime on CPU,
+# fp32 or int8 weights; see api.app.embeddings), the CPU threads of one encoder call (0: the
+# runtime's default), the padded tokens allowed in one ONNX batch, the model's pooling ("cls" for
+# bge, "mean") and where the ONNX exports are kept.
+EMBEDDING_BACKEND = os.getenv("SWITCH_EMBEDDING_BACKEND", "torch")
+EMBEDDING_THREADS = int(os.getenv("SWITCH_EMBEDDING_THREADS", "0"))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("SWITCH_EMBEDDING_BATCH_TOKENS", "8192"))
+EMBEDDING_POOLING = os.getenv("SWITCH_EMBEDDING_POOLING", "cls")
+EMBEDDING_ONNX_PATH = os.getenv("SWITCH_EMBEDDING_ONNX_PATH", "api/db/onnx")
+
+# Retrieval: top-k, micro-batching of concurrent queries and the query/result cache size.
+RETRIEVAL_K = int(os.getenv("SWITCH_RETRIEVAL_K", "4"))
+RETRIEVAL_BATCH_WINDOW_MS = float(os.getenv("SWITCH_RETRIEVAL_BATCH_WINDOW_MS", "5"))
+RETRIEVAL_MAX_BATCH = int(os.getenv("SWITCH_RETRIEVAL_MAX_BATCH", "32"))
+RETRIEVAL_CACHE_SIZE = int(os.getenv("SWITCH_RETRIEVAL_CACHE_SIZE", "1024"))
+
+# Which guide store the retriever reads: "faiss" (langchain store at FAISS_PATH) or
+# "mmap" (compressed store built by `python -m api.app.ingest`), and its search parameters.
+VECTOR_STORE = os.getenv("SWITCH_VECTOR_STORE", "faiss")
+VECTOR_STORE_PATH = os.getenv("SWITCH_VECTOR_STORE_PATH", "api/db/guides")
+RETRIEVAL_NPROBE = int(os.getenv("SWITCH_RETRIEVAL_NPROBE", "16"))
+RETRIEVAL_EF_SEARCH = int(os.getenv("SWITCH_RETRIEVAL_EF_SEARCH", "64"))
+
+# Number of conversation summaries (one per history prefix) kept for stage 1.
+SUMMARY_CACHE_SIZE = int(os.getenv("SWITCH_SUMMARY_CACHE_SIZE", "4096"))
+
+# Incremental mode: sessions (by "session_id" in the run config) remembered for /v4 and /v5.
+SESSION_CACHE_SIZE = int(os.getenv("SWITCH_SESSION_CACHE_SIZE", "1024"))
+SESSION_TTL = float(os.getenv("SWITCH_SESSION_TTL", str(24 * 3600)))
+
+# Per-device calls in flight for one /v4/batch or /v5/batch request (all of its requests share them).
+BATCH_DEVICE_CONCURRENCY = int(os.getenv("SWITCH_BATCH_DEVICE_CONCURRENCY", str(GLOBAL_DEVICE_CONCURRENCY)))
+
+# OpenAI rate limits of the organisation (requests and tokens per minute), shared by every chain,
+# how often a rate-limited or failed call is retried, and the HTTP connection pool of the shared client.
+LLM_RPM = float(os.getenv("SWITCH_LLM_RPM", "3500"))
+LLM_TPM = float(os.getenv("SWITCH_LLM_TPM", "90000"))
+LLM_MAX_RETRIES = int(os.getenv("SWITCH_LLM_MAX_RETRIES", "6"))
+LLM_BACKOFF_BASE = float(os.getenv("SWITCH_LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("SWITCH_LLM_BACKOFF_MAX", "30"))
+LLM_MAX_CONNECTIONS = int(os.getenv("SWITCH_LLM_MAX_CONNECTIONS", "100"))
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE") or None
+
+# With DEVICE_PRUNING, stage 4 of /v5 only calls the LLM for the devices the question is about (the
+# devices it names, the paths between them and their segments); the others are answered locally.
+# Off by default: every device gets its stage-4 call, as before. See api.app.intent.
+# A request can override it with {"config": {"configurable": {"device_pruning": true | false}}}.
+DEVICE_PRUNING = os.getenv("SWITCH_DEVICE_PRUNING", "0") != "0"
+
+# With CLI_TEMPLATES, stage 4 of /v5 renders the commands of routine designs (addressing, static
+# routes, single-area OSPF on vpcs/dynamips/ethernet_switch) from templates and only calls the LLM
+# for the rest. Off by default: every device's commands come from the LLM, as before.
+# See api.app.cli_templates. A request can override it with {"config": {"configurable": {"cli_templates": true | false}}}.
+CLI_TEMPLATES = os.getenv("SWITCH_CLI_TEMPLATES", "0") != "0"
+
+# With VALIDATION, stage-4 answers of /v4 and /v5 are checked locally (JSON, interface names,
+# addresses against the IP plan, "no shutdown"); a device that fails is asked again alone, up to
+# REPAIR_ATTEMPTS times. Off by default: answers are returned as the LLM gave them, as before.
+# See api.app.validation. A request can override it with {"config": {"configurable": {"validation": true | false}}}.
+VALIDATION = os.getenv("SWITCH_VALIDATION", "0") != "0"
+REPAIR_ATTEMPTS = int(os.getenv("SWITCH_REPAIR_ATTEMPTS", "1"))
+
+# Retrieval sidecar: "unix:/path/to.sock" or "http://127.0.0.1:8765" makes the RAG chains of every
+# worker query one shared process (python -m api.app.sidecar) instead of loading the embedding model
+# and the index themselves. Empty to load them in-process. The sidecar runs THREADS encoder batches
+# at once; each worker keeps up to CONNECTIONS pooled connections to it.
+RETRIEVAL_SIDECAR = os.getenv("SWITCH_RETRIEVAL_SIDECAR", "")
+RETRIEVAL_SIDECAR_THREADS = int(os.getenv("SWITCH_RETRIEVAL_SIDECAR_THREADS", "4"))
+RETRIEVAL_SIDECAR_CONNECTIONS = int(os.getenv("SWITCH_RETRIEVAL_SIDECAR_CONNECTIONS", "16"))
+
+# /v5/apply pushes the generated commands to the lab of a GNS3 server over its telnet consoles and
+# pings between the devices of the question. At most APPLY_SESSIONS consoles are driven at once
+# (idle ones stay open for the next call); a device that takes longer than APPLY_DEVICE_TIMEOUT
+# seconds to configure, or a probe longer than APPLY_PROBE_TIMEOUT, is reported as timed out.
+GNS3_URL = os.getenv("SWITCH_GNS3_URL", "http://127.0.0.1:3080")
+APPLY_SESSIONS = int(os.getenv("SWITCH_APPLY_SESSIONS", "16"))
+APPLY_DEVICE_TIMEOUT = float(os.getenv("SWITCH_APPLY_DEVICE_TIMEOUT", "60"))
+APPLY_PROBE_TIMEOUT = float(os.getenv("SWITCH_APPLY_PROBE_TIMEOUT", "20"))
+
+# Prompt token budgets: every prompt must fit in its model's context window less OUTPUT_TOKENS kept
+# for the answer, unless BUDGETS sets its stage's budget ("design=6000,v1.answer=3000"); longer chat
+# histories, retrieved documents and topologies are trimmed to fit. See api.app.prompts.
+PROMPT_OUTPUT_TOKENS = int(os.getenv("SWITCH_PROMPT_OUTPUT_TOKENS", "1024"))
+PROMPT_BUDGETS = {
+    key.strip(): int(value)
+    for key, value in (item.split("=", 1) for item in os.getenv("SWITCH_PROMPT_BUDGETS", "").split(",") if "=" in item)
+}
+
+# Identical requests, and identical deterministic OpenAI calls, that arrive while one is running
+# join it instead of running again. See api.app.singleflight.
+SINGLE_FLIGHT = os.getenv("SWITCH_SINGLE_FLIGHT", "1") != "0"
+
+# Chain requests (/vN/invoke, /stream, /batch) get a deadline of REQUEST_TIMEOUT seconds (0: none),
+# or what their "X-Request-Timeout" header asks for, up to MAX_REQUEST_TIMEOUT; their remaining work
+# is cancelled when it passes or when the client disconnects (CANCEL_ON_DISCONNECT). While more than
+# MAX_LLM_CALLS OpenAI calls are in flight or queued (0: no limit), new chain requests wait up to
+# ADMISSION_WAIT seconds for room, then get 503 with Retry-After: ADMISSION_RETRY_AFTER. The default
+# is about a second of the LLM_RPM quota: a longer backlog only makes every admitted request late.
+# See api.app.guard.
+REQUEST_TIMEOUT = float(os.getenv("SWITCH_REQUEST_TIMEOUT", "300"))
+MAX_REQUEST_TIMEOUT = float(os.getenv("SWITCH_MAX_REQUEST_TIMEOUT", "900"))
+CANCEL_ON_DISCONNECT = os.getenv("SWITCH_CANCEL_ON_DISCONNECT", "1") != "0"
+MAX_LLM_CALLS = int(os.getenv("SWITCH_MAX_LLM_CALLS", str(max(1, int(LLM_RPM / 60)))))
+ADMISSION_WAIT = float(os.getenv("SWITCH_ADMISSION_WAIT", "2"))
+ADMISSION_RETRY_AFTER = int(os.getenv("SWITCH_ADMISSION_RETRY_AFTER", "5"))
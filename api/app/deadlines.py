@@ -0,0 +1,83 @@
+# Per-request deadlines, carried by a context variable.
+#
+# api.app.guard gives each chain request a deadline (SWITCH_REQUEST_TIMEOUT, or less with an
+# "X-Request-Timeout" header) and cancels the request's tasks when it passes. Tasks started by the
+# request copy its context, so every stage below sees the same deadline: the LLM scheduler does
+# not queue, retry or wait on OpenAI past it (api.app.scheduler) and raises DeadlineExceeded
+# instead, which the server answers with 504.
+#
+# Work shared by single-flight (api.app.singleflight) runs until the latest deadline of the callers
+# it serves, so a caller with little time left does not fail the others.
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before `stage` could finish."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"the request deadline passed during {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """A point in time.monotonic() time, or None for no deadline; single-flight moves it later."""
+
+    def __init__(self, at: Optional[float]):
+        self.at = at
+
+    def remaining(self) -> Optional[float]:
+        return None if self.at is None else self.at - time.monotonic()
+
+    def extend(self, other: Optional["Deadline"]) -> None:
+        """Move this deadline to `other`'s if that one is later (no deadline is the latest)."""
+        if self.at is not None:
+            self.at = None if other is None or other.at is None else max(self.at, other.at)
+
+
+_current: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("deadline", default=None)
+
+
+def current() -> Optional[Deadline]:
+    return _current.get()
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """Code inside the block (and the tasks it starts) has `seconds` left, or less if an outer
+    deadline is sooner. None or 0: no deadline of its own."""
+    at = time.monotonic() + seconds if seconds else None
+    outer = _current.get()
+    if outer is not None and outer.at is not None and (at is None or outer.at < at):
+        at = outer.at
+    token = _current.set(Deadline(at))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def shared(value: Optional[Deadline]):
+    """Code inside the block (and the tasks it starts) follows `value`, as it moves."""
+    token = _current.set(value)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline (negative once passed), or None without one."""
+    value = _current.get()
+    return value.remaining() if value is not None else None
+
+
+def check(stage: str) -> Optional[float]:
+    """Seconds left, or DeadlineExceeded if there are none."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(stage)
+    return left
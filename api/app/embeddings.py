@@ -0,0 +1,148 @@
+# Embedding backends for the retriever (SWITCH_EMBEDDING_BACKEND).
+#
+# The RAG chains embed every query with BAAI/bge-base-en-v1.5. Through sentence-transformers on
+# PyTorch that is an fp32 forward pass, and on API nodes without a GPU it is most of the retrieval
+# latency. OnnxEmbeddings runs the same model with ONNX Runtime on CPU instead:
+#
+#   onnx       the model exported to ONNX, fp32: the same vectors as PyTorch up to rounding;
+#   onnx-int8  that export with its weights quantized to int8 (dynamic quantization, activations
+#              stay fp32): about 4x smaller and faster on CPU, vectors within about 1% in cosine.
+#
+# Both pool and normalize the way the sentence-transformers model does (the CLS token for bge, then
+# L2), so their query vectors search the existing FAISS store. To re-embed a store with a backend
+# instead, run `python -m api.app.ingest --from-faiss api/db/faiss --reembed`. The export (optimum)
+# and the quantization run once; the results are kept under SWITCH_EMBEDDING_ONNX_PATH.
+#
+# Texts are batched by length: they are sorted by token count and cut into batches whose padded
+# size (texts x longest text) stays under SWITCH_EMBEDDING_BATCH_TOKENS. A long guide chunk then
+# does not pad a batch of short queries to its length.
+import os
+from typing import List, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from api.app import config
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+def length_batches(lengths: Sequence[int], max_tokens: int, max_batch: int = 256) -> List[List[int]]:
+    """Indices of `lengths` in batches of similar length, each at most `max_tokens` once padded
+    (a text longer than that on its own gets a batch of its own)."""
+    batches, batch = [], []
+    for index in sorted(range(len(lengths)), key=lambda index: lengths[index]):
+        # In ascending order, this text is the longest of the batch so far.
+        if batch and ((len(batch) + 1) * lengths[index] > max_tokens or len(batch) >= max_batch):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def padded_tokens(lengths: Sequence[int], batches: Sequence[Sequence[int]]) -> int:
+    """Tokens the encoder runs over for `batches`, padding included."""
+    return sum(len(batch) * max(lengths[index] for index in batch) for batch in batches)
+
+
+def export_onnx(model_name: str, path: str, quantize: bool) -> str:
+    """Directory of the ONNX export of `model_name` (with int8 weights if `quantize`), made once under `path`."""
+    fp32 = os.path.join(path, model_name.replace("/", "--"))
+    target = fp32 + "-int8" if quantize else fp32
+    if os.path.exists(os.path.join(target, "model.onnx")):
+        return target
+    from transformers import AutoTokenizer
+
+    if not os.path.exists(os.path.join(fp32, "model.onnx")):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(fp32)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(fp32)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        os.makedirs(target, exist_ok=True)
+        quantize_dynamic(os.path.join(fp32, "model.onnx"), os.path.join(target, "model.onnx"), per_channel=True, weight_type=QuantType.QInt8)
+        AutoTokenizer.from_pretrained(fp32).save_pretrained(target)
+    return target
+
+
+class OnnxEmbeddings(Embeddings):
+    """A sentence-transformers model through ONNX Runtime on CPU (see the module comment)."""
+
+    def __init__(self, model_name: str, quantize: bool = False, threads: int = 0, max_tokens: int = 8192,
+                 pooling: str = "cls", path: str = "api/db/onnx", max_length: int = 512):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        directory = export_onnx(model_name, path, quantize)
+        self.tokenizer = AutoTokenizer.from_pretrained(directory)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(os.path.join(directory, "model.onnx"), options, providers=["CPUExecutionProvider"])
+        self.input_names = { node.name for node in self.session.get_inputs() }
+        self.max_tokens = max_tokens
+        self.pooling = pooling
+        self.max_length = max_length
+
+    def _encode(self, input_ids: List[List[int]]) -> np.ndarray:
+        features = self.tokenizer.pad({ "input_ids": input_ids }, return_tensors="np")
+        feeds = { "input_ids": features["input_ids"].astype(np.int64), "attention_mask": features["attention_mask"].astype(np.int64) }
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(feeds["input_ids"])
+        hidden = self.session.run(None, feeds)[0]  # last_hidden_state: (texts, tokens, dim)
+        if self.pooling == "cls":
+            pooled = hidden[:, 0]
+        else:
+            mask = feeds["attention_mask"][:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        input_ids = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)["input_ids"]
+        lengths = [len(ids) for ids in input_ids]
+        vectors: List[List[float]] = [[] for _ in texts]
+        for batch in length_batches(lengths, self.max_tokens):
+            for index, vector in zip(batch, self._encode([input_ids[index] for index in batch])):
+                vectors[index] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def _device() -> str:
+    if config.EMBEDDING_DEVICE != "auto":
+        return config.EMBEDDING_DEVICE
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def load_embedding(backend: str) -> Embeddings:
+    """The SWITCH_EMBEDDING_MODEL on one of BACKENDS."""
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxEmbeddings(
+            config.EMBEDDING_MODEL,
+            quantize=backend == "onnx-int8",
+            threads=config.EMBEDDING_THREADS,
+            max_tokens=config.EMBEDDING_BATCH_TOKENS,
+            pooling=config.EMBEDDING_POOLING,
+            path=config.EMBEDDING_ONNX_PATH,
+        )
+    if backend != "torch":
+        raise ValueError(f"unknown embedding backend {backend!r}, expected one of {BACKENDS}")
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    if config.EMBEDDING_THREADS:
+        import torch
+        torch.set_num_threads(config.EMBEDDING_THREADS)
+    return HuggingFaceEmbeddings(
+        model_name=config.EMBEDDING_MODEL,
+        model_kwargs={ "device": _device() },
+        encode_kwargs={ "normalize_embeddings": True }, # use cosine similarity
+    )
@@ -0,0 +1,182 @@
+# Concurrency helpers for the chains: bounded fan-out of the per-device calls, and stage scheduling.
+#
+# Stage 4 makes one LLM call per device. `as_completed_bounded`, `gather_bounded` and `TaskPool`
+# run those calls concurrently, at most SWITCH_DEVICE_CONCURRENCY at a time for one request and,
+# through `global_semaphore`, at most SWITCH_GLOBAL_DEVICE_CONCURRENCY at a time for the whole
+# process. An asyncio.Semaphore belongs to one event loop, so the global one is made again when the
+# running loop changes (a test, a bench or a worker that starts its own loop). A failure, or a
+# consumer that stops reading, cancels the calls still running.
+#
+# `StageGraph` starts each stage of a request as soon as the stages it depends on are done, instead
+# of one after the other, and `SharedCalls` runs work shared by the requests of a batch once.
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from api.app import config
+
+_global_semaphore: Optional[asyncio.Semaphore] = None
+_global_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def global_semaphore() -> asyncio.Semaphore:
+    """Process-wide cap on concurrent per-device calls, shared by every request."""
+    global _global_semaphore, _global_loop
+    loop = asyncio.get_running_loop()
+    if _global_semaphore is None or _global_loop is not loop:
+        _global_semaphore = asyncio.Semaphore(config.GLOBAL_DEVICE_CONCURRENCY)
+        _global_loop = loop
+    return _global_semaphore
+
+
+async def as_completed_bounded(
+    factories: Sequence[Callable[[], Awaitable[Any]]],
+    limit: Optional[int] = None,
+) -> AsyncIterator[Tuple[int, Any]]:
+    """Run coroutine factories concurrently and yield (index, result) as each one finishes.
+
+    At most `limit` of them run at once for this call, and never more than the global cap overall.
+    If one of them fails, or the consumer stops iterating, the others are cancelled.
+    """
+    local = asyncio.Semaphore(limit or config.DEVICE_CONCURRENCY)
+    shared = global_semaphore()
+
+    async def run(index, factory):
+        async with local:
+            async with shared:
+                return index, await factory()
+
+    tasks = [asyncio.ensure_future(run(index, factory)) for index, factory in enumerate(factories)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def gather_bounded(
+    factories: Sequence[Callable[[], Awaitable[Any]]],
+    limit: Optional[int] = None,
+) -> List[Any]:
+    """Like `as_completed_bounded`, but wait for all of them and return the results in input order."""
+    results = [None] * len(factories)
+    async for index, result in as_completed_bounded(factories, limit):
+        results[index] = result
+    return results
+
+
+class SharedCalls:
+    """Runs each distinct key once; later callers with the same key await the same task.
+
+    Used by the batch endpoints so that work identical across the requests of a batch
+    (summaries, designs, IP plans, device configurations) is only done once.
+    """
+
+    def __init__(self):
+        self.tasks: Dict[Hashable, asyncio.Future] = {}
+
+    def __call__(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.ensure_future(factory())
+        return task
+
+    def __len__(self) -> int:
+        return len(self.tasks)
+
+
+class StageGraph:
+    """Runs the stages of a pipeline as soon as the stages they depend on are done.
+
+    `add(name, func, *deps)` starts `func(*results of deps)` (a coroutine function) once every
+    dependency has finished; a failed stage fails the stages that depend on it.
+    `await graph[name]` waits for one stage. `cancel()` stops whatever is still running.
+    """
+
+    def __init__(self):
+        self.tasks: Dict[str, asyncio.Future] = {}
+
+    def add(self, name: str, func: Callable[..., Awaitable[Any]], *deps: str) -> asyncio.Future:
+        async def run():
+            results = [await self.tasks[dep] for dep in deps]
+            return await func(*results)
+
+        self.tasks[name] = asyncio.ensure_future(run())
+        return self.tasks[name]
+
+    def __getitem__(self, name: str) -> asyncio.Future:
+        return self.tasks[name]
+
+    def cancel(self) -> None:
+        for task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # a failure nobody awaited is not reported again at exit
+
+
+_CLOSED, _FAILED = object(), object()
+
+
+class TaskPool:
+    """Runs coroutine factories submitted over time, bounded like `as_completed_bounded`.
+
+    `results()` yields (key, result) as each one finishes, and the results given to `put` as they
+    come. It ends once the pool is closed and everything submitted is done, or raises the first
+    error (of a factory, or given to `fail`); the factories still running are then cancelled.
+    """
+
+    def __init__(self, limit: Optional[int] = None):
+        self.local = asyncio.Semaphore(limit or config.DEVICE_CONCURRENCY)
+        self.shared = global_semaphore()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tasks = set()
+        self.closed = False
+
+    def submit(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> None:
+        async def run():
+            try:
+                async with self.local:
+                    async with self.shared:
+                        result = await factory()
+            except Exception as error:
+                self.queue.put_nowait((_FAILED, error))
+            else:
+                self.queue.put_nowait((key, result))
+
+        task = asyncio.ensure_future(run())
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Future) -> None:
+        self.tasks.discard(task)
+        if self.closed and not self.tasks:
+            self.queue.put_nowait((_CLOSED, None))
+
+    def put(self, key: Hashable, result: Any) -> None:
+        self.queue.put_nowait((key, result))
+
+    def fail(self, error: Exception) -> None:
+        self.queue.put_nowait((_FAILED, error))
+
+    def close(self) -> None:
+        """No more submissions: `results()` ends once the running factories are done."""
+        self.closed = True
+        if not self.tasks:
+            self.queue.put_nowait((_CLOSED, None))
+
+    async def results(self) -> AsyncIterator[Tuple[Hashable, Any]]:
+        try:
+            while True:
+                key, value = await self.queue.get()
+                if key is _CLOSED:
+                    return
+                if key is _FAILED:
+                    raise value
+                yield key, value
+        finally:
+            self.cancel()
+
+    def cancel(self) -> None:
+        for task in list(self.tasks):
+            task.cancel()
@@ -0,0 +1,158 @@
+# Deadlines, cancellation and load shedding for the chain requests (/vN/invoke, /stream, /batch).
+#
+# A request used to run to the end whatever happened to its client: a user who closed the GNS3 tab
+# during /v5/invoke still paid for every remaining stage and device call, and nothing bounded how
+# long a request could take. RequestGuard, an ASGI middleware in front of the chain routes, now
+#
+# - gives the request a deadline (SWITCH_REQUEST_TIMEOUT, or "X-Request-Timeout: <seconds>") that
+#   every stage sees (api.app.deadlines);
+# - runs the request as a task and cancels it, with everything it started (stage tasks, device
+#   calls, queued LLM calls and retrieval queries), when the client disconnects or the deadline
+#   passes. A response that has not started yet becomes a 504. A stream gets a moment to send its
+#   own error event (api.app.server), then it is cut;
+# - sheds load: while more OpenAI calls are outstanding than SWITCH_MAX_LLM_CALLS, a new request
+#   waits in line for up to SWITCH_ADMISSION_WAIT seconds, then gets 503 with Retry-After. A request
+#   admitted but not finished counts as at least one call, so a burst of requests that have not
+#   made their first call yet cannot all get in.
+#
+# /v5/apply is not guarded: it drives the lab's consoles and has timeouts of its own.
+import asyncio
+import collections
+import re
+import time
+from typing import Optional
+
+from starlette.responses import JSONResponse
+
+from api.app import config, deadlines, metrics
+
+CHAIN_ROUTE = re.compile(r"^/v\d+/(invoke|stream|batch|stream_log|stream_events)/?$")
+# How long a started response gets after its deadline to end by itself.
+GRACE_SECONDS = 1.0
+POLL_SECONDS = 0.02
+
+_waiting: collections.deque = collections.deque()
+_admitted = 0  # chain requests admitted and not finished yet
+
+
+def _outstanding_llm_calls() -> int:
+    from api.app.scheduler import scheduler
+    return scheduler.outstanding()
+
+
+def _load() -> int:
+    return max(_outstanding_llm_calls(), _admitted)
+
+
+def _enter(result: str) -> bool:
+    global _admitted
+    _admitted += 1
+    metrics.ADMISSION.inc(result=result)
+    return True
+
+
+def leave() -> None:
+    """An admitted request is done."""
+    global _admitted
+    _admitted -= 1
+
+
+async def admit() -> bool:
+    """Whether a new chain request may start: at once below the limit, else first in line within ADMISSION_WAIT.
+    An admitted request must `leave()` when it is done."""
+    if not config.MAX_LLM_CALLS or (not _waiting and _load() < config.MAX_LLM_CALLS):
+        return _enter("admitted")
+    ticket = object()
+    _waiting.append(ticket)
+    try:
+        until = time.monotonic() + config.ADMISSION_WAIT
+        while time.monotonic() < until:
+            await asyncio.sleep(POLL_SECONDS)
+            if _waiting[0] is ticket and _load() < config.MAX_LLM_CALLS:
+                return _enter("queued")
+        metrics.ADMISSION.inc(result="rejected")
+        return False
+    finally:
+        _waiting.remove(ticket)
+
+
+def request_timeout(scope: dict) -> Optional[float]:
+    """The deadline of a request in seconds from now (None: no deadline)."""
+    seconds = config.REQUEST_TIMEOUT
+    for name, value in scope.get("headers", []):
+        if name == b"x-request-timeout":
+            try:
+                seconds = min(float(value), config.MAX_REQUEST_TIMEOUT)
+            except ValueError:
+                pass
+    return seconds if seconds and seconds > 0 else None
+
+
+class RequestGuard:
+    """See the module comment."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not CHAIN_ROUTE.match(scope["path"]):
+            return await self.app(scope, receive, send)
+        # The deadline counts from the request's arrival, time in line included.
+        seconds, arrived = request_timeout(scope), time.monotonic()
+        if not await admit():
+            response = JSONResponse({ "detail": "The server is overloaded, retry later." }, status_code=503,
+                                    headers={ "Retry-After": str(config.ADMISSION_RETRY_AFTER) })
+            return await response(scope, receive, send)
+        if seconds is not None:
+            seconds = max(seconds - (time.monotonic() - arrived), 1e-3)
+        state = { "started": False, "finished": False }
+
+        async def tracked_send(message):
+            if message["type"] == "http.response.start":
+                state["started"] = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                state["finished"] = True
+            await send(message)
+
+        # The client's messages go through a queue, so a disconnect is seen while the app is busy.
+        messages: asyncio.Queue = asyncio.Queue()
+
+        async def read():
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    return
+
+        with deadlines.deadline(seconds):
+            app = asyncio.ensure_future(self.app(scope, messages.get, tracked_send))
+        reader = asyncio.ensure_future(read())
+        try:
+            watched = { app, reader } if config.CANCEL_ON_DISCONNECT else { app }
+            done, _ = await asyncio.wait(watched, timeout=seconds, return_when=asyncio.FIRST_COMPLETED)
+            if app in done or (reader in done and state["finished"]):
+                # Done, or the server noticed its own response end before the app returned.
+                return await app
+            if reader in done:
+                reason = "disconnect"
+            else:
+                reason = "deadline"
+                if state["started"]:
+                    done, _ = await asyncio.wait({ app }, timeout=GRACE_SECONDS)
+                    if app in done:
+                        return await app
+            metrics.REQUESTS_CANCELLED.inc(reason=reason)
+            app.cancel()
+            await asyncio.gather(app, return_exceptions=True)
+            # The middlewares around this one expect a complete response, even for a client that left
+            # (499, "client closed request", only shows in the metrics).
+            if not state["started"]:
+                status, detail = (504, "The request did not finish before its deadline.") if reason == "deadline" else (499, "The client closed the request.")
+                await JSONResponse({ "detail": detail }, status_code=status)(scope, receive, send)
+            elif not state["finished"]:
+                await send({ "type": "http.response.body", "body": b"", "more_body": False })
+        finally:
+            reader.cancel()
+            if not app.done():
+                app.cancel()
+            leave()
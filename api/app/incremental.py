@@ -0,0 +1,132 @@
+# Incremental reconfiguration for /v4 and /v5.
+#
+# In the GNS3 UI a user typically changes one link or adds one PC and asks again. When a request
+# carries {"configurable": {"session_id": ...}}, the chains remember the last topology, IP plan,
+# design and per-device answers of that session. The next request diffs its topology against the
+# remembered one, keeps the IP plan sticky, and sends only the devices whose view of the lab
+# (ports, neighbours, addresses, subnets) or design changed back to the LLM; the other devices
+# get their previous answer again.
+#
+# The design is only reused for the same question about the same lab and conversation; after an
+# edit it is made again, and the per-device fingerprints tell which answers still hold. The IP
+# plan stays sticky in both allocation modes: the graph allocator keeps the previous subnets, and
+# with the LLM (`updated_plan`) the ports whose link did not change keep their addresses and only
+# the others are asked for, so an edit does not renumber, and re-send, the whole lab.
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from api.app import config
+from api.app.cache import LRUCache
+from api.app.topology import L2_NODE_TYPES, Topology, load_topology
+
+
+def diff_topologies(old: Union[str, dict, Topology], new: Union[str, dict, Topology]) -> dict:
+    """Nodes (by node_id) and links (by link_id and their node_id/port_number ends) that changed."""
+    old, new = load_topology(old), load_topology(new)
+    old_nodes, new_nodes = old.by_id, new.by_id
+
+    def ends(link):
+        return sorted((end["node_id"], end.get("adapter_number", 0), end.get("port_number")) for end in link.data["nodes"])
+
+    old_links = {link.link_id: ends(link) for link in old.links}
+    new_links = {link.link_id: ends(link) for link in new.links}
+    return {
+        "nodes_added": [new_nodes[key].name for key in new_nodes.keys() - old_nodes.keys()],
+        "nodes_removed": [old_nodes[key].name for key in old_nodes.keys() - new_nodes.keys()],
+        "nodes_changed": [new_nodes[key].name for key in new_nodes.keys() & old_nodes.keys() if new_nodes[key].data != old_nodes[key].data],
+        "links_added": sorted(new_links.keys() - old_links.keys()),
+        "links_removed": sorted(old_links.keys() - new_links.keys()),
+        "links_changed": sorted(key for key in new_links.keys() & old_links.keys() if new_links[key] != old_links[key]),
+    }
+
+
+def is_empty(diff: dict) -> bool:
+    return not any(diff.values())
+
+
+def sticky_plan(old: Union[str, dict, Topology], new: Union[str, dict, Topology], previous: dict) -> Tuple[dict, List[Tuple[str, str]]]:
+    """(the entries of `previous` whose port is still linked to the same peer port, the connected
+    L3 ports of `new` left without an address) as (device, port) pairs."""
+    old, new = load_topology(old), load_topology(new)
+
+    def peer(topology: Topology, device: str, port: str) -> Optional[tuple]:
+        found = topology.port(device, port)
+        other = topology.peer(found) if found is not None else None
+        return (other.node.name, other.name) if other is not None else None
+
+    kept, addressed = [], set()
+    for entry in previous.get("port_info", []):
+        device, port = entry.get("device"), entry.get("port")
+        now = peer(new, device, port)
+        if now is not None and now == peer(old, device, port) and (device, port) not in addressed:
+            kept.append(entry)
+            addressed.add((device, port))
+    missing = [
+        (node.name, port.name)
+        for node in new.nodes if node.node_type not in L2_NODE_TYPES
+        for port in node.ports if new.peer(port) is not None and (node.name, port.name) not in addressed
+    ]
+    return { "port_info": kept }, missing
+
+
+async def updated_plan(
+    old: Union[str, dict, Topology],
+    new: Union[str, dict, Topology],
+    previous: dict,
+    ask: Callable[[dict, List[dict]], Awaitable[dict]],
+) -> dict:
+    """The IP plan of an edited lab: the kept entries of `previous` (see `sticky_plan`) and, for the
+    ports left without an address, what `ask(kept plan, [{"device", "port"}, ...])` assigns them.
+    Nothing is asked when no port needs an address."""
+    kept, missing = sticky_plan(old, new, previous)
+    if not missing:
+        return kept
+    answer = await ask(kept, [{ "device": device, "port": port } for device, port in missing])
+    wanted = set(missing)
+    added = [entry for entry in (answer or {}).get("port_info", []) if (entry.get("device"), entry.get("port")) in wanted]
+    return { "port_info": kept["port_info"] + added }
+
+
+def fingerprint(*parts: Any) -> str:
+    """Everything a stage-4 answer depends on, hashed."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class Session:
+    """What the last request of one session produced."""
+
+    def __init__(self):
+        self.topology: Optional[Topology] = None
+        self.question: Optional[str] = None
+        self.design: Optional[str] = None
+        self.summary: Optional[str] = None  # of the conversation, as given to the design
+        self.history: Optional[str] = None  # fingerprint of the chat history
+        self.port_identification: Optional[dict] = None
+        # device name -> (fingerprint of its inputs, ChatResponse)
+        self.devices: Dict[str, tuple] = {}
+
+    def response(self, device: str, key: str):
+        """The previous answer for `device`, if its inputs are still the same."""
+        entry = self.devices.get(device)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        return None
+
+
+class SessionStore:
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.sessions = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, version: str, session_id: Optional[str]) -> Optional[Session]:
+        """The remembered session (a new one on first use), or None when the request has no session_id."""
+        if not session_id:
+            return None
+        session = self.sessions.get((version, session_id))
+        return session if session is not None else Session()
+
+    def save(self, version: str, session_id: str, session: Session) -> None:
+        self.sessions.set((version, session_id), session)
+
+
+sessions = SessionStore(config.SESSION_CACHE_SIZE, config.SESSION_TTL)
@@ -0,0 +1,80 @@
+# Build the guide store used by the RAG chains.
+#
+#   # from the Cisco/Juniper guides (.txt, .md, .pdf), embedded with the configured model
+#   python -m api.app.ingest guides/ --out api/db/guides --index ivfsq8
+#   # or convert the existing langchain FAISS store without re-embedding
+#   python -m api.app.ingest --from-faiss api/db/faiss --out api/db/guides
+#   # or re-embed its chunks with the configured backend (SWITCH_EMBEDDING_BACKEND, see api.app.embeddings)
+#   python -m api.app.ingest --from-faiss api/db/faiss --reembed --out api/db/guides
+#
+# Then start the server with SWITCH_VECTOR_STORE=mmap (and SWITCH_VECTOR_STORE_PATH=api/db/guides).
+import argparse
+import os
+from typing import List
+
+import numpy as np
+from langchain_core.documents import Document
+
+from api.app import config
+from api.app.vectorstore import INDEX_KINDS, build_store
+
+
+def load_documents(sources: List[str], chunk_size: int, chunk_overlap: int) -> List[Document]:
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    documents = []
+    for source in sources:
+        paths = [source] if os.path.isfile(source) else sorted(
+            os.path.join(root, name) for root, _, names in os.walk(source) for name in names
+        )
+        for path in paths:
+            extension = os.path.splitext(path)[1].lower()
+            if extension == ".pdf":
+                from langchain_community.document_loaders import PyPDFLoader
+                documents.extend(PyPDFLoader(path).load())
+            elif extension in (".txt", ".md"):
+                with open(path, encoding="utf-8") as f:
+                    documents.append(Document(page_content=f.read(), metadata={ "source": path }))
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return splitter.split_documents(documents)
+
+
+def from_faiss(path: str):
+    """Documents and vectors of a store written by langchain's FAISS.save_local."""
+    from api.app.retrieval import get_embedding
+    from langchain.vectorstores.faiss import FAISS
+
+    docsearch = FAISS.load_local(path, embeddings=get_embedding())
+    ids = [docsearch.index_to_docstore_id[i] for i in range(docsearch.index.ntotal)]
+    vectors = docsearch.index.reconstruct_n(0, docsearch.index.ntotal)
+    return [docsearch.docstore.search(id) for id in ids], vectors
+
+
+def main(args):
+    if args.from_faiss:
+        documents, vectors = from_faiss(args.from_faiss)
+        if args.reembed:
+            from api.app.retrieval import get_embedding
+            vectors = np.array(get_embedding().embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+    else:
+        from api.app.retrieval import get_embedding
+        documents = load_documents(args.sources, args.chunk_size, args.chunk_overlap)
+        vectors = np.array(get_embedding().embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    build_store(args.out, documents, vectors, kind=args.index, embedding_model=config.EMBEDDING_MODEL, embedding_backend=config.EMBEDDING_BACKEND)
+    print(f"wrote {len(documents)} chunks to {args.out} ({args.index})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the compressed guide store for the RAG chains.")
+    parser.add_argument("sources", nargs="*", help="guide files or directories (.txt, .md, .pdf)")
+    parser.add_argument("--from-faiss", help="convert an existing langchain FAISS store instead")
+    parser.add_argument("--reembed", action="store_true", help="with --from-faiss, embed its chunks again with the configured backend")
+    parser.add_argument("--out", default=config.VECTOR_STORE_PATH)
+    parser.add_argument("--index", choices=INDEX_KINDS, default="ivfsq8")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    args = parser.parse_args()
+    if not args.sources and not args.from_faiss:
+        parser.error("give guide sources or --from-faiss")
+    main(args)
@@ -0,0 +1,126 @@
+# Which devices a /v5 request actually has to touch.
+#
+# "connect PC1 to PC2" on a ten-node lab used to cost ten stage-4 calls, seven of which came back
+# with "No command is required.". Before the fan-out, the devices named in the question are taken
+# as endpoints and the relevant part of the lab is computed from the links: every node on a
+# shortest path between two endpoints, plus what sits on each endpoint's own segment (the L2
+# switches and the gateway routers behind them). Devices outside it are answered locally.
+#
+# Nothing is pruned when the question names no device, or when the question or the design asks
+# for something network-wide (a routing protocol, "every router", VLANs, ...). A request can also
+# switch pruning on or off with {"configurable": {"device_pruning": true | false}}.
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Dict, List, Optional, Set
+
+from api.app.allocator import GATEWAY_NODE_TYPES
+from api.app.topology import L2_NODE_TYPES, Node, Topology
+
+# In the question or in the design: changes that concern every device.
+NETWORK_WIDE = re.compile(
+    r"\b(ospf|eigrp|rip|ripv2|bgp|is-?is|routing protocols?|dynamic routing|redistribut\w*|"
+    r"vlans?|trunk\w*|spanning[- ]tree|stp|hsrp|vrrp|ntp|snmp|syslog)\b",
+    re.IGNORECASE,
+)
+# In the question only (a design often says "all devices" about the devices it just named).
+EVERY_DEVICE = re.compile(r"\b(every|all|each|whole|entire|network[- ]wide|everywhere)\b", re.IGNORECASE)
+
+SKIPPED_COMMENT = "No command is required."
+
+
+@lru_cache(maxsize=64)
+def _name_pattern(topology: Topology) -> Optional["re.Pattern"]:
+    # Longest names first, so "PC10" is not read as "PC1".
+    names = sorted((node.name for node in topology.nodes if node.name), key=len, reverse=True)
+    if not names:
+        return None
+    return re.compile(r"(?<![\w-])(" + "|".join(map(re.escape, names)) + r")(?![\w-])", re.IGNORECASE)
+
+
+def mentioned_devices(topology: Topology, text: str) -> List[Node]:
+    """Devices named in `text`, in order of first mention (names match case-insensitively)."""
+    pattern = _name_pattern(topology)
+    if pattern is None:
+        return []
+    by_name = {node.name.lower(): node for node in topology.nodes if node.name}
+    found: Dict[str, Node] = {}
+    for match in pattern.finditer(text):
+        node = by_name[match.group(1).lower()]
+        found.setdefault(node.node_id, node)
+    return list(found.values())
+
+
+def _neighbours(topology: Topology) -> Dict[str, Set[str]]:
+    adjacency: Dict[str, Set[str]] = {node.node_id: set() for node in topology.nodes}
+    for port, peer in topology.peers.items():
+        adjacency[port.node.node_id].add(peer.node.node_id)
+    return adjacency
+
+
+def _distances(adjacency: Dict[str, Set[str]], start: str) -> Dict[str, int]:
+    distances = {start: 0}
+    queue = deque([start])
+    while queue:
+        current = queue.popleft()
+        for neighbour in adjacency[current]:
+            if neighbour not in distances:
+                distances[neighbour] = distances[current] + 1
+                queue.append(neighbour)
+    return distances
+
+
+def relevant_devices(topology: Topology, endpoints: List[Node]) -> Set[str]:
+    """node_ids of the endpoints, every node on a shortest path between two of them, and the
+    L2 nodes of each endpoint's segments (with the gateways there when the endpoint is a host)."""
+    adjacency = _neighbours(topology)
+    relevant = {node.node_id for node in endpoints}
+    distances = {node.node_id: _distances(adjacency, node.node_id) for node in endpoints}
+    ids = list(distances)
+    for i, a in enumerate(ids):
+        for b in ids[i + 1:]:
+            length = distances[a].get(b)
+            if length is None:  # not connected: nothing in between
+                continue
+            relevant.update(
+                node for node, distance in distances[a].items()
+                if distance + distances[b].get(node, length + 1) == length
+            )
+
+    # Each endpoint's segments: through L2 nodes only, keeping the switches and, for hosts, their gateways.
+    for node in endpoints:
+        host = node.node_type not in GATEWAY_NODE_TYPES
+        seen, queue = {node.node_id}, deque([node.node_id])
+        while queue:
+            current = queue.popleft()
+            for neighbour in adjacency[current]:
+                if neighbour in seen:
+                    continue
+                seen.add(neighbour)
+                node_type = topology.by_id[neighbour].node_type
+                if node_type in L2_NODE_TYPES:
+                    relevant.add(neighbour)
+                    queue.append(neighbour)
+                elif host and node_type in GATEWAY_NODE_TYPES:
+                    relevant.add(neighbour)
+    return relevant
+
+
+def device_scope(topology: Topology, question: str, design: str = "", pruning: Optional[bool] = None) -> dict:
+    """{"devices": names to send to stage 4 (None for all), "endpoints": names, "network_wide": bool}.
+
+    `pruning` forces pruning on (as long as the question names a device) or off.
+    """
+    endpoints = mentioned_devices(topology, question)
+    network_wide = bool(EVERY_DEVICE.search(question) or NETWORK_WIDE.search(question) or NETWORK_WIDE.search(design or ""))
+    scope = { "devices": None, "endpoints": [node.name for node in endpoints], "network_wide": network_wide }
+    if pruning is False or not endpoints or (network_wide and pruning is not True):
+        return scope
+    relevant = relevant_devices(topology, endpoints)
+    scope["devices"] = [node.name for node in topology.nodes if node.node_id in relevant]
+    return scope
+
+
+def skipped_response(device: str) -> dict:
+    """The answer of a device outside the scope, in the stage-4 output format."""
+    return { "device": device, "command": "", "comment": SKIPPED_COMMENT }
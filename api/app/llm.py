@@ -0,0 +1,78 @@
+# Every chain builds its OpenAI models through these helpers, so process-wide concerns
+# (the response cache, the rate-limit scheduler and the HTTP connection pool) are configured in one place.
+import threading
+
+from langchain.globals import set_llm_cache
+from langchain_community.chat_models import ChatOpenAI
+from langchain_community.llms import OpenAI
+
+from api.app import config, metrics
+from api.app.cache import TieredLLMCache
+from api.app.scheduler import ScheduledResource, scheduler
+
+llm_cache = None
+if config.LLM_CACHE:
+    llm_cache = TieredLLMCache(
+        maxsize=config.LLM_CACHE_SIZE,
+        path=config.LLM_CACHE_PATH or None,
+        ttl=config.LLM_CACHE_TTL,
+        max_rows=config.LLM_CACHE_MAX_ROWS,
+    )
+    set_llm_cache(llm_cache)
+
+
+@metrics.collector
+def _llm_cache_metrics():
+    if llm_cache is None:
+        return
+    stats = llm_cache.stats()
+    help = "LLM response cache lookups by result."
+    for tier, hits in stats["hits"].items():
+        yield "switch_llm_cache_total", "counter", help, {"result": f"{tier}_hit"}, hits
+    yield "switch_llm_cache_total", "counter", help, {"result": "miss"}, stats["misses"]
+    yield "switch_llm_cache_total", "counter", help, {"result": "bypassed"}, stats["bypassed"]
+    yield "switch_llm_cache_entries", "gauge", "Entries in the in-memory LLM response cache.", {}, stats["memory_entries"]
+
+
+_clients = None
+_clients_lock = threading.Lock()
+
+
+def openai_clients():
+    """One pooled sync and one async OpenAI client for the whole process.
+
+    Their own retries are off: rate limits and retries are handled by the scheduler.
+    """
+    global _clients
+    with _clients_lock:
+        if _clients is None:
+            import httpx
+            import openai
+            limits = httpx.Limits(max_connections=config.LLM_MAX_CONNECTIONS, max_keepalive_connections=config.LLM_MAX_CONNECTIONS)
+            _clients = (
+                openai.OpenAI(base_url=config.OPENAI_API_BASE, max_retries=0, http_client=httpx.Client(limits=limits)),
+                openai.AsyncOpenAI(base_url=config.OPENAI_API_BASE, max_retries=0, http_client=httpx.AsyncClient(limits=limits)),
+            )
+        return _clients
+
+
+def chat_model(model: str = "gpt-3.5-turbo", temperature: float = 0, json_mode: bool = False) -> ChatOpenAI:
+    """With `json_mode`, the model is constrained to answer a JSON object (OpenAI's response_format)."""
+    client, async_client = openai_clients()
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        model_kwargs={"response_format": {"type": "json_object"}} if json_mode else {},
+        client=ScheduledResource(client.chat.completions, scheduler, is_async=False),
+        async_client=ScheduledResource(async_client.chat.completions, scheduler, is_async=True),
+    )
+
+
+def completion_model(model: str = "gpt-3.5-turbo-instruct", temperature: float = 0) -> OpenAI:
+    client, async_client = openai_clients()
+    return OpenAI(
+        model=model,
+        temperature=temperature,
+        client=ScheduledResource(client.completions, scheduler, is_async=False),
+        async_client=ScheduledResource(async_client.completions, scheduler, is_async=True),
+    )
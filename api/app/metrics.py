@@ -0,0 +1,201 @@
+# Process metrics in the Prometheus text format, served by GET /metrics.
+#
+# A few counters, gauges and histograms kept in plain dicts under one lock: recording a value is
+# a dict lookup and an addition, so instrumentation can stay on under load. Values owned by
+# other components (LLM cache, scheduler, retrieval) are read by collectors at scrape time.
+#
+# `timed(version, stage)` records the wall time of a chain stage; inside a request it is also
+# added to that request's timing breakdown, which the server returns as a Server-Timing header.
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+_lock = threading.Lock()
+_metrics: Dict[str, "Metric"] = {}
+_collectors: List[Callable[[], Iterable[Tuple[str, str, str, dict, float]]]] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: Dict[tuple, object] = {}
+        with _lock:
+            _metrics[name] = self
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, dict, float]]:
+        for key, value in list(self.values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self) -> Iterable[Tuple[str, dict, float]]:
+        for key, (counts, total) in list(self.values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": repr(float(bound))}, cumulative
+            cumulative += counts[-1]
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+def collector(collect: Callable[[], Iterable[Tuple[str, str, str, dict, float]]]):
+    """Register a function yielding (name, type, help, labels, value) samples at scrape time."""
+    _collectors.append(collect)
+    return collect
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    with _lock:
+        metrics = list(_metrics.values())
+        snapshot = [(metric, list(metric.samples())) for metric in metrics]
+    for metric, samples in snapshot:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(f"{name}{_labels(labels)} {value}" for name, labels, value in samples)
+    seen = set()
+    for collect in _collectors:
+        try:
+            samples = list(collect())
+        except Exception:  # a failing collector must not break the scrape
+            continue
+        for name, type, help, labels, value in samples:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type}")
+            lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# What the server and the chains record.
+
+HTTP_REQUESTS = Counter("switch_http_requests_total", "HTTP requests by route and status.", ("route", "method", "status"))
+HTTP_SECONDS = Histogram("switch_http_request_seconds", "HTTP request latency (until the response starts).", ("route",))
+HTTP_IN_FLIGHT = Gauge("switch_http_requests_in_flight", "HTTP requests being handled.")
+STAGE_SECONDS = Histogram("switch_stage_seconds", "Wall time of each chain stage (device: one stage-4 call).", ("version", "stage"))
+LLM_SECONDS = Histogram("switch_llm_call_seconds", "Latency of each OpenAI call attempt (queueing excluded).", ("model",))
+LLM_QUEUE_SECONDS = Histogram("switch_llm_queue_seconds", "Time an OpenAI call waited for the rate-limit scheduler.", ("priority",))
+LLM_TOKENS = Counter("switch_llm_tokens_total", "Tokens reported by OpenAI.", ("model", "kind"))
+LLM_PROMPT_TOKENS = Histogram("switch_llm_prompt_tokens", "Prompt tokens per OpenAI call.", ("model",), buckets=TOKEN_BUCKETS)
+DEVICE_ANSWERS = Counter("switch_device_answers_total", "Stage-4 device answers by source (llm, template, skipped, reused).", ("version", "source"))
+DEVICE_CHECKS = Counter("switch_device_checks_total", "Validated stage-4 answers by result (valid, repaired, invalid).", ("version", "result"))
+DEVICE_PROBLEMS = Counter("switch_device_problems_total", "Problems found in stage-4 answers by kind (json, schema, interface, address, gateway, shutdown).", ("version", "kind"))
+REPAIR_CALLS = Counter("switch_repair_calls_total", "Stage-4 calls made to repair one device's answer.", ("version",))
+REPAIR_CALLS_SAVED = Counter("switch_repair_calls_saved_total", "Stage-4 calls a retry of the whole request would have made on top of the repairs.", ("version",))
+PARSER_FAILURES = Counter("switch_parser_failures_total", "LLM outputs the JSON output parsers could not parse.", ("parser",))
+PROMPT_TOKENS = Histogram("switch_prompt_tokens", "Prompt tokens per call, counted locally after budgeting.", ("version", "stage"), buckets=TOKEN_BUCKETS)
+PROMPT_TRIMS = Counter("switch_prompt_trims_total", "Prompt fields shrunk to fit a stage's token budget.", ("version", "stage", "field"))
+PROMPT_REJECTED = Counter("switch_prompt_rejected_total", "Prompts still over their token budget after trimming (not sent).", ("version", "stage"))
+SINGLE_FLIGHT = Counter("switch_single_flight_total", "Requests, streams and LLM calls by single-flight result (started, coalesced, cancelled).", ("scope", "result"))
+ADMISSION = Counter("switch_admission_total", "Chain requests by admission result (admitted, queued, rejected).", ("result",))
+REQUESTS_CANCELLED = Counter("switch_requests_cancelled_total", "Chain requests stopped before they finished, by reason (disconnect, deadline).", ("reason",))
+APPLY_DEVICES = Counter("switch_apply_devices_total", "Devices /v5/apply configured, by status (applied, skipped, error, timeout, failed, ...).", ("status",))
+APPLY_PROBES = Counter("switch_apply_probes_total", "Verification probes run by /v5/apply, by kind (ping, route) and result.", ("kind", "result"))
+CONSOLE_SESSIONS = Counter("switch_console_sessions_total", "Node console sessions /v5/apply opened or reused from its pool.", ("result",))
+
+
+_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def request_timings():
+    """Collect the stage times of the current request (and of the tasks it starts) into a dict."""
+    timings: Dict[str, float] = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def record_stage(version: str, stage: str, seconds: float, per_request: bool = True) -> None:
+    """Observe a stage time; with `per_request` it also goes into the current request's breakdown."""
+    STAGE_SECONDS.observe(seconds, version=version, stage=stage)
+    timings = _timings.get()
+    if per_request and timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(version: str, stage: str, per_request: bool = True):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(version, stage, time.perf_counter() - started, per_request)
+
+
+async def timed_call(version: str, stage: str, awaitable, per_request: bool = True):
+    """Await `awaitable`, recording its wall time as `stage`."""
+    with timed(version, stage, per_request):
+        return await awaitable
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """A Server-Timing header value (durations in milliseconds)."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
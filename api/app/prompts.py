@@ -0,0 +1,242 @@
+# Token budgets for every prompt, and the order of its parts.
+#
+# Prompts used to be filled with whatever the request carried: the whole chat history, every
+# retrieved document, the topology as exported. A long chat or a big lab went past the context
+# window and the request failed at OpenAI, after the earlier stages had already spent seconds on
+# it. `budgeted(...)` now sits in front of each prompt template: it counts the tokens of the static
+# part of the template once and of each filled-in field locally (api.app.tokens), and when the sum
+# goes over the stage's budget it shrinks the fields in a fixed order:
+#
+#   1. history: the oldest turns are dropped (a note says how many); if even the last one is too long, it is cut;
+#   2. documents: the lowest-ranked retrieved documents are dropped (the retriever returns the best first);
+#   3. topology: the JSON is compacted (GNS3 export fields the chains do not read are dropped),
+#      then written as node names, node types and port-to-port links only.
+#
+# If the prompt still does not fit, PromptTooLarge is raised before any call is made. Each call's
+# token count, budget and the steps taken are counted in the metrics and logged.
+#
+# The budget of a stage is the model's context window less SWITCH_PROMPT_OUTPUT_TOKENS kept for
+# the answer, unless SWITCH_PROMPT_BUDGETS sets it ("design=6000,v1.answer=3000").
+#
+# Templates put their static part first (instructions, format instructions, examples) and the
+# request's data after it, most stable first, so the beginning of every prompt of a stage is
+# byte-identical across calls and the provider's prompt prefix cache can serve it.
+import json
+import logging
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.runnables import RunnableLambda
+
+from api.app import config, metrics
+from api.app.tokens import count_tokens
+from api.app.topology import Topology, load_topology
+
+logger = logging.getLogger(__name__)
+
+# Context windows (prompt + answer) of the models the chains use.
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-3.5-turbo-instruct": 4096,
+    "gpt-4": 8192,
+    "gpt-4-1106-preview": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Field kinds, in the order they are shrunk. Other fields ("text") are never changed.
+HISTORY, DOCUMENTS, TOPOLOGY, TEXT = "history", "documents", "topology", "text"
+SHRINK_ORDER = (HISTORY, DOCUMENTS, TOPOLOGY)
+
+HUMAN = "\nHuman: "
+
+
+class PromptTooLarge(ValueError):
+    """A prompt is over its stage's token budget even after trimming its fields."""
+
+    def __init__(self, stage: str, tokens: int, budget: int):
+        super().__init__(f"the {stage} prompt needs {tokens} tokens, over its budget of {budget}")
+        self.stage = stage
+        self.tokens = tokens
+        self.budget = budget
+
+
+def stage_budget(version: str, stage: str, model: str) -> int:
+    """Prompt tokens allowed for `stage` of `version` on `model`."""
+    for key in (f"{version}.{stage}", stage):
+        if key in config.PROMPT_BUDGETS:
+            return config.PROMPT_BUDGETS[key]
+    return CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW) - config.PROMPT_OUTPUT_TOKENS
+
+
+@lru_cache(maxsize=4096)
+def _tokens(text: str, model: str) -> int:
+    # Topologies, designs and histories come back in every stage of a request: count them once.
+    return count_tokens(text, model)
+
+
+def static_part(prompt: BasePromptTemplate) -> str:
+    """The prompt with every field empty: what all its calls share."""
+    return prompt.format(**{ name: "" for name in prompt.input_variables })
+
+
+def static_prefix(prompt: BasePromptTemplate) -> str:
+    """The text before the first field: byte-identical in every call of the prompt."""
+    marker = "\x00field\x00"
+    return prompt.format(**{ name: marker for name in prompt.input_variables }).split(marker, 1)[0]
+
+
+def join_documents(documents: Sequence) -> str:
+    return "\n\n".join(document.page_content if isinstance(document, Document) else str(document) for document in documents)
+
+
+def split_history(history: str) -> List[str]:
+    """The turns of a format_chat_history string ("\\nHuman: ...\\nAssistant: ..." per turn)."""
+    if not history.startswith(HUMAN):
+        return [history] if history else []
+    return [HUMAN + turn for turn in history[len(HUMAN):].split(HUMAN)]
+
+
+def compact_topology(topology: Topology, level: int) -> str:
+    """The topology JSON with less detail: level 1 keeps what the chains read, level 2 only names and links."""
+    if level == 1:
+        return json.dumps({
+            "node_info": [{
+                "node_id": node.node_id,
+                "name": node.name,
+                "node_type": node.node_type,
+                "ports": [{ key: port.data[key] for key in ("name", "port_number", "adapter_number") if key in port.data } for port in node.ports],
+            } for node in topology.nodes],
+            "link_info": [{
+                "nodes": [{ key: end[key] for key in ("node_id", "port_number", "adapter_number") if key in end } for end in link.data.get("nodes", [])],
+            } for link in topology.links],
+        }, separators=(",", ":"))
+    return json.dumps({
+        "nodes": [[node.name, node.node_type] for node in topology.nodes],
+        "links": [[f"{a.node.name} {a.name}", f"{b.node.name} {b.name}"] for a, b in (link.ends for link in topology.links if len(link.ends) == 2)],
+    }, separators=(",", ":"))
+
+
+class PromptBudget:
+    """Fits the fields of one prompt template into its stage's budget (see the module comment)."""
+
+    def __init__(self, version: str, stage: str, prompt: BasePromptTemplate, model: str, fields: Dict[str, str], budget: Optional[int] = None):
+        self.version = version
+        self.stage = stage
+        self.prompt = prompt
+        self.model = model
+        self.fields = fields
+        self.budget = budget
+        self._static_tokens: Optional[int] = None
+
+    @property
+    def static_tokens(self) -> int:
+        if self._static_tokens is None:
+            self._static_tokens = _tokens(static_part(self.prompt), self.model)
+        return self._static_tokens
+
+    def _render(self, name: str, value) -> str:
+        if self.fields.get(name) == DOCUMENTS and not isinstance(value, str):
+            return join_documents(value)
+        if self.fields.get(name) == TOPOLOGY and not isinstance(value, str):
+            return load_topology(value).json
+        return value if isinstance(value, str) else str(value)
+
+    def fit(self, values: dict) -> Tuple[dict, dict]:
+        """(the values to format the prompt with, the report of this call)."""
+        budget = self.budget if self.budget is not None else stage_budget(self.version, self.stage, self.model)
+        rendered = { name: self._render(name, values[name]) for name in self.prompt.input_variables if name in values }
+        counts = { name: _tokens(text, self.model) for name, text in rendered.items() }
+        total = self.static_tokens + sum(counts.values())
+        actions = []
+        for kind in SHRINK_ORDER:
+            for name in (name for name, field_kind in self.fields.items() if field_kind == kind and name in rendered):
+                if total <= budget:
+                    break
+                allowed = max(0, budget - (total - counts[name]))
+                before = counts[name]
+                shrunk, action = getattr(self, f"_shrink_{kind}")(values[name], rendered[name], allowed)
+                if action is None:
+                    continue
+                rendered[name] = shrunk
+                counts[name] = _tokens(shrunk, self.model)
+                total += counts[name] - before
+                actions.append({ "field": name, "action": action, "tokens_before": before, "tokens_after": counts[name] })
+        report = { "version": self.version, "stage": self.stage, "model": self.model, "tokens": total, "budget": budget, "static_tokens": self.static_tokens, "actions": actions }
+        self._record(report)
+        if total > budget:
+            raise PromptTooLarge(self.stage, total, budget)
+        return { **values, **rendered }, report
+
+    def _shrink_history(self, value, history: str, allowed: int) -> Tuple[str, Optional[str]]:
+        turns = split_history(history)
+        if not turns:
+            return history, None
+        kept, used = [], 8  # the note on the omitted turns
+        for turn in reversed(turns):
+            tokens = _tokens(turn, self.model)
+            if used + tokens > allowed:
+                break
+            kept.insert(0, turn)
+            used += tokens
+        dropped = len(turns) - len(kept)
+        note = f"\n({dropped} earlier turn{'s' if dropped != 1 else ''} omitted)" if dropped else ""
+        if kept:
+            return note + "".join(kept), f"dropped {dropped} oldest turns"
+        # Not even the last turn fits: keep as much of its start as the budget allows (about 4 characters a token).
+        room = max(0, allowed - _tokens(note, self.model) - 8) * 4
+        return note + turns[-1][:room] + " ...", f"dropped {dropped - 1} oldest turns and cut the last one"
+
+    def _shrink_documents(self, value, documents: str, allowed: int) -> Tuple[str, Optional[str]]:
+        if isinstance(value, str):
+            return documents, None
+        kept = list(value)
+        while kept and _tokens(join_documents(kept), self.model) > allowed:
+            kept.pop()
+        if len(kept) == len(value):
+            return documents, None
+        return join_documents(kept), f"dropped {len(value) - len(kept)} lowest-ranked documents"
+
+    def _shrink_topology(self, value, topology: str, allowed: int) -> Tuple[str, Optional[str]]:
+        try:
+            parsed = load_topology(value)
+        except (ValueError, KeyError, TypeError):
+            return topology, None
+        compact = topology
+        for level in (1, 2):
+            compact = compact_topology(parsed, level)
+            if _tokens(compact, self.model) <= allowed:
+                break
+        return compact, f"compacted to level {level}"
+
+    def _record(self, report: dict) -> None:
+        metrics.PROMPT_TOKENS.observe(report["tokens"], version=self.version, stage=self.stage)
+        for action in report["actions"]:
+            metrics.PROMPT_TRIMS.inc(version=self.version, stage=self.stage, field=action["field"])
+        if report["tokens"] > report["budget"]:
+            metrics.PROMPT_REJECTED.inc(version=self.version, stage=self.stage)
+        if report["actions"] or report["tokens"] > report["budget"]:
+            logger.info("prompt %s/%s: %d tokens (budget %d): %s", self.version, self.stage, report["tokens"], report["budget"],
+                        "; ".join(f"{action['field']} {action['action']} ({action['tokens_before']} -> {action['tokens_after']})" for action in report["actions"]) or "nothing to trim")
+        else:
+            logger.debug("prompt %s/%s: %d tokens (budget %d)", self.version, self.stage, report["tokens"], report["budget"])
+
+
+def budgeted(version: str, stage: str, prompt: BasePromptTemplate, model: str, fields: Optional[Dict[str, str]] = None, budget: Optional[int] = None):
+    """A runnable to put in front of `prompt`: it fits the prompt's input into the stage's token budget.
+
+    `fields` maps the input fields that may be shrunk to their kind (HISTORY, DOCUMENTS, TOPOLOGY);
+    a DOCUMENTS field is given as the list of retrieved documents, best first.
+    """
+    fitter = PromptBudget(version, stage, prompt, model, fields or {}, budget)
+
+    def fit(values: dict) -> dict:
+        return fitter.fit(values)[0]
+
+    async def afit(values: dict) -> dict:
+        return fitter.fit(values)[0]
+
+    return RunnableLambda(fit, afunc=afit, name=f"budget_{stage}")
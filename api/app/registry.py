@@ -0,0 +1,124 @@
+# Chain registry: which /vN routes exist and how their chains are loaded.
+#
+# Chain modules are imported on first use, or by the background warm-up started with the
+# server, so the server starts without loading any model and only loads enabled versions.
+import asyncio
+import importlib
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from api.app import config, metrics
+from api.app.singleflight import request_flights, request_key, stream_flights
+
+# version -> module holding the chain. v1 ~ v3 are langserve runnables (attribute `chain`),
+# v4 and v5 expose `invoke` / `astream` for the custom routes in server.py.
+CHAIN_MODULES = {
+    "v1": "api.app.chains.chain_v1",
+    "v2": "api.app.chains.chain_v2",
+    "v3": "api.app.chains.chain_v3",
+    "v4": "api.app.chains.chain_v4",
+    "v5": "api.app.chains.chain_v5",
+}
+RUNNABLE_VERSIONS = ("v1", "v2", "v3")
+
+
+class ChainRegistry:
+    def __init__(self, versions):
+        unknown = [version for version in versions if version not in CHAIN_MODULES]
+        if unknown:
+            raise ValueError(f"unknown chain versions: {unknown}")
+        self.versions = list(versions)
+        self.status: Dict[str, str] = { version: "pending" for version in self.versions }
+        self.load_seconds: Dict[str, float] = {}
+        self._modules: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def load(self, version: str):
+        """Import the chain module of `version` (blocking; the first call pays for the heavy resources)."""
+        module = self._modules.get(version)
+        if module is not None:
+            return module
+        with self._lock:
+            if version not in self._modules:
+                self.status[version] = "loading"
+                started = time.perf_counter()
+                try:
+                    self._modules[version] = importlib.import_module(CHAIN_MODULES[version])
+                except BaseException:
+                    self.status[version] = "failed"
+                    raise
+                self.load_seconds[version] = time.perf_counter() - started
+                self.status[version] = "ready"
+        return self._modules[version]
+
+    async def aload(self, version: str):
+        module = self._modules.get(version)
+        if module is not None:
+            return module
+        return await asyncio.to_thread(self.load, version)
+
+    async def warm_up(self) -> None:
+        """Load every enabled version in the background, one after the other."""
+        for version in self.versions:
+            try:
+                await self.aload(version)
+            except Exception:
+                pass  # reported as "failed" by /ready; the next request will retry
+
+    def ready(self) -> bool:
+        return all(status == "ready" for status in self.status.values())
+
+
+class LazyRunnable(Runnable):
+    """Runnable that stands in for a registry chain until the chain is first used."""
+
+    def __init__(self, registry: ChainRegistry, version: str):
+        self.registry = registry
+        self.version = version
+
+    def _chain(self) -> Runnable:
+        return self.registry.load(self.version).chain
+
+    async def _achain(self) -> Runnable:
+        return (await self.registry.aload(self.version)).chain
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        chain = self._chain()
+        with metrics.timed(self.version, "total"):
+            return chain.invoke(input, config, **kwargs)
+
+    # An identical request already running is joined (see api.app.singleflight). Each caller still
+    # gets a run of its own in its callbacks (langserve reads the run_id from them).
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return await self._acall_with_config(self._ainvoke, input, config, **kwargs)
+
+    async def _ainvoke(self, input: Any, config: RunnableConfig, **kwargs: Any) -> Any:
+        chain = await self._achain()
+
+        async def run():
+            with metrics.timed(self.version, "total"):
+                return await chain.ainvoke(input, config, **kwargs)
+
+        return await request_flights.run(request_key(self.version, "invoke", input, config), run)
+
+    def stream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        yield from self._chain().stream(input, config, **kwargs)
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[Any]:
+        async def inputs():
+            yield input
+
+        async for chunk in self._atransform_stream_with_config(inputs(), self._astream, config, **kwargs):
+            yield chunk
+
+    async def _astream(self, inputs: AsyncIterator[Any], config: RunnableConfig, **kwargs: Any) -> AsyncIterator[Any]:
+        chain = await self._achain()
+        async for input in inputs:
+            async for chunk in stream_flights.stream(request_key(self.version, "stream", input, config), lambda: chain.astream(input, config, **kwargs)):
+                yield chunk
+
+
+registry = ChainRegistry(config.ENABLED_VERSIONS)
@@ -0,0 +1,235 @@
+# Embedding model and FAISS store used by the RAG chains.
+#
+# They are loaded on first use (never at import) and only once per process, however many
+# chain versions ask for them. Queries go through RetrievalService, which encodes concurrent
+# queries together in micro-batches and caches query embeddings and top-k results. With
+# SWITCH_RETRIEVAL_SIDECAR set, a worker loads neither and asks the sidecar (api.app.sidecar).
+import asyncio
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from api.app import config, metrics
+from api.app.cache import LRUCache
+
+
+def _once(load: Callable[[], Any]) -> Callable[[], Any]:
+    """Call `load` the first time only; concurrent first callers wait for the same result."""
+    lock = threading.Lock()
+    result = []
+
+    def get():
+        if not result:
+            with lock:
+                if not result:
+                    result.append(load())
+        return result[0]
+
+    get.loaded = lambda: bool(result)
+    return get
+
+
+@_once
+def get_embedding():
+    """The embedding model, on the backend SWITCH_EMBEDDING_BACKEND picks (see api.app.embeddings)."""
+    from api.app.embeddings import load_embedding
+
+    return load_embedding(config.EMBEDDING_BACKEND)
+
+
+class FaissStore:
+    """Adapter for a langchain FAISS store (the flat index written by FAISS.save_local)."""
+
+    def __init__(self, docsearch):
+        self.docsearch = docsearch
+
+    def search(self, vectors: np.ndarray, k: int) -> List[List[str]]:
+        if self.docsearch._normalize_L2:
+            import faiss
+            faiss.normalize_L2(vectors)
+        _, indices = self.docsearch.index.search(vectors, k)
+        return [[self.docsearch.index_to_docstore_id[i] for i in row if i != -1] for row in indices]
+
+    def documents(self, ids: List[str]) -> List[Document]:
+        return [self.docsearch.docstore.search(id) for id in ids]
+
+
+@_once
+def get_vector_store():
+    if config.VECTOR_STORE == "mmap":
+        from api.app.vectorstore import MmapVectorStore
+        return MmapVectorStore.open(config.VECTOR_STORE_PATH, nprobe=config.RETRIEVAL_NPROBE, ef_search=config.RETRIEVAL_EF_SEARCH)
+
+    from langchain.vectorstores.faiss import FAISS
+    return FaissStore(FAISS.load_local(config.FAISS_PATH, embeddings=get_embedding()))
+
+
+class RetrievalService:
+    """Top-k search over a vector store, batching concurrent queries into one encoder call.
+
+    While fewer than `parallel` batches are running, a query is sent right away (together with
+    whatever arrived in the same event-loop tick). Otherwise new queries wait for up to `window`
+    seconds or until a batch finishes, and then go together (up to `max_batch`) through a single
+    `embed_documents` call and a single index lookup, in a worker thread.
+    Query embeddings and the resulting document ids are kept in bounded LRU caches.
+    """
+
+    def __init__(self, embedding, store, k: int = 4, window: float = 0.005, max_batch: int = 32, parallel: int = 2, cache_size: int = 1024):
+        self.embedding = embedding
+        self.store = store
+        self.k = k
+        self.window = window
+        self.max_batch = max_batch
+        self.parallel = parallel
+        self.embeddings = LRUCache(maxsize=cache_size)
+        self.results = LRUCache(maxsize=cache_size)
+        self.batches = 0
+        self.batched_queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._running = 0
+
+    async def search(self, query: str) -> List[Document]:
+        ids = self._cached(query)
+        if ids is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending.append((query, future))
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._flush_handle is None:
+                if self._running >= self.parallel:
+                    self._flush_handle = loop.call_later(self.window, self._flush)
+                else:
+                    self._flush_handle = loop.call_soon(self._flush)
+            ids = await future
+        return self._documents(ids)
+
+    def search_sync(self, query: str) -> List[Document]:
+        ids = self._cached(query)
+        if ids is None:
+            ids = self._search([query])[query]
+        return self._documents(ids)
+
+    def _cached(self, query: str) -> Optional[List[str]]:
+        ids = self.results.get(query)
+        if ids is None:
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
+        return ids
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        # Queries whose callers went away while they waited (a closed connection, a passed deadline) are not run.
+        batch = [(query, future) for query, future in batch if not future.done()]
+        if not batch:
+            return
+        queries = list(dict.fromkeys(query for query, _ in batch))
+        self._running += 1
+        try:
+            results = await asyncio.to_thread(self._search, queries)
+        except BaseException as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._running -= 1
+            # Whatever queued up behind this batch goes next, without waiting for the window.
+            if self._pending and self._running < self.parallel:
+                self._flush()
+        for query, future in batch:
+            if not future.done():
+                future.set_result(results[query])
+
+    def _search(self, queries: List[str]) -> Dict[str, List[str]]:
+        """Embed (what is not cached yet) and search a batch of distinct queries."""
+        self.batches += 1
+        self.batched_queries += len(queries)
+        vectors = { query: self.embeddings.get(query) for query in queries }
+        missing = [query for query, vector in vectors.items() if vector is None]
+        if missing:
+            for query, vector in zip(missing, self.embedding.embed_documents(missing)):
+                vectors[query] = vector
+                self.embeddings.set(query, vector)
+
+        matrix = np.array([vectors[query] for query in queries], dtype=np.float32)
+        results = dict(zip(queries, self.store.search(matrix, self.k)))
+        for query, ids in results.items():
+            self.results.set(query, ids)
+        return results
+
+    def _documents(self, ids: List[Any]) -> List[Document]:
+        return self.store.documents(ids)
+
+
+class ServiceRetriever(BaseRetriever):
+    """langchain retriever backed by a RetrievalService."""
+
+    service: Any
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.service.search_sync(query)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        return await self.service.search(query)
+
+
+@_once
+def get_local_retrieval_service() -> RetrievalService:
+    """The model and the index in this process."""
+    return RetrievalService(
+        get_embedding(),
+        get_vector_store(),
+        k=config.RETRIEVAL_K,
+        window=config.RETRIEVAL_BATCH_WINDOW_MS / 1000,
+        max_batch=config.RETRIEVAL_MAX_BATCH,
+        cache_size=config.RETRIEVAL_CACHE_SIZE,
+    )
+
+
+@_once
+def get_retrieval_service():
+    """The retrieval sidecar's client when SWITCH_RETRIEVAL_SIDECAR is set (see api.app.sidecar), else the local service."""
+    if config.RETRIEVAL_SIDECAR:
+        from api.app.sidecar import RemoteRetrievalService
+        return RemoteRetrievalService(
+            config.RETRIEVAL_SIDECAR,
+            connections=config.RETRIEVAL_SIDECAR_CONNECTIONS,
+            cache_size=config.RETRIEVAL_CACHE_SIZE,
+        )
+    return get_local_retrieval_service()
+
+
+def get_retriever() -> ServiceRetriever:
+    return ServiceRetriever(service=get_retrieval_service())
+
+
+@metrics.collector
+def _retrieval_metrics():
+    if not get_retrieval_service.loaded() and not get_local_retrieval_service.loaded():
+        return
+    service = get_retrieval_service() if get_retrieval_service.loaded() else get_local_retrieval_service()
+    yield "switch_retrieval_cache_total", "counter", "Retrieval queries answered from / missing the top-k cache.", {"result": "hit"}, service.cache_hits
+    yield "switch_retrieval_cache_total", "counter", "Retrieval queries answered from / missing the top-k cache.", {"result": "miss"}, service.cache_misses
+    if get_local_retrieval_service.loaded():
+        local = get_local_retrieval_service()
+        yield "switch_retrieval_batches_total", "counter", "Encoder batches run by the retrieval service.", {}, local.batches
+        yield "switch_retrieval_batched_queries_total", "counter", "Queries encoded in those batches.", {}, local.batched_queries
+    if hasattr(service, "requests"):
+        yield "switch_retrieval_sidecar_requests_total", "counter", "Queries sent to the retrieval sidecar.", {}, service.requests
+        yield "switch_retrieval_sidecar_errors_total", "counter", "Queries the retrieval sidecar failed to answer.", {}, service.errors
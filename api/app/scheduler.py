@@ -0,0 +1,434 @@
+# One scheduler for every OpenAI call of the process.
+#
+# The chains used to call OpenAI directly, so a big /v4 or /v5 fan-out could burst past the
+# organisation's requests-per-minute and tokens-per-minute limits, and the 429s that came back
+# failed the whole request. Every model built by api.app.llm now shares one pooled OpenAI client
+# whose `create` goes through LLMScheduler:
+#
+# - two token buckets (requests and tokens per minute), charged with the estimated prompt
+#   tokens (plus max_tokens) before the call and corrected with the real usage after it (a failed
+#   call, a 429 included, bills nothing and gives its estimate back). A streamed call holds its
+#   slot until its stream is exhausted or closed, and is charged the tokens it streamed;
+# - waiting calls are served by priority: interactive requests first, then batch/CI traffic
+#   (see `llm_priority`), and within a priority the call of the request with the earliest
+#   deadline first (in arrival order without one), so under load the oldest requests finish
+#   rather than every request slowing down until none makes its deadline;
+# - rate limits, timeouts and 5xx answers are retried with jittered exponential backoff
+#   (honouring Retry-After); a 429 also pauses every other call until the limit resets;
+# - nothing waits past the request's deadline (api.app.deadlines): not the queue, a retry or the
+#   call itself, whose OpenAI timeout is cut to the time left. DeadlineExceeded is raised instead.
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+from api.app import config, deadlines, metrics
+from api.app.singleflight import canonical_key, llm_flights
+from api.app.tokens import count_tokens
+
+INTERACTIVE = 0
+BATCH = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+_priority = contextvars.ContextVar("llm_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def llm_priority(priority: int):
+    """Run the LLM calls made inside the block (and the tasks it starts) at `priority`."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_llm_priority() -> int:
+    return _priority.get()
+
+
+class TokenBucket:
+    """Refills at `per_minute` units a minute and holds `burst` seconds' worth. Not thread-safe on its own.
+
+    OpenAI enforces its per-minute limits over shorter periods too, so the bucket must not
+    allow a whole minute's worth at once.
+    """
+
+    def __init__(self, per_minute: float, burst: float = 6.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` units are available (a request bigger than the bucket waits for a full one)."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        """Remove `amount` units (a negative amount gives units back); the level may go below zero."""
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+def estimate_tokens(kwargs: dict) -> int:
+    """Prompt tokens of a chat or completion request, plus the completion tokens it may use."""
+    model = kwargs.get("model", "gpt-3.5-turbo")
+    if "messages" in kwargs:
+        # Every message costs a few tokens of framing on top of its content.
+        prompt = sum(count_tokens(str(message.get("content") or ""), model) + 4 for message in kwargs["messages"])
+    else:
+        prompts = kwargs.get("prompt", "")
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+        prompt = sum(count_tokens(text if isinstance(text, str) else json.dumps(text), model) for text in prompts)
+    return prompt + (kwargs.get("max_tokens") or 0) * kwargs.get("n", 1)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def _retryable(error: Exception) -> bool:
+    import openai
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status in (408, 409) or (status is not None and status >= 500)
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        rpm: float = 3500,
+        tpm: float = 90000,
+        max_retries: int = 6,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        burst: float = 6.0,
+    ):
+        self.requests = TokenBucket(rpm, burst)
+        self.tokens = TokenBucket(tpm, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._waiting = []  # heap of (priority, deadline, order, tokens, future)
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.in_flight = 0
+        self.counts = {"calls": 0, "retries": 0, "rate_limited": 0, "failed": 0}
+
+    # Admission.
+
+    def _delay(self, tokens: int) -> float:
+        """Seconds until a call of `tokens` may start (0 means now). Caller holds the lock."""
+        pause = self.paused_until - time.monotonic()
+        return max(pause, self.requests.delay(1), self.tokens.delay(tokens))
+
+    def _admit(self, tokens: int) -> None:
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+
+    def _dispatch(self) -> None:
+        """Start as many waiting calls as the buckets allow, highest priority first."""
+        self._timer = None
+        with self._lock:
+            while self._waiting:
+                *_, tokens, future = self._waiting[0]
+                if future.done():  # cancelled while waiting
+                    heapq.heappop(self._waiting)
+                    continue
+                delay = self._delay(tokens)
+                if delay > 0:
+                    self._timer = future.get_loop().call_later(delay, self._dispatch)
+                    return
+                heapq.heappop(self._waiting)
+                self._admit(tokens)
+                future.set_result(None)
+
+    async def _acquire(self, tokens: int, priority: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            heapq.heappush(self._waiting, (priority, _deadline_at(), next(self._counter), tokens, future))
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as the caller went away: hand the slot back.
+                self._release(tokens, None)
+            raise
+
+    def _acquire_sync(self, tokens: int) -> None:
+        while True:
+            with self._lock:
+                # Threads only go ahead when no async call is queued, so they cannot jump the queue.
+                delay = self._delay(tokens) if not self._waiting else 0.05
+                if delay <= 0:
+                    self._admit(tokens)
+                    return
+            time.sleep(delay)
+
+    def _release(self, estimated: int, response: Any, model: Optional[str] = None, seconds: Optional[float] = None, usage: Any = None) -> None:
+        """End a call: `response` is None when it failed, `usage` overrides the response's own."""
+        usage = usage or getattr(response, "usage", None)
+        with self._lock:
+            self.in_flight -= 1
+            if response is None:
+                # Nothing was billed: give the estimate back.
+                self.tokens.take(-estimated)
+            else:
+                self.counts["calls"] += 1
+                if usage is not None and getattr(usage, "total_tokens", None):
+                    self.tokens.take(usage.total_tokens - estimated)
+        if seconds is not None:
+            metrics.LLM_SECONDS.observe(seconds, model=model)
+        if usage is not None:
+            metrics.LLM_TOKENS.inc(usage.prompt_tokens or 0, model=model, kind="prompt")
+            metrics.LLM_TOKENS.inc(usage.completion_tokens or 0, model=model, kind="completion")
+            metrics.LLM_PROMPT_TOKENS.observe(usage.prompt_tokens or 0, model=model)
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Jittered exponential backoff; a 429 also holds back every other call."""
+        import openai
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        with self._lock:
+            self.counts["retries"] += 1
+            if isinstance(error, openai.RateLimitError):
+                self.counts["rate_limited"] += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
+
+    # Calls.
+
+    async def arun(self, create: Callable, kwargs: dict) -> Any:
+        tokens, priority = estimate_tokens(kwargs), _priority.get()
+        for attempt in itertools.count():
+            queued = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._acquire(tokens, priority), deadlines.check("the LLM queue"))
+            except asyncio.TimeoutError:
+                raise deadlines.DeadlineExceeded("the LLM queue") from None
+            started = time.perf_counter()
+            metrics.LLM_QUEUE_SECONDS.observe(started - queued, priority=PRIORITY_NAMES.get(priority, priority))
+            response = None
+            try:
+                response = await create(**_within_deadline(kwargs))
+                if kwargs.get("stream"):
+                    # Released once the stream ends (see _TrackedStream), not now.
+                    response = _TrackedStream(self, response, tokens, kwargs, started)
+                return response
+            except Exception as error:
+                if attempt >= self.max_retries or not _retryable(error):
+                    self.counts["failed"] += 1
+                    raise
+                delay = self._retry_delay(attempt, error)
+            finally:
+                if not isinstance(response, _TrackedStream):
+                    self._release(tokens, response, kwargs.get("model"), time.perf_counter() - started)
+            await asyncio.sleep(delay)
+
+    def run(self, create: Callable, kwargs: dict) -> Any:
+        tokens = estimate_tokens(kwargs)
+        for attempt in itertools.count():
+            queued = time.perf_counter()
+            deadlines.check("the LLM queue")
+            self._acquire_sync(tokens)
+            started = time.perf_counter()
+            metrics.LLM_QUEUE_SECONDS.observe(started - queued, priority=PRIORITY_NAMES[INTERACTIVE])
+            response = None
+            try:
+                response = create(**_within_deadline(kwargs))
+                if kwargs.get("stream"):
+                    response = _TrackedStream(self, response, tokens, kwargs, started)
+                return response
+            except Exception as error:
+                if attempt >= self.max_retries or not _retryable(error):
+                    self.counts["failed"] += 1
+                    raise
+                delay = self._retry_delay(attempt, error)
+            finally:
+                if not isinstance(response, _TrackedStream):
+                    self._release(tokens, response, kwargs.get("model"), time.perf_counter() - started)
+            time.sleep(delay)
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        """The backoff before the next attempt, unless that would end past the deadline."""
+        delay = self._backoff(attempt, error)
+        left = deadlines.remaining()
+        if left is not None and delay >= left:
+            self.counts["failed"] += 1
+            raise deadlines.DeadlineExceeded("an LLM retry") from error
+        return delay
+
+    def outstanding(self) -> int:
+        """Calls in flight or waiting for the buckets."""
+        with self._lock:
+            return self.in_flight + sum(1 for *_, future in self._waiting if not future.done())
+
+    def stats(self) -> dict:
+        with self._lock:
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, *_, future in self._waiting:
+                if not future.done():
+                    queued[PRIORITY_NAMES.get(priority, str(priority))] += 1
+            return {
+                "queued": queued,
+                "in_flight": self.in_flight,
+                "paused_seconds": round(max(0.0, self.paused_until - time.monotonic()), 3),
+                "requests_available": round(max(0.0, self.requests.level), 1),
+                "tokens_available": round(max(0.0, self.tokens.level)),
+                **self.counts,
+            }
+
+
+class _TrackedStream:
+    """A streamed completion (openai Stream / AsyncStream) that holds its scheduler slot until it is
+    exhausted or closed, then charges the prompt estimate plus the tokens of the text it streamed
+    (streams carry no usage)."""
+
+    def __init__(self, scheduler: LLMScheduler, stream: Any, estimated: int, kwargs: dict, started: float):
+        self._scheduler = scheduler
+        self._stream = stream
+        self._estimated = estimated
+        self._model = kwargs.get("model", "gpt-3.5-turbo")
+        self._prompt_tokens = estimate_tokens({ **kwargs, "max_tokens": 0 })
+        self._started = started
+        self._text = []
+        self._released = False
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._stream, name)
+
+    def _note(self, chunk: Any) -> None:
+        for choice in getattr(chunk, "choices", None) or ():
+            delta = getattr(choice, "delta", None)
+            text = getattr(delta, "content", None) if delta is not None else getattr(choice, "text", None)
+            if text:
+                self._text.append(text)
+
+    def _release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        completion = count_tokens("".join(self._text), self._model) if self._text else 0
+        usage = SimpleNamespace(prompt_tokens=self._prompt_tokens, completion_tokens=completion, total_tokens=self._prompt_tokens + completion)
+        self._scheduler._release(self._estimated, self._stream, self._model, time.perf_counter() - self._started, usage)
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                self._note(chunk)
+                yield chunk
+        finally:
+            self._release()
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                self._note(chunk)
+                yield chunk
+        finally:
+            self._release()
+
+    def close(self) -> Any:
+        # Stream.close() returns None, AsyncStream.close() a coroutine: either way the call is over.
+        self._release()
+        return self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+def _deadline_at() -> float:
+    value = deadlines.current()
+    return value.at if value is not None and value.at is not None else float("inf")
+
+
+def _within_deadline(kwargs: dict) -> dict:
+    """`kwargs` with the OpenAI timeout cut to the time left before the deadline."""
+    left = deadlines.check("an LLM call")
+    if left is None:
+        return kwargs
+    timeout = kwargs.get("timeout")
+    return { **kwargs, "timeout": min(left, timeout) if isinstance(timeout, (int, float)) else left }
+
+
+def deterministic(kwargs: dict) -> bool:
+    """Whether identical requests get the same answer, so one call can serve them all."""
+    return kwargs.get("temperature", 1) == 0 and kwargs.get("n", 1) == 1 and not kwargs.get("stream")
+
+
+class ScheduledResource:
+    """Stands in for `client.chat.completions` / `client.completions`: every `create` goes through the scheduler."""
+
+    def __init__(self, resource: Any, scheduler: LLMScheduler, is_async: bool):
+        self.resource = resource
+        self.scheduler = scheduler
+        self.is_async = is_async
+
+    def create(self, **kwargs: Any) -> Any:
+        if self.is_async:
+            if deterministic(kwargs):
+                # An identical call already in flight is awaited instead of made again (see api.app.singleflight).
+                key = canonical_key(type(self.resource).__module__, kwargs, _priority.get())
+                return llm_flights.run(key, lambda: self.scheduler.arun(self.resource.create, kwargs))
+            return self.scheduler.arun(self.resource.create, kwargs)
+        return self.scheduler.run(self.resource.create, kwargs)
+
+
+scheduler = LLMScheduler(
+    rpm=config.LLM_RPM,
+    tpm=config.LLM_TPM,
+    max_retries=config.LLM_MAX_RETRIES,
+    backoff_base=config.LLM_BACKOFF_BASE,
+    backoff_max=config.LLM_BACKOFF_MAX,
+)
+
+
+@metrics.collector
+def _scheduler_metrics():
+    stats = scheduler.stats()
+    for priority, count in stats["queued"].items():
+        yield "switch_llm_queued", "gauge", "OpenAI calls waiting for the rate-limit scheduler.", {"priority": priority}, count
+    yield "switch_llm_in_flight", "gauge", "OpenAI calls in flight.", {}, stats["in_flight"]
+    yield "switch_llm_retries_total", "counter", "OpenAI call attempts that were retried.", {}, stats["retries"]
+    yield "switch_llm_rate_limited_total", "counter", "OpenAI calls answered with 429.", {}, stats["rate_limited"]
+    yield "switch_llm_failed_total", "counter", "OpenAI calls that failed after their retries.", {}, stats["failed"]
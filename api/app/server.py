@@ -1,31 +1,36 @@
 
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
 from langserve import add_routes
 from fastapi.middleware.cors import CORSMiddleware
+from sse_starlette import EventSourceResponse
+
+from api.app.utils import ApplyRequest, ChatRequest, ChatResponse, ChatRequestWrapper, ChatBatchRequestWrapper
+from api.app.cache import bypass_llm_cache
+from api.app.scheduler import BATCH, INTERACTIVE, llm_priority, scheduler
+from api.app.registry import RUNNABLE_VERSIONS, LazyRunnable, registry
+from api.app import config, metrics
+from api.app.prompts import PromptTooLarge
+from api.app.deadlines import DeadlineExceeded, remaining
+from api.app.guard import RequestGuard
+from api.app.singleflight import request_flights, request_key, stream_flights
 
-from api.app.utils import ChatRequest, ChatResponse, ChatRequestWrapper
-from api.app.chains.chain_v1 import chain as chain_v1
-from api.app.chains.chain_v2 import chain as chain_v2
-from api.app.chains.chain_v3 import chain as chain_v3
-from api.app.chains.chain_v4 import chain as chain_v4
-from api.app.chains.chain_v5 import invoke as chain_v5_invoke
-
-from api.app.chains.chain_v4 import first_chain as first_chain_v4, second_chain as second_chain_v4
-
+import asyncio
+import json
+import time
 from dotenv import load_dotenv; load_dotenv()
 
-chain_v1 = chain_v1.with_types(input_type=ChatRequest, output_type=ChatResponse)
-chain_v2 = chain_v2.with_types(input_type=ChatRequest, output_type=ChatResponse)
-chain_v3 = chain_v3.with_types(input_type=ChatRequest, output_type=ChatResponse)
-chain_v4 = chain_v4.with_types(input_type=ChatRequest)
-
 app = FastAPI(
     title="S Witch API Server",
     version="0.1.0",
     description="S Witch API Server",
 )
 
+# Deadline, cancellation on disconnect and load shedding of the chain routes (see api.app.guard).
+# Added first, so it runs inside every other middleware.
+app.add_middleware(RequestGuard)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -34,47 +39,163 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# "Cache-Control: no-cache" makes every LLM call of that request skip the response cache.
+@app.middleware("http")
+async def llm_cache_bypass(request: Request, call_next):
+    with bypass_llm_cache("no-cache" in request.headers.get("cache-control", "")):
+        return await call_next(request)
+
+# Batch endpoints (or "X-Priority: batch") queue their LLM calls behind interactive ones.
+@app.middleware("http")
+async def llm_request_priority(request: Request, call_next):
+    batch = request.url.path.endswith("/batch") or request.headers.get("x-priority", "").lower() == "batch"
+    with llm_priority(BATCH if batch else INTERACTIVE):
+        return await call_next(request)
+
+# Request count and latency per route (the route template, so label values stay bounded), requests in flight for /metrics, and the time each chain
+# stage took as a Server-Timing header (on responses that are complete when they start;
+# streamed responses carry their stages as events instead).
+@app.middleware("http")
+async def request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    metrics.HTTP_IN_FLIGHT.inc()
+    status = 500
+    try:
+        with metrics.request_timings() as timings:
+            response = await call_next(request)
+        status = response.status_code
+        if timings and "text/event-stream" not in response.headers.get("content-type", ""):
+            response.headers["Server-Timing"] = metrics.server_timing(timings)
+        return response
+    finally:
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.HTTP_IN_FLIGHT.dec()
+        metrics.HTTP_REQUESTS.inc(route=route, method=request.method, status=status)
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - started, route=route)
+
+# A prompt that does not fit its token budget even after trimming is refused before any LLM call.
+@app.exception_handler(PromptTooLarge)
+async def prompt_too_large(request: Request, error: PromptTooLarge) -> Response:
+    return JSONResponse({ "detail": str(error), "stage": error.stage, "tokens": error.tokens, "budget": error.budget }, status_code=413)
+
+# A stage that could not finish before the request's deadline (see api.app.deadlines).
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded(request: Request, error: DeadlineExceeded) -> Response:
+    return JSONResponse({ "detail": str(error), "stage": error.stage }, status_code=504)
+
+@app.get("/metrics")
+async def prometheus_metrics() -> Response:
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+async def cache_stats() -> dict:
+    from api.app.llm import llm_cache
+    return llm_cache.stats() if llm_cache is not None else {}
+
+# Queue depth per priority, calls in flight and retries of the shared OpenAI scheduler.
+@app.get("/llm/stats")
+async def llm_stats() -> dict:
+    return scheduler.stats()
+
+# Chains are loaded on first use (or by the warm-up below), never at import time.
+@app.on_event("startup")
+async def warm_up():
+    if config.WARM_UP:
+        app.state.warm_up = asyncio.create_task(registry.warm_up())
+
+@app.get("/ready")
+async def ready() -> Response:
+    body = { "ready": registry.ready(), "versions": registry.status, "load_seconds": registry.load_seconds }
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
 # Adds routes to the app for using the chain under:
 # /invoke
 # /batch
 # /stream
-add_routes(app, chain_v1, path="/v1", enable_feedback_endpoint=True)
-add_routes(app, chain_v2, path="/v2", enable_feedback_endpoint=True)
-add_routes(app, chain_v3, path="/v3", enable_feedback_endpoint=True)
-
-from langserve import APIHandler
-api_handler = APIHandler(chain_v4, path="/v4")
-
-from fastapi import Request, Response
-import json
-import asyncio
-
-
-# ip 받기
-# 이를 활용해서, 전체적으로 어떻게 설정해야할지 조언을 얻기
-# 조언과 ip, topology에 기반하여 각 각의 device를 위한 설정 방법 얻기.
-@app.post("/v4/invoke")
-async def invoke_v4(request: ChatRequestWrapper) -> Response:
-    request = request.input
-    topology = json.loads(request.topology)
-    node_info = topology["node_info"]
-    async_list = []
-    first_request = request.dict()
-    first_output = first_chain_v4.invoke(first_request)
-    request["topology"] = first_output["output"]
-    for node in node_info:
-        node_request = request.dict()
-        node_request["question"] += f" for this purpose, how can I configure device {node['name']}?"
-        node_response = second_chain_v4.ainvoke(node_request)
-        async_list.append(node_response)
-    finished, _ = await asyncio.wait(async_list, return_when=asyncio.ALL_COMPLETED)
-    return { "output": [f.result() for f in finished] } 
-
-@app.post("/v5/invoke")
-async def invoke_v5(request: ChatRequestWrapper) -> Response:
-    request = request.input
-    output = await chain_v5_invoke(request)
-    return { "output": output }
+for version in RUNNABLE_VERSIONS:
+    if version in registry.versions:
+        chain = LazyRunnable(registry, version).with_types(input_type=ChatRequest, output_type=ChatResponse)
+        add_routes(app, chain, path=f"/{version}", enable_feedback_endpoint=True)
+
+
+# Same server-sent events as the langserve /stream routes of v1 ~ v3:
+# one "data" event per finished stage ({"stage": "summary" | "design" | "ip_plan" | "scope", "output": ...})
+# and per finished device ({"stage": "device", "index": <position in node_info>, "output": ChatResponse}),
+# then "end" (or "error"). A stream still running at the request's deadline ends with a 504 error.
+def _event_stream(events) -> EventSourceResponse:
+    async def stream():
+        iterator = events.__aiter__()
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(iterator.__anext__(), remaining())
+                except StopAsyncIteration:
+                    break
+                yield { "event": "data", "data": json.dumps(event) }
+            yield { "event": "end" }
+        except (asyncio.TimeoutError, DeadlineExceeded) as error:
+            message = str(error) if isinstance(error, DeadlineExceeded) else "the request deadline passed"
+            yield { "event": "error", "data": json.dumps({ "status_code": 504, "message": message }) }
+        except PromptTooLarge as error:
+            yield { "event": "error", "data": json.dumps({ "status_code": 413, "message": str(error) }) }
+        except Exception:
+            yield { "event": "error", "data": json.dumps({ "status_code": 500, "message": "Internal Server Error" }) }
+            raise
+    return EventSourceResponse(stream())
+
+# In the v4 and v5 routes below, identical /vN/invoke and /vN/stream requests that arrive while one
+# is running join it (request_flights, stream_flights) instead of running the chain again (see
+# api.app.singleflight).
+if "v4" in registry.versions:
+    # ip 받기
+    # 이를 활용해서, 전체적으로 어떻게 설정해야할지 조언을 얻기
+    # 조언과 ip, topology에 기반하여 각 각의 device를 위한 설정 방법 얻기.
+    @app.post("/v4/invoke")
+    async def invoke_v4(request: ChatRequestWrapper) -> Response:
+        chain_v4 = await registry.aload("v4")
+        output = await request_flights.run(request_key("v4", "invoke", request.input, request.config), lambda: chain_v4.invoke(request.input, request.config))
+        return { "output": output }
+
+    @app.post("/v4/stream")
+    async def stream_v4(request: ChatRequestWrapper) -> EventSourceResponse:
+        chain_v4 = await registry.aload("v4")
+        return _event_stream(stream_flights.stream(request_key("v4", "stream", request.input, request.config), lambda: chain_v4.astream(request.input, request.config)))
+
+    @app.post("/v4/batch")
+    async def batch_v4(request: ChatBatchRequestWrapper) -> Response:
+        chain_v4 = await registry.aload("v4")
+        output = await chain_v4.abatch(request.inputs, request.configs())
+        return { "output": output }
+
+if "v5" in registry.versions:
+    @app.post("/v5/invoke")
+    async def invoke_v5(request: ChatRequestWrapper) -> Response:
+        chain_v5 = await registry.aload("v5")
+        output = await request_flights.run(request_key("v5", "invoke", request.input, request.config), lambda: chain_v5.invoke(request.input, request.config))
+        return { "output": output }
+
+    @app.post("/v5/stream")
+    async def stream_v5(request: ChatRequestWrapper) -> EventSourceResponse:
+        chain_v5 = await registry.aload("v5")
+        return _event_stream(stream_flights.stream(request_key("v5", "stream", request.input, request.config), lambda: chain_v5.astream(request.input, request.config)))
+
+    # Requests about the same lab share their common stages (see chain_v5.abatch).
+    @app.post("/v5/batch")
+    async def batch_v5(request: ChatBatchRequestWrapper) -> Response:
+        chain_v5 = await registry.aload("v5")
+        output = await chain_v5.abatch(request.inputs, request.configs())
+        return { "output": output }
+
+    # Push the output of /v5/invoke to the GNS3 lab (SWITCH_GNS3_URL) and verify it (see api.app.twin).
+    @app.post("/v5/apply")
+    async def apply_v5(request: ApplyRequest) -> Response:
+        import httpx
+        from api.app import twin
+        try:
+            return await twin.apply(request)
+        except httpx.HTTPError as error:
+            # The GNS3 server is down or does not know the project.
+            return JSONResponse({ "detail": f"GNS3 server error: {error}" }, status_code=502)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,180 @@
+# Embedding and vector search in one process shared by every API worker.
+#
+# With `uvicorn --workers N`, every worker loaded its own copy of the embedding model and of the
+# guide index, so memory grew with the number of workers. With SWITCH_RETRIEVAL_SIDECAR set, the
+# workers' retrievers are thin clients of one sidecar process instead: it holds the model, the
+# index and a RetrievalService, so queries from all workers are micro-batched together on its
+# thread pool, and the workers only keep pooled HTTP connections to it (over a Unix socket or
+# localhost TCP).
+#
+#   SWITCH_RETRIEVAL_SIDECAR=unix:/tmp/switch-retrieval.sock python -m api.app.sidecar
+#   SWITCH_RETRIEVAL_SIDECAR=unix:/tmp/switch-retrieval.sock uvicorn api.app.server:app --workers 4
+import argparse
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from langchain_core.documents import Document
+
+from api.app import config, metrics
+from api.app.cache import LRUCache
+
+
+def _transport_options(address: str) -> Dict[str, Any]:
+    """httpx client options for "unix:/path/to.sock" or "http://host:port"."""
+    if address.startswith("unix:"):
+        return { "base_url": "http://sidecar", "uds": address[len("unix:"):] }
+    return { "base_url": address.rstrip("/") }
+
+
+def _document(data: dict) -> Document:
+    return Document(page_content=data["page_content"], metadata=data.get("metadata") or {})
+
+
+class RemoteRetrievalService:
+    """Same interface as RetrievalService (search / search_sync), answered by the sidecar.
+
+    Results are kept in a small LRU, so a repeated query does not leave the worker.
+    """
+
+    def __init__(self, address: str, connections: int = 16, timeout: float = 30.0, cache_size: int = 1024):
+        self.address = address
+        self.connections = connections
+        self.timeout = timeout
+        self.results = LRUCache(maxsize=cache_size)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._sync_client = None
+        self._async_clients: Dict[int, Any] = {}  # one per event loop (httpx pools cannot cross loops)
+
+    def _options(self, is_async: bool) -> Dict[str, Any]:
+        import httpx
+        options = _transport_options(self.address)
+        limits = httpx.Limits(max_connections=self.connections, max_keepalive_connections=self.connections)
+        uds = options.pop("uds", None)
+        transport = (httpx.AsyncHTTPTransport if is_async else httpx.HTTPTransport)(uds=uds, limits=limits)
+        return { **options, "transport": transport, "timeout": self.timeout }
+
+    def _async_client(self):
+        import httpx
+        loop = id(asyncio.get_running_loop())
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = self._async_clients[loop] = httpx.AsyncClient(**self._options(True))
+        return client
+
+    def _client(self):
+        import httpx
+        with self._lock:
+            if self._sync_client is None:
+                self._sync_client = httpx.Client(**self._options(False))
+        return self._sync_client
+
+    def _cached(self, query: str) -> Optional[List[Document]]:
+        documents = self.results.get(query)
+        if documents is None:
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
+        return documents
+
+    def _answer(self, query: str, response) -> List[Document]:
+        if response.status_code != 200:
+            self.errors += 1
+            response.raise_for_status()
+        documents = [_document(data) for data in response.json()["results"][0]]
+        self.results.set(query, documents)
+        return documents
+
+    async def search(self, query: str) -> List[Document]:
+        documents = self._cached(query)
+        if documents is not None:
+            return documents
+        self.requests += 1
+        try:
+            response = await self._async_client().post("/search", json={ "queries": [query] })
+        except Exception:
+            self.errors += 1
+            raise
+        return self._answer(query, response)
+
+    def search_sync(self, query: str) -> List[Document]:
+        documents = self._cached(query)
+        if documents is not None:
+            return documents
+        self.requests += 1
+        try:
+            response = self._client().post("/search", json={ "queries": [query] })
+        except Exception:
+            self.errors += 1
+            raise
+        return self._answer(query, response)
+
+
+def create_app(service):
+    """The sidecar's HTTP API around a RetrievalService."""
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse
+    from langserve.pydantic_v1 import BaseModel
+
+    class SearchRequest(BaseModel):
+        queries: List[str]
+
+    app = FastAPI(title="S Witch retrieval sidecar")
+
+    @app.post("/search")
+    async def search(request: SearchRequest):
+        # Concurrent requests (from every worker) end up in the same encoder batches.
+        results = await asyncio.gather(*(service.search(query) for query in request.queries))
+        return { "results": [[{ "page_content": document.page_content, "metadata": document.metadata } for document in documents] for documents in results] }
+
+    @app.get("/health")
+    async def health():
+        return { "status": "ok" }
+
+    @app.get("/metrics")
+    async def prometheus_metrics():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+    return app
+
+
+def serve(service, address: str, threads: int = 4) -> None:
+    """Run the sidecar for `service` on `address` until interrupted."""
+    import uvicorn
+
+    app = create_app(service)
+    service.parallel = threads
+
+    @app.on_event("startup")
+    async def thread_pool():
+        # Encoder batches run in this pool; `threads` of them may run at once.
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(threads, thread_name_prefix="retrieval"))
+
+    options = _transport_options(address)
+    if "uds" in options:
+        if os.path.exists(options["uds"]):  # left behind by a previous run
+            os.unlink(options["uds"])
+        uvicorn.run(app, uds=options["uds"], log_level="warning")
+    else:
+        from urllib.parse import urlparse
+        url = urlparse(address)
+        uvicorn.run(app, host=url.hostname or "127.0.0.1", port=url.port or 80, log_level="warning")
+
+
+if __name__ == "__main__":
+    from api.app.retrieval import get_local_retrieval_service
+
+    parser = argparse.ArgumentParser(description="Embedding and vector search sidecar shared by the API workers.")
+    parser.add_argument("--address", default=config.RETRIEVAL_SIDECAR or "unix:/tmp/switch-retrieval.sock", help='"unix:/path/to.sock" or "http://127.0.0.1:8765"')
+    parser.add_argument("--threads", type=int, default=config.RETRIEVAL_SIDECAR_THREADS)
+    args = parser.parse_args()
+    service = get_local_retrieval_service()
+    service.embedding.embed_documents(["warm up"])
+    serve(service, args.address, args.threads)
@@ -0,0 +1,167 @@
+# Single-flight: identical work that is already running is joined instead of started again.
+#
+# Several engineers, or the UI retrying after a timeout, often send the same topology and question
+# at the same moment. Each request used to run the whole pipeline, so the same design and device
+# calls were made, and billed, once per request. The LLM response cache (api.app.cache) only helps
+# once a call has finished. Now, while one is running, an identical
+#
+# - request (/vN/invoke, /vN/stream: same version, input and run config, same Cache-Control:
+#   no-cache and priority) joins it; a joined stream first replays the events sent so far;
+# - OpenAI call (api.app.scheduler: same endpoint, model, messages and parameters, deterministic
+#   only: temperature 0, one choice, not streamed) awaits it. Prompts are a function of the stage
+#   inputs, so the stage-2 designs, stage-4 device calls and repairs of every chain are shared
+#   across requests even when the requests themselves differ.
+#
+# Keys are a hash of the canonical JSON of the inputs (api.app.executor.SharedCalls does the same
+# within one batch, where the keys are known in advance). Each caller of a shared result gets its
+# own copy of it, or the same exception. A caller that goes away (its task is cancelled, e.g. a
+# closed stream) only stops waiting; the shared work is cancelled when no caller is left. It runs
+# until the latest deadline of its callers (api.app.deadlines).
+import asyncio
+import copy
+import hashlib
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from api.app import config, deadlines, metrics
+
+_END = object()
+
+
+def _plain(value: Any) -> Any:
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    if hasattr(value, "dict"):
+        return value.dict()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    return repr(value)
+
+
+def canonical_key(*parts: Any) -> str:
+    """A hash of `parts` that does not depend on dict order or on models vs plain values."""
+    text = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=_plain)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def request_key(version: str, endpoint: str, input: Any, run_config: Optional[dict]) -> str:
+    """Key of a chain request; the topology is compared parsed, so its JSON formatting does not matter."""
+    from api.app.cache import llm_cache_bypassed
+    from api.app.scheduler import current_llm_priority
+
+    input = _plain(input) if not isinstance(input, dict) else dict(input)
+    topology = input.get("topology")
+    if isinstance(topology, str):
+        try:
+            input["topology"] = json.loads(topology)
+        except ValueError:
+            pass
+    configurable = (run_config or {}).get("configurable", {})
+    return canonical_key(version, endpoint, input, configurable, llm_cache_bypassed(), current_llm_priority())
+
+
+class _Flight:
+    def __init__(self):
+        self.task: Optional[asyncio.Future] = None
+        self.deadline: Optional[deadlines.Deadline] = None
+        self.callers = 0
+        self.waiting = 0
+        self.items: List[Any] = []  # streams: everything sent so far
+        self.queues: List[asyncio.Queue] = []
+
+
+class SingleFlight:
+    """Runs each distinct key once at a time; callers that arrive while it runs share its outcome."""
+
+    def __init__(self, scope: str):
+        self.scope = scope
+        self.flights: Dict[str, _Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self.flights)
+
+    def _join(self, key: str, start: Callable[[_Flight], Awaitable[Any]]) -> _Flight:
+        flight = self.flights.get(key)
+        # A finished call is forgotten by a done-callback, which may not have run yet.
+        if flight is None or flight.task.done():
+            flight = self.flights[key] = _Flight()
+            caller = deadlines.current()
+            flight.deadline = deadlines.Deadline(caller.at if caller is not None else None)
+            with deadlines.shared(flight.deadline):
+                flight.task = asyncio.ensure_future(start(flight))
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            metrics.SINGLE_FLIGHT.inc(scope=self.scope, result="started")
+        else:
+            flight.deadline.extend(deadlines.current())
+            metrics.SINGLE_FLIGHT.inc(scope=self.scope, result="coalesced")
+        flight.callers += 1
+        flight.waiting += 1
+        return flight
+
+    def _leave(self, key: str, flight: _Flight) -> None:
+        flight.waiting -= 1
+        if flight.waiting == 0 and not flight.task.done():
+            # Every caller has gone away: nobody is left to use the result.
+            flight.task.cancel()
+            self._forget(key, flight)
+            metrics.SINGLE_FLIGHT.inc(scope=self.scope, result="cancelled")
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """The result of `factory()`, or of the identical call already running under `key`."""
+        if not config.SINGLE_FLIGHT:
+            return await factory()
+        flight = self._join(key, lambda flight: factory())
+        try:
+            result = await asyncio.shield(flight.task)
+        finally:
+            self._leave(key, flight)
+        # Callers can only join while the call runs, so `callers` is final once it is done.
+        return copy.deepcopy(result) if flight.callers > 1 else result
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """The items of `factory()`, or of the identical stream already running under `key`
+        (the items it sent before this caller joined come first)."""
+        if not config.SINGLE_FLIGHT:
+            async for item in factory():
+                yield item
+            return
+
+        async def produce(flight: _Flight) -> None:
+            try:
+                async for item in factory():
+                    flight.items.append(item)
+                    for queue in flight.queues:
+                        queue.put_nowait((item, None))
+            except Exception as error:
+                for queue in flight.queues:
+                    queue.put_nowait((_END, error))
+            else:
+                for queue in flight.queues:
+                    queue.put_nowait((_END, None))
+
+        flight = self._join(key, produce)
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in flight.items:
+            queue.put_nowait((item, None))
+        flight.queues.append(queue)
+        try:
+            while True:
+                item, error = await queue.get()
+                if item is _END:
+                    if error is not None:
+                        raise error
+                    return
+                # Items are kept for late joiners, so every caller gets a copy.
+                yield copy.deepcopy(item)
+        finally:
+            flight.queues.remove(queue)
+            self._leave(key, flight)
+
+
+request_flights = SingleFlight("request")
+stream_flights = SingleFlight("stream")
+llm_flights = SingleFlight("llm")
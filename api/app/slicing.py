@@ -0,0 +1,115 @@
+# Per-device views of the topology for the stage-4 prompts.
+#
+# Stage 4 used to receive the whole topology and the whole IP plan for every device, so the
+# prompt tokens of one request grew with the square of the device count. A device only needs
+# its own ports, what each port is plugged into, the other L3 ports on the same segment
+# (e.g. its default gateway) and the subnets it sits on.
+import ipaddress
+import json
+from typing import Dict, List, Optional, Union
+
+from api.app.allocator import GATEWAY_NODE_TYPES, broadcast_domains
+from api.app.topology import L2_NODE_TYPES, Port, Topology, load_topology
+
+
+class TopologySlicer:
+    """Builds compact per-device views of one topology and its IP plan."""
+
+    def __init__(self, topology: Union[str, dict, Topology], port_identification: dict):
+        self.topology = load_topology(topology)
+
+        # Entries address the ports of the same name in node order: the first entry the first port.
+        self._unaddressed: Dict[tuple, List[Port]] = {}
+        for node in self.topology.nodes:
+            for port in node.ports:
+                self._unaddressed.setdefault((node.name, port.name), []).append(port)
+        self.addresses: Dict[Port, dict] = {}
+        for entry in port_identification.get("port_info", []):
+            self.add(entry)
+
+        self.segments: Dict[Port, List[Port]] = {}
+        for domain in broadcast_domains(self.topology):
+            for port in domain:
+                self.segments[port] = domain
+
+    def add(self, entry: dict) -> Optional[Port]:
+        """Adds one entry of the IP plan; returns the port it addresses (None if there is none left)."""
+        ports = self._unaddressed.get((entry.get("device"), entry.get("port")))
+        if not ports:
+            return None
+        port = ports.pop(0)
+        self.addresses[port] = entry
+        return port
+
+    def inputs(self, device_name: str) -> List[Port]:
+        """The ports whose addresses view(device_name) shows."""
+        node = self.topology.by_name[device_name]
+        ports = []
+        for port in node.ports:
+            peer = self.topology.peer(port)
+            if peer is None:
+                continue
+            ports.append(port)
+            if peer.node.node_type in L2_NODE_TYPES and node.node_type not in L2_NODE_TYPES:
+                ports += [other for other in self.segments.get(port, []) if other is not port and other.node.node_type in GATEWAY_NODE_TYPES]
+        return ports
+
+    def waiting_for(self, device_name: str) -> Optional[List[Port]]:
+        """The ports view(device_name) shows that have no address yet; once there are none, the view
+        is final while the plan is still coming in. None for an L2 device: plans usually leave its
+        ports out, so only the whole plan tells."""
+        if self.topology.by_name[device_name].node_type in L2_NODE_TYPES:
+            return None
+        return [port for port in self.inputs(device_name) if port not in self.addresses]
+
+    def _address(self, port: Port) -> dict:
+        entry = self.addresses.get(port)
+        view = {"device": port.node.name, "port": port.name}
+        if entry:
+            view["ip"] = entry.get("ip")
+        return view
+
+    def view(self, device_name: str) -> dict:
+        """Ports, neighbours and subnets of one device, without node/link UUIDs."""
+        node = self.topology.by_name[device_name]
+        ports, neighbours, subnets = [], [], []
+        for port in node.ports:
+            peer = self.topology.peer(port)
+            if peer is None:
+                continue
+            port_view = {"name": port.name, "connected_to": f"{peer.node.name} {peer.name}"}
+            entry = self.addresses.get(port)
+            if entry:
+                port_view["ip"], port_view["subnet"] = entry.get("ip"), entry.get("subnet")
+                try:
+                    subnet = str(ipaddress.ip_interface(f"{entry['ip']}/{entry['subnet']}").network)
+                    if subnet not in subnets:
+                        subnets.append(subnet)
+                except (KeyError, TypeError, ValueError):
+                    pass
+            # Behind a switch, the routers on the same segment are what matters (e.g. the default gateway).
+            # The other hosts are left out so a big segment does not grow every host's prompt.
+            if peer.node.node_type in L2_NODE_TYPES and node.node_type not in L2_NODE_TYPES:
+                gateways = [
+                    self._address(other)
+                    for other in self.segments.get(port, [])
+                    if other is not port and other.node.node_type in GATEWAY_NODE_TYPES
+                ]
+                if gateways:
+                    port_view["gateways"] = gateways
+            ports.append(port_view)
+            neighbour = {"device": peer.node.name, "node_type": peer.node.node_type}
+            if neighbour not in neighbours:
+                neighbours.append(neighbour)
+        return {
+            "device": device_name,
+            "node_type": node.node_type,
+            "connected_ports": ports,
+            "unused_ports": [port.name for port in node.ports if port not in self.topology.peers],
+            "neighbours": neighbours,
+            "subnets": subnets,
+        }
+
+    def view_json(self, device_name: str) -> str:
+        return json.dumps(self.view(device_name))
+
@@ -0,0 +1,50 @@
+# Rolling conversation summaries for stage 1.
+#
+# Summaries are stored under a hash of the history prefix they cover. On a new turn only the
+# previous summary plus the exchanges after it are summarized, so the cost of a turn does not
+# grow with the length of the conversation; a history seen before is answered from the store.
+import hashlib
+import json
+from typing import Awaitable, Callable, List, Sequence, Tuple
+
+from api.app.cache import LRUCache
+
+Turn = Tuple[str, str]
+
+
+def prefix_hashes(chat_history: Sequence[Turn]) -> List[str]:
+    """hashes[i] identifies chat_history[:i] (hashes[0] is the empty history)."""
+    hashes = [hashlib.sha256(b"").hexdigest()]
+    for turn in chat_history:
+        hashes.append(hashlib.sha256((hashes[-1] + json.dumps(list(turn))).encode()).hexdigest())
+    return hashes
+
+
+class ConversationSummaries:
+    def __init__(self, maxsize: int = 4096):
+        self.summaries = LRUCache(maxsize=maxsize)
+
+    async def summarize(
+        self,
+        chat_history: Sequence[Turn],
+        summarize_all: Callable[[Sequence[Turn]], Awaitable[str]],
+        summarize_since: Callable[[str, Sequence[Turn]], Awaitable[str]],
+    ) -> str:
+        """Summary of `chat_history`, built from the longest prefix already summarized.
+
+        `summarize_all(history)` summarizes from scratch; `summarize_since(summary, turns)`
+        folds new turns into an existing summary.
+        """
+        hashes = prefix_hashes(chat_history)
+        summary = self.summaries.get(hashes[-1])
+        if summary is not None:
+            return summary
+        for known in range(len(chat_history) - 1, 0, -1):
+            previous = self.summaries.get(hashes[known])
+            if previous is not None:
+                summary = await summarize_since(previous, chat_history[known:])
+                break
+        else:
+            summary = await summarize_all(chat_history)
+        self.summaries.set(hashes[-1], summary)
+        return summary
@@ -0,0 +1,170 @@
+# The GNS3 topology sent by the web UI, parsed once into an indexed model.
+#
+# A topology looks like {"node_info": [...], "link_info": [...]}. Nodes carry their ports,
+# links name their two ends by node_id and port_number. Dynamips routers report several
+# ports with the same port_number (the adapter number is not sent), so link ends are matched
+# to ports in order: the first link using port_number 0 of R1 gets R1's first such port, the
+# next one gets the second, and so on.
+#
+# Every stage used to take the JSON string (or the dict it parsed again) and scan node_info and
+# link_info for each lookup. `load_topology` now builds a Topology once: compact node, port and
+# link records, indexes by node_id and name, port-to-port adjacency, and a canonical JSON form
+# (for prompts) with a content hash (for cache keys), both computed on first use. A Topology is
+# never modified after it is built, so one instance is shared by every stage of a request and,
+# through the parse cache, by requests that send the same topology.
+import hashlib
+import json
+from functools import lru_cache
+from typing import Dict, List, Optional, Union
+
+# Node types that forward frames without taking part in IP addressing.
+L2_NODE_TYPES = {"ethernet_switch", "ethernet_hub"}
+
+
+def node_name(node: dict) -> str:
+    return node.get("name") or node.get("node_name")
+
+
+class Port:
+    __slots__ = ("node", "index", "name", "port_number", "adapter_number", "data")
+
+    def __init__(self, node: "Node", index: int, data: dict):
+        self.node = node
+        self.index = index
+        self.name = data.get("name")
+        self.port_number = data.get("port_number")
+        self.adapter_number = data.get("adapter_number")
+        self.data = data
+
+    def __repr__(self) -> str:
+        return f"Port({self.node.name} {self.name})"
+
+
+class Node:
+    __slots__ = ("node_id", "name", "node_type", "ports", "data")
+
+    def __init__(self, data: dict):
+        self.node_id = data["node_id"]
+        self.name = node_name(data)
+        self.node_type = data.get("node_type")
+        self.ports = tuple(Port(self, index, port) for index, port in enumerate(data.get("ports", [])))
+        self.data = data
+
+    def __repr__(self) -> str:
+        return f"Node({self.name})"
+
+
+class Link:
+    __slots__ = ("link_id", "ends", "data")
+
+    def __init__(self, data: dict, ends: tuple):
+        self.link_id = data.get("link_id")
+        self.ends = ends  # the ports of the ends that resolved to a known node
+        self.data = data
+
+
+class Topology:
+    __slots__ = ("data", "nodes", "links", "by_id", "by_name", "peers", "_json", "_hash")
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.nodes = tuple(Node(node) for node in data.get("node_info", []))
+        self.by_id: Dict[str, Node] = {node.node_id: node for node in self.nodes}
+        self.by_name: Dict[str, Node] = {node.name: node for node in self.nodes}
+
+        numbered: Dict[str, Dict[object, List[Port]]] = {}  # node_id -> port_number -> ports, built on demand
+        used = set()
+        links = []
+        for link in data.get("link_info", []):
+            ends = []
+            for end in link["nodes"]:
+                node = self.by_id.get(end["node_id"])
+                if node is None:
+                    continue
+                ports = numbered.get(node.node_id)
+                if ports is None:
+                    ports = numbered[node.node_id] = {}
+                    for port in node.ports:
+                        ports.setdefault(port.port_number, []).append(port)
+                port = _claim_port(ports.get(end.get("port_number"), ()), end, used)
+                if port is not None:
+                    ends.append(port)
+            links.append(Link(link, tuple(ends)))
+        self.links = tuple(links)
+
+        # Port -> the port at the other end of its link (links with two resolved ends only).
+        self.peers: Dict[Port, Port] = {}
+        for link in self.links:
+            if len(link.ends) == 2:
+                a, b = link.ends
+                self.peers[a] = b
+                self.peers[b] = a
+        self._json: Optional[str] = None
+        self._hash: Optional[str] = None
+
+    @property
+    def json(self) -> str:
+        """Canonical JSON (sorted keys, no whitespace): the same topology always reads the same."""
+        if self._json is None:
+            self._json = json.dumps(self.data, sort_keys=True, separators=(",", ":"))
+        return self._json
+
+    @property
+    def hash(self) -> str:
+        """sha256 of the canonical JSON."""
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.json.encode()).hexdigest()
+        return self._hash
+
+    def peer(self, port: Port) -> Optional[Port]:
+        return self.peers.get(port)
+
+    def port(self, device: str, port: str) -> Optional[Port]:
+        node = self.by_name.get(device)
+        return next((candidate for candidate in node.ports if candidate.name == port), None) if node else None
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Topology) and (other is self or other.hash == self.hash)
+
+    def __hash__(self) -> int:
+        return hash(self.hash)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+def _claim_port(ports: List[Port], end: dict, used: set) -> Optional[Port]:
+    """The first port not used by an earlier link among those with the end's port_number (and adapter)."""
+    adapter = end.get("adapter_number", _ANY)
+    first = None
+    for port in ports:
+        if adapter is not _ANY and port.adapter_number != adapter:
+            continue
+        if port not in used:
+            used.add(port)
+            return port
+        if first is None:
+            first = port
+    return first
+
+
+_ANY = object()
+
+
+@lru_cache(maxsize=64)
+def _parse(text: str) -> Topology:
+    return Topology(json.loads(text))
+
+
+def load_topology(topology: Union[str, dict, Topology]) -> Topology:
+    """The Topology of a JSON string, a parsed JSON object, or an existing Topology (returned as is)."""
+    if isinstance(topology, Topology):
+        return topology
+    if isinstance(topology, str):
+        return _parse(topology)
+    return Topology(topology)
+
+
+def topology_json(topology: Union[str, dict, Topology]) -> str:
+    """The canonical JSON of a topology, for prompts."""
+    return load_topology(topology).json
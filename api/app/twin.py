@@ -0,0 +1,405 @@
+# /v5/apply: configure the GNS3 lab (the network digital twin) with the generated commands, then
+# verify it.
+#
+# The API used to stop at the generated text: pushing it to the lab and checking reachability was
+# done by hand, one console after the other. Here every device's command is typed into its node's
+# telnet console concurrently, then the probes run concurrently too: a ping between each pair of
+# devices the question names (or the pairs given in the request) and `show ip route` on every
+# router that was configured. Each device and probe comes back with its status, its console output
+# and how long it took.
+#
+# The node consoles come from the GNS3 REST API (GET /v2/projects/{project_id}/nodes). They are
+# driven through a ConsolePool: at most SWITCH_APPLY_SESSIONS sessions at once, one at a time per
+# console (a console is a serial line), and sessions are kept open for the next request. Every
+# device and every probe has its own timeout, which covers the console work but not the wait for
+# a session.
+import asyncio
+import ipaddress
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from itertools import combinations
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from api.app import config, metrics
+from api.app.intent import mentioned_devices
+from api.app.topology import load_topology
+from api.app.utils import ApplyRequest
+from api.app.validation import IOS_NODE_TYPES, VPCS_NODE_TYPES
+
+# Telnet (RFC 854) bytes the consoles send to negotiate options.
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+ECHO, SUPPRESS_GO_AHEAD = 1, 3
+
+# A prompt at the end of the output ("R1>", "R1#", "R1(config-if)#", "PC1> ").
+_PROMPT = re.compile(r"(?:^|[\r\n])[\w.\-]+(?:\([\w\-]+\))?[>#] ?$")
+# An IOS configuration mode ("R1(config)#", "R1(config-if)#"), where pings and show commands are refused.
+_CONFIG_MODE = re.compile(r"\([\w\-]+\)#$")
+# Questions the console asks on the way ("Destination filename [startup-config]?", "[confirm]",
+# "Press RETURN to get started." after an exit from the exec mode): the default answer is fine.
+_QUESTION = re.compile(r"(?:\[[^\]\r\n]*\]\?|\[confirm\]|Press RETURN to get started\.?)\s*$", re.IGNORECASE)
+_MORE = re.compile(r"--\s*More\s*--\s*$", re.IGNORECASE)
+_PASSWORD = re.compile(r"Password:\s*$", re.IGNORECASE)
+# Lines of the output that say a command was refused (IOS "% Invalid input ...", VPCS "Bad command ...").
+_CLI_ERROR = re.compile(r"^\s*(?:%\s*(?:Invalid|Incomplete|Ambiguous|Unknown|Unrecognized|Bad).*|(?:Bad|Invalid|Unknown) command.*)$", re.IGNORECASE | re.MULTILINE)
+
+# The addresses a command gives its device (IOS "ip address A M", VPCS "ip A/M G" or "ip A M G").
+_IOS_ADDRESS = re.compile(r"^\s*ip\s+address\s+(\d+\.\d+\.\d+\.\d+)\s", re.IGNORECASE | re.MULTILINE)
+_VPCS_ADDRESS = re.compile(r"^\s*ip\s+(\d+\.\d+\.\d+\.\d+)(?:\s|/|$)", re.IGNORECASE | re.MULTILINE)
+
+PING_COUNT = 3
+PING_COMMANDS = { "vpcs": "ping {address} -c {count}", "ios": "ping {address} repeat {count}" }
+_PING_REPLY = re.compile(r"bytes from|Success rate is [1-9]\d* percent", re.IGNORECASE)
+
+Address = Tuple[str, int]
+
+
+class ConsoleError(Exception):
+    """The console could not be used (closed, or asking for a password)."""
+
+
+class ConsoleSession:
+    """One telnet session to a node console."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.awake = False  # a prompt has been seen since the session was opened
+        self.prompt = ""  # the last one
+        self._pending = b""  # a telnet command split across two reads
+
+    @classmethod
+    async def open(cls, host: str, port: int) -> "ConsoleSession":
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    @property
+    def closed(self) -> bool:
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def _negotiate(self, data: bytes) -> str:
+        """The text of `data`, with the telnet commands answered and removed.
+
+        The client accepts the server echoing and suppressing go-ahead, and refuses everything else.
+        """
+        data, self._pending = self._pending + data, b""
+        text, replies = bytearray(), bytearray()
+        index = 0
+        while index < len(data):
+            byte = data[index]
+            if byte != IAC:
+                text.append(byte)
+                index += 1
+                continue
+            if index + 1 >= len(data):
+                self._pending = data[index:]
+                break
+            verb = data[index + 1]
+            if verb == IAC:
+                text.append(IAC)
+                index += 2
+            elif verb in (DO, DONT, WILL, WONT):
+                if index + 2 >= len(data):
+                    self._pending = data[index:]
+                    break
+                option = data[index + 2]
+                if verb == DO:
+                    replies += bytes((IAC, WONT, option))
+                elif verb == WILL:
+                    replies += bytes((IAC, DO if option in (ECHO, SUPPRESS_GO_AHEAD) else DONT, option))
+                index += 3
+            elif verb == SB:
+                end = data.find(bytes((IAC, SE)), index)
+                if end < 0:
+                    self._pending = data[index:]
+                    break
+                index = end + 2
+            else:
+                index += 2
+        if replies:
+            self.writer.write(bytes(replies))
+        return text.decode("utf-8", errors="replace")
+
+    async def read_until_prompt(self) -> str:
+        """Console output up to the next prompt, answering the questions asked on the way."""
+        output, scanned = "", 0
+        while True:
+            data = await self.reader.read(4096)
+            if not data:
+                raise ConsoleError("the console closed the session")
+            output += self._negotiate(data)
+            tail = output[scanned:]
+            prompt = _PROMPT.search(tail)
+            if prompt:
+                self.awake, self.prompt = True, prompt.group().strip()
+                return output
+            if _PASSWORD.search(tail):
+                raise ConsoleError("the console asks for a password")
+            if _MORE.search(tail):
+                self.writer.write(b" ")
+                scanned = len(output)
+            elif _QUESTION.search(tail):
+                self.writer.write(b"\r\n")
+                scanned = len(output)
+
+    async def wake(self) -> str:
+        self.writer.write(b"\r\n")
+        return await self.read_until_prompt()
+
+    async def run(self, line: str) -> str:
+        """Type one line and return what the console printed until its next prompt."""
+        if not self.awake:
+            await self.wake()
+        self.writer.write(line.encode() + b"\r\n")
+        await self.writer.drain()
+        return await self.read_until_prompt()
+
+    @property
+    def in_config_mode(self) -> bool:
+        return bool(_CONFIG_MODE.search(self.prompt))
+
+    async def leave_config_mode(self) -> str:
+        """`end` when the last command left the console in a configuration mode (a command that does
+        not end with `end` or `exit`), so the next command runs in the exec mode."""
+        if not self.in_config_mode:
+            return ""
+        output = await self.run("end")
+        if self.in_config_mode:
+            raise ConsoleError(f"the console stays in configuration mode ({self.prompt})")
+        return output
+
+
+class ConsolePool:
+    """Up to `size` console sessions in use at once, one per console, reused between calls."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.opened = 0
+        self.reused = 0
+        self._slots = asyncio.Semaphore(size)
+        self._locks: Dict[Address, asyncio.Lock] = {}
+        self._idle: "OrderedDict[Address, ConsoleSession]" = OrderedDict()
+
+    @asynccontextmanager
+    async def session(self, address: Address):
+        lock = self._locks.setdefault(address, asyncio.Lock())
+        async with lock, self._slots:
+            session = self._idle.pop(address, None)
+            if session is not None and session.closed:
+                session = None
+            if session is None:
+                session = await ConsoleSession.open(*address)
+                self.opened += 1
+                metrics.CONSOLE_SESSIONS.inc(result="opened")
+            else:
+                self.reused += 1
+                metrics.CONSOLE_SESSIONS.inc(result="reused")
+            try:
+                yield session
+            except BaseException:
+                # Cut off in the middle of a command: the console state is unknown.
+                session.close()
+                raise
+            if session.in_config_mode:
+                # Not in the exec mode the next user expects.
+                session.close()
+                return
+            self._idle[address] = session
+            while len(self._idle) > self.size:
+                self._idle.popitem(last=False)[1].close()
+
+    def close(self) -> None:
+        while self._idle:
+            self._idle.popitem()[1].close()
+
+
+_pool: Optional[ConsolePool] = None
+_pool_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def console_pool() -> ConsolePool:
+    """The process-wide pool (one per event loop, like the executor's global semaphore)."""
+    global _pool, _pool_loop
+    loop = asyncio.get_running_loop()
+    if _pool is None or _pool_loop is not loop:
+        _pool = ConsolePool(config.APPLY_SESSIONS)
+        _pool_loop = loop
+    return _pool
+
+
+async def node_consoles(project_id: str, url: Optional[str] = None) -> Dict[str, dict]:
+    """Node name -> {"host", "port", "type", "status", "node_type"} of a GNS3 project."""
+    import httpx
+
+    url = (url or config.GNS3_URL).rstrip("/")
+    async with httpx.AsyncClient(timeout=config.APPLY_PROBE_TIMEOUT) as client:
+        response = await client.get(f"{url}/v2/projects/{project_id}/nodes")
+        response.raise_for_status()
+    server_host = urlparse(url).hostname or "127.0.0.1"
+    consoles = {}
+    for node in response.json():
+        host = node.get("console_host")
+        if not host or host in ("0.0.0.0", "::"):
+            host = server_host
+        consoles[node["name"]] = {
+            "host": host,
+            "port": node.get("console"),
+            "type": node.get("console_type"),
+            "status": node.get("status"),
+            "node_type": node.get("node_type"),
+        }
+    return consoles
+
+
+def cli_family(node_type: Optional[str]) -> Optional[str]:
+    if node_type in IOS_NODE_TYPES:
+        return "ios"
+    if node_type in VPCS_NODE_TYPES:
+        return "vpcs"
+    return None
+
+
+def addresses_of(response: dict, node_type: Optional[str]) -> List[str]:
+    """The addresses the command of `response` gives its device, in order."""
+    pattern = _VPCS_ADDRESS if cli_family(node_type) == "vpcs" else _IOS_ADDRESS
+    addresses = []
+    for address in pattern.findall(response.get("command") or ""):
+        try:
+            addresses.append(str(ipaddress.ip_address(address)))
+        except ValueError:
+            continue
+    return addresses
+
+
+def _unusable(console: Optional[dict]) -> Optional[Tuple[str, str]]:
+    """(status, error) when a node's console cannot be used."""
+    if console is None:
+        return "unknown", "the GNS3 project has no node of this name"
+    if console["type"] != "telnet" or not console["port"]:
+        return "unsupported", f"the node has no telnet console (console_type {console['type']})"
+    if console["status"] not in (None, "started"):
+        return "stopped", f"the node is {console['status']}"
+    return None
+
+
+async def _on_console(pool: ConsolePool, console: dict, lines: List[str], timeout: float) -> str:
+    async with pool.session((console["host"], console["port"])) as session:
+        async def type_lines():
+            output = ""
+            for line in lines:
+                output += await session.run(line)
+            return output + await session.leave_config_mode()
+        return await asyncio.wait_for(type_lines(), timeout)
+
+
+async def configure_device(pool: ConsolePool, response: dict, console: Optional[dict], timeout: float) -> dict:
+    """Type one device's command into its console: {"device", "status", "seconds", "output", "errors"}."""
+    result = { "device": response["device"], "status": "applied", "seconds": 0.0, "output": "", "errors": [] }
+    lines = [line.strip() for line in (response.get("command") or "").splitlines() if line.strip()]
+    started = time.perf_counter()
+    problem = _unusable(console) if lines else ("skipped", "")
+    if problem:
+        result["status"], error = problem
+        result["errors"] = [error] if error else []
+    else:
+        try:
+            result["output"] = await _on_console(pool, console, lines, timeout)
+            result["errors"] = [match.strip() for match in _CLI_ERROR.findall(result["output"])]
+            if result["errors"]:
+                result["status"] = "error"
+        except asyncio.TimeoutError:
+            result["status"], result["errors"] = "timeout", [f"not configured within {timeout:g}s"]
+        except (OSError, ConsoleError) as error:
+            result["status"], result["errors"] = "failed", [str(error) or type(error).__name__]
+    result["seconds"] = time.perf_counter() - started
+    metrics.APPLY_DEVICES.inc(status=result["status"])
+    return result
+
+
+async def run_probe(pool: ConsolePool, probe: dict, console: Optional[dict], timeout: float) -> dict:
+    """Run one probe ({"kind", "device", "command", ...}); it comes back with "success", "seconds", "output" and "error"."""
+    started = time.perf_counter()
+    probe = { "success": False, "output": "", "error": "", **probe }
+    problem = None if probe["error"] else _unusable(console)
+    if problem:
+        probe["error"] = problem[1]
+    elif not probe["error"]:
+        try:
+            probe["output"] = await _on_console(pool, console, [probe["command"]], timeout)
+            if probe["kind"] == "ping":
+                probe["success"] = bool(_PING_REPLY.search(probe["output"]))
+            else:
+                probe["success"] = not _CLI_ERROR.search(probe["output"])
+        except asyncio.TimeoutError:
+            probe["error"] = f"no answer within {timeout:g}s"
+        except (OSError, ConsoleError) as error:
+            probe["error"] = str(error) or type(error).__name__
+    probe["seconds"] = time.perf_counter() - started
+    metrics.APPLY_PROBES.inc(kind=probe["kind"], result="success" if probe["success"] else "failure")
+    return probe
+
+
+def plan_probes(request: ApplyRequest, topology, devices: List[dict]) -> List[dict]:
+    """Pings between the devices of the question (or `request.probes`) and `show ip route` on the configured routers."""
+    node_types = { node.name: node.node_type for node in topology.nodes }
+    addresses = { response.device: addresses_of(response.dict(), node_types.get(response.device)) for response in request.output }
+    if request.probes is not None:
+        pairs = [tuple(pair) for pair in request.probes]
+    else:
+        endpoints = [node.name for node in mentioned_devices(topology, request.question) if cli_family(node.node_type)]
+        pairs = list(combinations(endpoints, 2))
+
+    probes = []
+    for source, target in pairs:
+        family = cli_family(node_types.get(source))
+        probe = { "kind": "ping", "device": source, "target": target, "address": None, "command": "" }
+        if family is None:
+            probe["error"] = f"{source} cannot ping (node type {node_types.get(source)})"
+        elif not addresses.get(target):
+            probe["error"] = f"{target} has no address in the applied commands"
+        else:
+            probe["address"] = addresses[target][0]
+            probe["command"] = PING_COMMANDS[family].format(address=probe["address"], count=PING_COUNT)
+        probes.append(probe)
+    for result in devices:
+        if result["status"] == "applied" and cli_family(node_types.get(result["device"])) == "ios":
+            probes.append({ "kind": "route", "device": result["device"], "command": "show ip route" })
+    return probes
+
+
+async def apply(request: ApplyRequest, pool: Optional[ConsolePool] = None, gns3_url: Optional[str] = None) -> dict:
+    """Configure the lab of `request.project_id` with `request.output`, then verify it.
+
+    Returns {"devices": [...], "probes": [...], "timings": {"consoles", "configure", "verify", "total"}}.
+    """
+    pool = pool or console_pool()
+    device_timeout = request.device_timeout or config.APPLY_DEVICE_TIMEOUT
+    probe_timeout = request.probe_timeout or config.APPLY_PROBE_TIMEOUT
+    started = time.perf_counter()
+    timings = {}
+
+    with metrics.timed("v5", "consoles"):
+        consoles = await node_consoles(request.project_id, gns3_url)
+    timings["consoles"] = time.perf_counter() - started
+
+    with metrics.timed("v5", "configure"):
+        devices = await asyncio.gather(*(
+            configure_device(pool, response.dict(), consoles.get(response.device), device_timeout)
+            for response in request.output
+        ))
+    timings["configure"] = time.perf_counter() - started - timings["consoles"]
+
+    verify_started = time.perf_counter()
+    with metrics.timed("v5", "verify"):
+        probes = await asyncio.gather(*(
+            run_probe(pool, probe, consoles.get(probe["device"]), probe_timeout)
+            for probe in plan_probes(request, load_topology(request.topology), devices)
+        ))
+    timings["verify"] = time.perf_counter() - verify_started
+    timings["total"] = time.perf_counter() - started
+    return { "devices": devices, "probes": probes, "timings": timings }
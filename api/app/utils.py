@@ -1,6 +1,11 @@
-from typing import List, Tuple
+import json
+from typing import Any, List, Optional, Tuple, Union
 from langserve.pydantic_v1 import BaseModel, Field
+from langchain_core.exceptions import OutputParserException
 from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.outputs import Generation
+
+from api.app import metrics
 
 # User input
 class ChatRequest(BaseModel):
@@ -9,7 +14,7 @@ class ChatRequest(BaseModel):
         ...,
         extra={"widget": {"type": "chat", "input": "question"}},
     )
-    topology: str
+    topology: Union[str, dict] = Field(..., description="The GNS3 topology, as a JSON string or object.")
     question: str
 
 class ChatRequestWrapper(BaseModel):
@@ -23,6 +28,39 @@ class ChatRequestWrapper(BaseModel):
         description="Additional keyword arguments for the chain.",
     )
 
+class ChatBatchRequestWrapper(BaseModel):
+    inputs: List[ChatRequest]
+    config: Union[dict, List[dict]] = Field(
+        {},
+        description="Configuration for every input, or a list with one configuration per input.",
+    )
+    kwargs: dict = Field(
+        {},
+        description="Additional keyword arguments for the chain.",
+    )
+
+    def configs(self) -> List[dict]:
+        if isinstance(self.config, list):
+            return self.config
+        return [self.config] * len(self.inputs)
+
+def format_chat_history(chat_history: List[Tuple[str, str]]) -> str:
+    """Format chat history into a string (in linear time, whatever its length)."""
+    if not chat_history:
+        return "None"
+    return "".join(f"\nHuman: {human}\nAssistant: {ai}" for human, ai in chat_history)
+
+class CountingJsonOutputParser(JsonOutputParser):
+    """JsonOutputParser that counts the outputs it cannot parse in the metrics, under `name`."""
+    name: str
+
+    def parse_result(self, result: List[Generation], *, partial: bool = False) -> Any:
+        try:
+            return super().parse_result(result, partial=partial)
+        except OutputParserException:
+            metrics.PARSER_FAILURES.inc(parser=self.name)
+            raise
+
 # User output
 class ChatResponse(BaseModel):
     """Chat response from the bot."""
@@ -32,7 +70,18 @@ class ChatResponse(BaseModel):
     comment: str = Field(description="Description of the command.")
 
 # Set up a parser + inject instructions into the prompt template.
-output_parser = JsonOutputParser(pydantic_object=ChatResponse)
+output_parser = CountingJsonOutputParser(name="output", pydantic_object=ChatResponse)
+
+# /v5/apply input: the answers of /v5/invoke, pushed to the nodes of a GNS3 project.
+class ApplyRequest(BaseModel):
+    """Configure the lab with the generated commands, then verify it."""
+    project_id: str = Field(..., description="The GNS3 project of the lab.")
+    topology: Union[str, dict] = Field(..., description="The GNS3 topology the commands were generated for.")
+    question: str = Field("", description="The request; the devices it names are pinged from each other.")
+    output: List[ChatResponse] = Field(..., description="The output of /v5/invoke.")
+    probes: Optional[List[Tuple[str, str]]] = Field(None, description="(source, target) devices to ping instead of the ones the question names.")
+    device_timeout: Optional[float] = Field(None, description="Seconds allowed to configure one device.")
+    probe_timeout: Optional[float] = Field(None, description="Seconds allowed for one probe.")
 
 class PortIdentification(BaseModel):
     """Port identification."""
@@ -45,7 +94,62 @@ class PortIdentificationWrapper(BaseModel):
     port_info: List[PortIdentification] = Field(description="The result of port identification.")
 
 # Set up a parser + inject instructions into the prompt template.
-port_identification_parser = JsonOutputParser(pydantic_object=PortIdentificationWrapper)
+port_identification_parser = CountingJsonOutputParser(name="port_identification", pydantic_object=PortIdentificationWrapper)
+
+class PortInfoScanner:
+    """Picks the entries of the "port_info" array out of a JSON answer while it streams in.
+
+    `feed(chunk)` returns the entries completed by that chunk. The whole answer is still to be
+    parsed with port_identification_parser once it is in: this only lets work start earlier.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.pos = -1  # where scanning resumes, once past "port_info": [
+        self.depth = 0
+        self.start = 0
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+
+    def feed(self, chunk: str) -> List[dict]:
+        self.text += chunk
+        if self.pos < 0:
+            key = self.text.find('"port_info"')
+            bracket = self.text.find("[", key) if key >= 0 else -1
+            if bracket < 0:
+                return []
+            self.pos = bracket + 1
+        entries = []
+        text = self.text
+        while self.pos < len(text) and not self.done:
+            char = text[self.pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                if self.depth == 0:
+                    self.start = self.pos
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        entry = json.loads(text[self.start:self.pos + 1])
+                    except ValueError:
+                        entry = None
+                    if isinstance(entry, dict):
+                        entries.append(entry)
+            elif char == "]" and self.depth == 0:
+                self.done = True
+            self.pos += 1
+        return entries
 
 class NetworkTopology(BaseModel):
     """Network topology."""
@@ -58,4 +162,4 @@ class NetworkTopology(BaseModel):
         description="The information of each link.",
     )
 
-network_topology_parser = JsonOutputParser(pydantic_object=NetworkTopology)
\ No newline at end of file
+network_topology_parser = CountingJsonOutputParser(name="network_topology", pydantic_object=NetworkTopology)
\ No newline at end of file
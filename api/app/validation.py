@@ -0,0 +1,217 @@
+# Local checks of the stage-4 answers of /v4 and /v5, and targeted repair of the broken ones.
+#
+# One device whose output the JSON parser could not read used to fail the whole request, and a
+# malformed command (an interface the node does not have, an address outside the port's subnet,
+# an interface never brought up) went back to the client as is, so the only way out was to send
+# everything again. Every LLM answer is now checked against the device's ports and the IP plan.
+# A device that fails is asked again, alone, with its previous output and the list of problems
+# (REPAIR_TEMPLATE, in JSON mode), up to SWITCH_REPAIR_ATTEMPTS times; a device that still fails
+# comes back with an empty command and its problems instead of failing the request.
+import ipaddress
+import json
+import re
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from langchain_core.exceptions import OutputParserException
+
+from api.app import config, metrics
+from api.app.slicing import TopologySlicer
+from api.app.topology import Node, Port
+
+# Node types whose commands are IOS, and VPCS hosts.
+IOS_NODE_TYPES = {"dynamips", "iou"}
+VPCS_NODE_TYPES = {"vpcs"}
+
+REPAIR_TEMPLATE = """You are a network operator. Your previous answer for a device could not be used.
+Answer again for that device only and fix every problem listed below. Use only the interface names of the device view, the ip address and subnet mask assigned to each port there, and "no shutdown" on every interface you give an address.
+
+{format_instructions}
+
+- Request: {request}
+- device view: {device_view}
+- Device: {device_name}
+- Previous answer: {previous_output}
+- Problems: {problems}"""
+
+FAILED_COMMENT = "No valid command could be generated: "
+
+# (kind, message): kind is what the metrics count, message what the repair prompt and the client see.
+Problem = Tuple[str, str]
+
+_INTERFACE = re.compile(r"^(?:interface|int)\s+(?!range\b)(\S+(?:\s+\S+)?)$", re.IGNORECASE)
+_IP_ADDRESS = re.compile(r"^ip\s+address\s+(\S+)\s+(\S+)", re.IGNORECASE)
+_NO_SHUTDOWN = re.compile(r"^no\s+shut(?:down)?$", re.IGNORECASE)
+_SHUTDOWN = re.compile(r"^shut(?:down)?$", re.IGNORECASE)
+_VPCS_IP = re.compile(r"^ip\s+(\d+\.\d+\.\d+\.\d+)(?:\s*/\s*(\d+)|\s+(\d+\.\d+\.\d+\.\d+))?(?:\s+(\d+\.\d+\.\d+\.\d+))?$", re.IGNORECASE)
+_PORT_NAME = re.compile(r"^([a-z-]+)\s*([\d/:]+)(?:\.\d+)?$", re.IGNORECASE)
+
+
+def find_port(node: Node, name: str) -> Optional[Port]:
+    """The port of `node` that an IOS interface name designates, abbreviations included ("Gi1/0", "f0/0")."""
+    wanted = _PORT_NAME.match(name.strip())
+    if wanted is None:
+        return None
+    for port in node.ports:
+        if not port.name:
+            continue
+        if port.name.lower() == name.strip().lower():
+            return port
+        actual = _PORT_NAME.match(port.name)
+        if actual and actual.group(2) == wanted.group(2) and actual.group(1).lower().startswith(wanted.group(1).lower()):
+            return port
+    return None
+
+
+def _planned(slicer: TopologySlicer, port: Port) -> Optional[ipaddress.IPv4Interface]:
+    entry = slicer.addresses.get(port)
+    try:
+        return ipaddress.ip_interface(f"{entry['ip']}/{entry['subnet']}")
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _check_address(problems: List[Problem], slicer: TopologySlicer, port: Port, address: str, mask: str) -> None:
+    try:
+        given = ipaddress.ip_interface(f"{address}/{mask}")
+    except ValueError:
+        problems.append(("address", f"'{address} {mask}' on {port.name} is not a valid ip address and subnet mask"))
+        return
+    planned = _planned(slicer, port)
+    if planned is None:
+        return
+    if given.ip not in planned.network or given.network != planned.network:
+        problems.append(("address", f"{given.ip}/{given.network.prefixlen} on {port.name} is outside its subnet {planned.network} (its address is {planned.ip} {planned.netmask})"))
+    elif given.ip in (planned.network.network_address, planned.network.broadcast_address):
+        problems.append(("address", f"{given.ip} on {port.name} is the network or broadcast address of {planned.network}"))
+
+
+def _check_ios(problems: List[Problem], node: Node, slicer: TopologySlicer, lines: List[str]) -> None:
+    port, addressed, up = None, False, False
+
+    def close():
+        if port is not None and addressed and not up:
+            problems.append(("shutdown", f"{port.name} gets an ip address but is never brought up with 'no shutdown'"))
+
+    for line in lines:
+        interface = _INTERFACE.match(line)
+        if interface:
+            close()
+            port, addressed, up = find_port(node, interface.group(1)), False, False
+            if port is None:
+                names = ", ".join(candidate.name for candidate in node.ports if candidate.name)
+                problems.append(("interface", f"{node.name} has no interface '{interface.group(1)}' (its ports are {names})"))
+            continue
+        if port is None:
+            continue
+        address = _IP_ADDRESS.match(line)
+        if address:
+            addressed = True
+            _check_address(problems, slicer, port, address.group(1), address.group(2))
+        elif _NO_SHUTDOWN.match(line):
+            up = True
+        elif _SHUTDOWN.match(line):
+            up = False
+        elif not line.lower().startswith(("ip ", "no ip ", "description", "duplex", "speed", "encapsulation", "mtu", "bandwidth")):
+            # Anything else (exit, end, router ..., another mode) leaves the interface.
+            close()
+            port = None
+    close()
+
+
+def _check_vpcs(problems: List[Problem], node: Node, slicer: TopologySlicer, lines: List[str]) -> None:
+    connected = [port for port in node.ports if slicer.topology.peer(port) is not None]
+    port = connected[0] if connected else (node.ports[0] if node.ports else None)
+    for line in lines:
+        match = _VPCS_IP.match(line)
+        if match is None or port is None:
+            continue
+        address, prefix, mask, gateway = match.groups()
+        _check_address(problems, slicer, port, address, prefix or mask or "32")
+        planned = _planned(slicer, port)
+        if gateway and planned is not None:
+            if ipaddress.ip_address(gateway) not in planned.network:
+                problems.append(("gateway", f"the gateway {gateway} of {node.name} is outside its subnet {planned.network}"))
+            elif gateway == address:
+                problems.append(("gateway", f"the gateway of {node.name} is its own address {address}"))
+
+
+def check_response(response, node: Node, slicer: TopologySlicer) -> List[Problem]:
+    """Problems of one stage-4 answer for `node` (an empty list when it can be used)."""
+    if not isinstance(response, dict):
+        return [("schema", "the answer is not a JSON object with the keys device, command and comment")]
+    problems: List[Problem] = []
+    for key in ("device", "command", "comment"):
+        if not isinstance(response.get(key), str):
+            problems.append(("schema", f"the key '{key}' is missing or is not a string"))
+    if problems:
+        return problems
+    lines = [line.strip() for line in response["command"].splitlines() if line.strip()]
+    if node.node_type in IOS_NODE_TYPES:
+        _check_ios(problems, node, slicer, lines)
+    elif node.node_type in VPCS_NODE_TYPES:
+        _check_vpcs(problems, node, slicer, lines)
+    return problems
+
+
+def failed_response(device: str, problems: List[Problem]) -> dict:
+    return { "device": device, "command": "", "comment": FAILED_COMMENT + "; ".join(message for _, message in problems) + "." }
+
+
+def _parse_failure(error: OutputParserException) -> str:
+    """The raw LLM output of a parser error."""
+    output = error.llm_output or str(error)
+    return output[len("Invalid json output: "):] if output.startswith("Invalid json output: ") else output
+
+
+async def checked(
+    version: str,
+    node: Node,
+    slicer: TopologySlicer,
+    generate: Callable[[], Awaitable[dict]],
+    repair: Callable[[str, str], Awaitable[dict]],
+    attempts: Optional[int] = None,
+) -> Tuple[dict, dict]:
+    """(response, report) of a device: `generate()`, then `repair(previous_output, problems)` while it fails.
+
+    The report is {"repair_calls": n, "repaired": bool} or, for a device that is still invalid after
+    its repairs, {"repair_calls": n, "invalid": True, "problems": [messages]}.
+    """
+    attempts = config.REPAIR_ATTEMPTS if attempts is None else attempts
+
+    async def attempt(call) -> Tuple[Optional[dict], str, List[Problem]]:
+        try:
+            response = await call()
+            output, problems = json.dumps(response, default=str), check_response(response, node, slicer)
+        except OutputParserException as error:
+            response, output = None, _parse_failure(error)
+            problems = [("json", "the answer is not valid JSON in the requested format")]
+        for kind, _ in problems:
+            metrics.DEVICE_PROBLEMS.inc(version=version, kind=kind)
+        return response, output, problems
+
+    response, output, problems = await attempt(generate)
+    broken, calls = bool(problems), 0
+    while problems and calls < attempts:
+        calls += 1
+        metrics.REPAIR_CALLS.inc(version=version)
+        hints = "\n".join(f"- {message}" for _, message in problems)
+        response, output, problems = await attempt(lambda: repair(output, hints))
+    if problems:
+        metrics.DEVICE_CHECKS.inc(version=version, result="invalid")
+        return failed_response(node.name, problems), { "repair_calls": calls, "invalid": True, "problems": [message for _, message in problems] }
+    metrics.DEVICE_CHECKS.inc(version=version, result="repaired" if broken else "valid")
+    if response["device"] != node.name:
+        # Only the name is off (e.g. "r1" or ""): no need to ask again.
+        response = { **response, "device": node.name }
+    return response, { "repair_calls": calls, "repaired": broken }
+
+
+def event_fields(report: dict) -> dict:
+    """What a device event says about its validation: "repaired": True, or "invalid": True and "problems"."""
+    return { key: value for key, value in report.items() if key != "repair_calls" and value }
+
+
+def record_saved_calls(version: str, llm_calls: int, repair_calls: int) -> None:
+    """Count the stage-4 calls a retry of the whole request would have made, less the targeted repairs."""
+    if repair_calls:
+        metrics.REPAIR_CALLS_SAVED.inc(max(0, llm_calls - repair_calls), version=version)
@@ -0,0 +1,111 @@
+# Compressed, memory-mapped vector store for the configuration guides.
+#
+# A store is a directory with three files:
+#   index.faiss  - IVF with 8-bit scalar quantization (default, ~4x smaller than flat), IVF-PQ
+#                  (~16x smaller, lower recall), HNSW with 8-bit scalar quantization, or flat
+#   docs.sqlite  - the chunks (text + metadata), looked up by their position in the index
+#   meta.json    - how the store was built (embedding model and backend, index kind, dimension, size)
+# The index is opened with faiss' mmap flag and the documents are read from SQLite, so several
+# uvicorn workers share the same pages through the OS page cache instead of each holding a copy.
+# Build one with `python -m api.app.ingest`.
+import json
+import math
+import os
+import sqlite3
+import threading
+from typing import List, Optional, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+INDEX_KINDS = ("ivfsq8", "ivfpq", "hnsw", "flat")
+
+
+class MmapVectorStore:
+    def __init__(self, path: str, index, meta: dict):
+        self.path = path
+        self.index = index
+        self.meta = meta
+        self._local = threading.local()
+
+    @classmethod
+    def open(cls, path: str, nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> "MmapVectorStore":
+        import faiss
+
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        index = faiss.read_index(os.path.join(path, "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        if nprobe is not None and hasattr(index, "nprobe"):
+            index.nprobe = nprobe
+        if ef_search is not None and hasattr(index, "hnsw"):
+            index.hnsw.efSearch = ef_search
+        return cls(path, index, meta)
+
+    def _docs(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{os.path.join(self.path, 'docs.sqlite')}?mode=ro", uri=True)
+            self._local.conn = conn
+        return conn
+
+    def search(self, vectors: np.ndarray, k: int) -> List[List[int]]:
+        """Ids of the `k` nearest chunks for each (normalized) query vector."""
+        _, indices = self.index.search(np.ascontiguousarray(vectors, dtype=np.float32), k)
+        return [[int(i) for i in row if i != -1] for row in indices]
+
+    def documents(self, ids: Sequence[int]) -> List[Document]:
+        if not ids:
+            return []
+        rows = self._docs().execute(
+            f"SELECT id, page_content, metadata FROM docs WHERE id IN ({','.join('?' * len(ids))})", list(ids)
+        ).fetchall()
+        found = { id: Document(page_content=text, metadata=json.loads(metadata)) for id, text, metadata in rows }
+        return [found[id] for id in ids if id in found]
+
+
+def _build_index(vectors: np.ndarray, kind: str):
+    import faiss
+
+    count, dim = vectors.shape
+    if kind == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif kind == "hnsw":
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+    elif kind in ("ivfsq8", "ivfpq"):
+        # ~4*sqrt(n) inverted lists, with enough points to train each centroid.
+        nlist = max(1, min(int(4 * math.sqrt(count)), count // 39))
+        quantizer = faiss.IndexFlatIP(dim)
+        if kind == "ivfsq8":
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        else:
+            # dim/4 sub-quantizers (192 bytes per 768-d vector), fewer bits for tiny corpora.
+            m = next(m for m in (dim // 4, dim // 2, dim) if m and dim % m == 0)
+            nbits = max(4, min(8, int(math.log2(max(count, 2))) - 1))
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, m, nbits, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+    else:
+        raise ValueError(f"unknown index kind {kind!r}, expected one of {INDEX_KINDS}")
+    index.add(vectors)
+    return index
+
+
+def build_store(path: str, documents: Sequence[Document], vectors: np.ndarray, kind: str = "ivfsq8", embedding_model: str = "", embedding_backend: str = "") -> None:
+    """Write `documents` and their (normalized) embedding `vectors` as a store at `path`."""
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    os.makedirs(path, exist_ok=True)
+    faiss.write_index(_build_index(vectors, kind), os.path.join(path, "index.faiss"))
+
+    docs_path = os.path.join(path, "docs.sqlite")
+    if os.path.exists(docs_path):
+        os.remove(docs_path)
+    with sqlite3.connect(docs_path) as conn:
+        conn.execute("CREATE TABLE docs (id INTEGER PRIMARY KEY, page_content TEXT NOT NULL, metadata TEXT NOT NULL)")
+        conn.executemany(
+            "INSERT INTO docs (id, page_content, metadata) VALUES (?, ?, ?)",
+            ((i, doc.page_content, json.dumps(doc.metadata)) for i, doc in enumerate(documents)),
+        )
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({ "kind": kind, "dim": int(vectors.shape[1]), "count": len(documents), "embedding_model": embedding_model, "embedding_backend": embedding_backend }, f)
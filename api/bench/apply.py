@@ -0,0 +1,80 @@
+# /v5/apply (api.app.twin) against the local GNS3 mock (api.bench.gns3_mock).
+#
+# A synthetic lab gets the commands the CLI templates render for a static-routing design (what
+# /v5 returns for it), typed into the mock consoles at --latency seconds per line, then pings
+# between the PCs the question names and `show ip route` on every router. For each console pool
+# size: the time to configure and to verify, device statuses, probes that succeeded and console
+# sessions opened. A pool of 1 is the one-console-after-the-other way of doing it by hand. The
+# last row runs again on a warm pool, and --stuck nodes whose console never answers show the
+# per-device timeout.
+#
+#   python -m api.bench.apply --size 50 --latency 0.02 --pools 1 4 16 64
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+from api.app.allocator import allocate_ips
+from api.app.cli_templates import CliRenderer, design_spec
+from api.app.slicing import TopologySlicer
+from api.app.topology import load_topology
+from api.app.twin import ConsolePool, apply
+from api.app.utils import ApplyRequest
+from api.bench.gns3_mock import MockGns3
+from api.bench.topologies import generate_topology
+
+DESIGN = "Assign addresses to every connected port and add static routes on the routers."
+
+
+def make_request(topology: dict, project_id: str, pcs: int, device_timeout: float) -> ApplyRequest:
+    parsed = load_topology(json.dumps(topology))
+    renderer = CliRenderer(TopologySlicer(parsed, allocate_ips(parsed)), design_spec(DESIGN))
+    output = [renderer.render(node.name) for node in parsed.nodes]
+    question = "make " + ", ".join(f"PC{i + 1}" for i in range(pcs)) + " reach each other."
+    return ApplyRequest(project_id=project_id, topology=topology, question=question, output=output, device_timeout=device_timeout)
+
+
+async def run_once(lab: MockGns3, request: ApplyRequest, pool: ConsolePool, label: str) -> None:
+    opened = pool.opened
+    started = time.perf_counter()
+    result = await apply(request, pool=pool, gns3_url=lab.url)
+    elapsed = time.perf_counter() - started
+    statuses = Counter(device["status"] for device in result["devices"])
+    pings = [probe for probe in result["probes"] if probe["kind"] == "ping"]
+    routes = [probe for probe in result["probes"] if probe["kind"] == "route"]
+    print(f"{label:>10} {result['timings']['configure']:>9.2f}s {result['timings']['verify']:>7.2f}s {elapsed:>7.2f}s "
+          f"{statuses['applied']:>7} {statuses['skipped']:>7} {statuses['timeout'] + statuses['failed'] + statuses['error']:>6} "
+          f"{sum(p['success'] for p in pings):>3}/{len(pings):<3} {sum(p['success'] for p in routes):>4}/{len(routes):<4} {pool.opened - opened:>8}")
+
+
+async def main(args):
+    topology = generate_topology(args.size)
+    print(f"{'pool':>10} {'configure':>10} {'verify':>8} {'total':>8} {'applied':>7} {'skipped':>7} {'failed':>6} {'pings':>7} {'routes':>9} {'sessions':>8}")
+    for size in args.pools:
+        lab = await MockGns3(topology, latency=args.latency).start()
+        request = make_request(topology, lab.project_id, args.pcs, args.device_timeout)
+        pool = ConsolePool(size)
+        await run_once(lab, request, pool, str(size))
+        if size == args.pools[-1]:
+            await run_once(lab, request, pool, f"{size} warm")
+        pool.close()
+        await lab.stop()
+    if args.stuck:
+        stuck = [f"R{i + 1}" for i in range(args.stuck)]
+        lab = await MockGns3(topology, latency=args.latency, stuck=stuck).start()
+        pool = ConsolePool(args.pools[-1])
+        await run_once(lab, make_request(topology, lab.project_id, args.pcs, args.device_timeout), pool, f"{args.stuck} stuck")
+        pool.close()
+        await lab.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/v5/apply against the GNS3 mock.")
+    parser.add_argument("--size", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per console line")
+    parser.add_argument("--pools", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--pcs", type=int, default=4, help="PCs named in the question (pinged pairwise)")
+    parser.add_argument("--stuck", type=int, default=2, help="routers whose console never answers (last run)")
+    parser.add_argument("--device-timeout", type=float, default=2.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,65 @@
+# /v5/batch against the same requests sent one by one.
+#
+# CI sends dozens of intent checks about one lab. The chains are swapped for fakes that take a
+# fixed time per call; the batch should make far fewer calls (shared summaries, designs and
+# device prompts) and finish well before N sequential invokes.
+#
+#   python -m api.bench.batch --requests 24 --size 20 --latency 0.1
+import argparse
+import asyncio
+import time
+
+from api.app.chains import chain_v4, chain_v5
+from api.app.utils import ChatRequest
+from api.bench.load_v5 import FakeStage, install_fakes
+from api.bench.topologies import generate_topology_json
+
+QUESTIONS = [
+    "connect PC1 to PC2.",
+    "make every PC reach every other PC.",
+    "configure OSPF area 0 on every router.",
+    "block telnet to the routers.",
+]
+# Every device goes to stage 4, so the batch has device prompts to share (see api.bench.pruning and
+# api.bench.cli_templates for what /v5 saves on top of that).
+CONFIG = { "configurable": { "ip_allocation": "graph", "device_pruning": False, "cli_templates": False } }
+HISTORY = [("connect PC1 to PC2.", "Device: PC1\nCommand: ip 192.168.0.1 /24\nComment: set up ip address")]
+
+
+def requests(count, topology):
+    return [
+        ChatRequest(chat_history=HISTORY if index % 2 else [], topology=topology, question=QUESTIONS[index % len(QUESTIONS)])
+        for index in range(count)
+    ]
+
+
+async def main(args):
+    stages = install_fakes(args.latency)
+    # Each question gets its own design, as it would from the LLM.
+    stages["second_step_chain"].output = lambda input: f"design for: {input['question']}"
+    chain_v5.second_step_chain = stages["second_step_chain"].runnable()
+    v4_devices = FakeStage(args.latency, {"device": "", "command": "", "comment": ""})
+    chain_v4.second_chain = v4_devices.runnable()
+    inputs = requests(args.requests, generate_topology_json(args.size))
+    counted = [stages[name] for name in ("first_step_chain", "second_step_chain", "fourth_step_chain")] + [v4_devices]
+
+    print(f"{'chain':>5} {'mode':>10} {'wall(s)':>8} {'req/s':>7} {'LLM calls':>10}")
+    for name, chain in (("v5", chain_v5), ("v4", chain_v4)):
+        for mode in ("sequential", "batch"):
+            calls = sum(stage.calls for stage in counted)
+            started = time.perf_counter()
+            if mode == "batch":
+                outputs = await chain.abatch(inputs, [CONFIG] * len(inputs))
+            else:
+                outputs = [await chain.invoke(input, CONFIG) for input in inputs]
+            elapsed = time.perf_counter() - started
+            assert len(outputs) == len(inputs) and all(len(output) == args.size for output in outputs)
+            print(f"{name:>5} {mode:>10} {elapsed:>8.2f} {len(inputs) / elapsed:>7.1f} {sum(stage.calls for stage in counted) - calls:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/v4 and /v5 batch vs. sequential invokes.")
+    parser.add_argument("--requests", type=int, default=24)
+    parser.add_argument("--size", type=int, default=20, help="nodes in the lab")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds per fake LLM call")
+    asyncio.run(main(parser.parse_args()))
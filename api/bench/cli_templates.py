@@ -0,0 +1,86 @@
+# Stage-4 devices rendered by the CLI templates (api.app.cli_templates) instead of the LLM.
+#
+# For DUMMY_INPUT_1 and synthetic labs, and a few kinds of design: how many devices the templates
+# render, how long rendering every device takes, and whether the static routes reach every subnet
+# from every router. Then /v5 runs end to end on a synthetic lab (fake stages sleeping --latency
+# seconds per call, pruning off) with the templates off and on: stage-4 calls and wall time.
+#
+#   python -m api.bench.cli_templates --sizes 50 200 --latency 0.2
+import argparse
+import asyncio
+import ipaddress
+import json
+import time
+
+from api.app.allocator import allocate_ips
+from api.app.chains import chain_v5
+from api.app.cli_templates import CliRenderer, design_spec
+from api.app.slicing import TopologySlicer
+from api.app.topology import load_topology
+from api.app.utils import ChatRequest
+from api.bench.load_v5 import install_fakes
+from api.bench.topologies import generate_topology
+
+DESIGNS = {
+    "addressing": "Assign an IP address and subnet mask to every connected port.",
+    "static": "Assign addresses to every connected port and add static routes on the routers.",
+    "ospf": "Run OSPF area 0 on every router and advertise the connected subnets.",
+    "acl": "Assign addresses and add an access list on R1 denying telnet from PC4.",
+    "vlan": "Put PC1 and PC2 in VLAN 10 on the switch.",
+}
+
+
+def routes_complete(renderer: CliRenderer) -> bool:
+    """Every router has a connected subnet or a static route for every subnet of the plan."""
+    subnets = {
+        ipaddress.ip_interface(f"{entry['ip']}/{entry['subnet']}").network
+        for entry in renderer.slicer.addresses.values()
+    }
+    routes = renderer.routes()
+    for router, entries in routes.items():
+        connected = {
+            ipaddress.ip_interface(f"{entry['ip']}/{entry['subnet']}").network
+            for port, entry in renderer.slicer.addresses.items() if port.node.name == router
+        }
+        if connected | {network for network, _ in entries} != subnets:
+            return False
+    return True
+
+
+def table(name: str, topology) -> None:
+    parsed = load_topology(topology)
+    slicer = TopologySlicer(parsed, allocate_ips(parsed))
+    for kind, design in DESIGNS.items():
+        started = time.perf_counter()
+        renderer = CliRenderer(slicer, design_spec(design, "connect PC1 to PC2."))
+        rendered = sum(renderer.render(node.name) is not None for node in parsed.nodes)
+        elapsed = (time.perf_counter() - started) * 1000
+        complete = routes_complete(renderer) if renderer.spec["routing"] == "static" else "-"
+        print(f"{name:>14} {kind:>10} {len(parsed):>7} {rendered:>8} {len(parsed) - rendered:>6} {elapsed:>8.2f}ms {complete!s:>8}")
+
+
+async def end_to_end(size: int, latency: float) -> None:
+    stages = install_fakes(latency)
+    stages["second_step_chain"].output = DESIGNS["static"]
+    input = ChatRequest(chat_history=[], topology=json.dumps(generate_topology(size)), question="connect PC1 to PC2.")
+    for templates in (False, True):
+        stages["fourth_step_chain"].calls = 0
+        started = time.perf_counter()
+        outputs = await chain_v5.invoke(input, { "configurable": { "ip_allocation": "graph", "device_pruning": False, "cli_templates": templates } })
+        print(f"synthetic-{size} end to end, templates {'on ' if templates else 'off'}: {len(outputs)} devices, "
+              f"{stages['fourth_step_chain'].calls} stage-4 calls, {time.perf_counter() - started:.2f}s")
+
+
+def main(args):
+    print(f"{'topology':>14} {'design':>10} {'devices':>7} {'rendered':>8} {'to LLM':>6} {'render':>10} {'routes ok':>8}")
+    table("DUMMY_INPUT_1", chain_v5.DUMMY_INPUT_1.topology)
+    for size in args.sizes:
+        table(f"synthetic-{size}", generate_topology(size))
+    asyncio.run(end_to_end(args.sizes[0], args.latency))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage-4 devices rendered by the CLI templates.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--latency", type=float, default=0.2)
+    main(parser.parse_args())
@@ -0,0 +1,121 @@
+# Embedding backends (api.app.embeddings) against the current fp32 PyTorch model.
+#
+#   batching - padded tokens the encoder runs over for a mix of short queries and guide chunks of
+#              every length, in fixed batches of arrival order against length batches under a
+#              token budget (runs offline: lengths only).
+#   backends - for each backend: load time, single-query latency (p50/p95), throughput over the
+#              corpus, and against the first backend (torch, fp32): cosine of the query vectors and
+#              recall@k of their top-k, searching the fp32 index ("existing store") and an index
+#              the backend embedded itself ("re-indexed"). A backend whose packages are not
+#              installed (torch, onnxruntime, optimum, transformers) is skipped.
+#
+#   python -m api.bench.embedding_backends --backends torch onnx onnx-int8 --threads 4 --guides guides/
+import argparse
+import random
+import statistics
+import time
+
+import numpy as np
+
+from api.bench.fakes import fake_corpus
+
+QUERIES = [
+    "how do I configure OSPF area 0 on a Cisco router", "set a default gateway on a VPCS host", "trunk a VLAN between two switches",
+    "static route to a remote subnet", "NAT overload for an inside network", "DHCP pool on IOS", "BGP neighbor in Junos",
+    "RIP version 2 on several interfaces", "access list that blocks telnet", "no shutdown on a GigabitEthernet interface",
+]
+
+
+def corpus(args) -> list:
+    if args.guides:
+        from api.app.ingest import load_documents
+        return [document.page_content for document in load_documents(args.guides, 1000, 100)][:args.corpus]
+    # Guide chunks run from a sentence to a full 1000-character chunk.
+    rng = random.Random(0)
+    return [" ".join([text] * rng.choice((1, 1, 2, 4, 8))) for text in fake_corpus(args.corpus)]
+
+
+def batching(texts, queries, args) -> None:
+    from api.app.embeddings import length_batches, padded_tokens
+    from api.app.tokens import count_tokens
+
+    rng = random.Random(1)
+    mixed = texts + queries * 4
+    rng.shuffle(mixed)
+    lengths = [min(512, count_tokens(text) + 2) for text in mixed]
+    fixed = [list(range(start, min(start + args.batch, len(mixed)))) for start in range(0, len(mixed), args.batch)]
+    print(f"{'batching':>22} {'batches':>8} {'tokens':>9} {'padded':>9} {'padding':>8}")
+    for name, batches in ((f"arrival order x{args.batch}", fixed), (f"length, {args.batch_tokens} tok", length_batches(lengths, args.batch_tokens))):
+        padded = padded_tokens(lengths, batches)
+        print(f"{name:>22} {len(batches):>8} {sum(lengths):>9} {padded:>9} {1 - sum(lengths) / padded:>8.0%}")
+
+
+def recall(reference: np.ndarray, found: np.ndarray) -> float:
+    return statistics.mean(len(set(a) & set(b)) / len(a) for a, b in zip(reference, found))
+
+
+def backends(texts, queries, args) -> None:
+    import faiss
+
+    from api.app import config
+    from api.app.embeddings import load_embedding
+
+    config.EMBEDDING_THREADS = args.threads
+    config.EMBEDDING_BATCH_TOKENS = args.batch_tokens
+    k = args.k
+    reference = None
+    print(f"{'backend':>10} {'load(s)':>8} {'p50(ms)':>8} {'p95(ms)':>8} {'docs/s':>8} {'cosine':>7} {'min cos':>8} {'recall@' + str(k):>9} {'re-indexed':>10}")
+    for backend in args.backends:
+        started = time.perf_counter()
+        try:
+            embedding = load_embedding(backend)
+        except ImportError as error:
+            print(f"{backend:>10} skipped: {error.name or error} is not installed")
+            continue
+        loaded = time.perf_counter() - started
+        embedding.embed_query("warm up")
+        latencies = []
+        for query in queries * args.repeat:
+            started = time.perf_counter()
+            embedding.embed_query(query)
+            latencies.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        documents = np.array(embedding.embed_documents(texts), dtype=np.float32)
+        throughput = len(texts) / (time.perf_counter() - started)
+        vectors = np.array(embedding.embed_documents(queries), dtype=np.float32)
+
+        index = faiss.IndexFlatIP(documents.shape[1])
+        index.add(documents)
+        own = index.search(vectors, k)[1]
+        if reference is None:
+            reference = { "index": index, "queries": vectors, "top": own }
+            cosine, lowest, existing, reindexed = 1.0, 1.0, 1.0, 1.0
+        else:
+            cosines = (vectors * reference["queries"]).sum(axis=1)
+            cosine, lowest = float(cosines.mean()), float(cosines.min())
+            existing = recall(reference["top"], reference["index"].search(vectors, k)[1])
+            reindexed = recall(reference["top"], own)
+        p50, p95 = np.percentile(latencies, 50) * 1000, np.percentile(latencies, 95) * 1000
+        print(f"{backend:>10} {loaded:>8.1f} {p50:>8.1f} {p95:>8.1f} {throughput:>8.0f} {cosine:>7.4f} {lowest:>8.4f} {existing:>9.2%} {reindexed:>10.2%}")
+
+
+def main(args):
+    texts = corpus(args)
+    queries = QUERIES + [text[:80] for text in random.Random(2).sample(texts, min(len(texts), args.queries - len(QUERIES)))]
+    batching(texts, queries, args)
+    print()
+    backends(texts, queries, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embedding backends: latency, throughput and recall against fp32 PyTorch.")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx-int8"], help="the first one is the reference")
+    parser.add_argument("--threads", type=int, default=4, help="CPU threads of one encoder call")
+    parser.add_argument("--batch-tokens", type=int, default=8192, help="padded tokens per length batch")
+    parser.add_argument("--batch", type=int, default=32, help="size of the fixed batches compared against")
+    parser.add_argument("--corpus", type=int, default=2000, help="guide chunks (generated unless --guides)")
+    parser.add_argument("--guides", nargs="*", help="guide files or directories to take the chunks from")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the queries for the latency")
+    parser.add_argument("-k", type=int, default=4)
+    main(parser.parse_args())
@@ -0,0 +1,236 @@
+# A local stand-in for the OpenAI API, for benchmarks that must run offline and repeatably.
+#
+# It serves /v1/chat/completions and /v1/completions (plain or streamed) and answers in the
+# shape each chain parses: a ChatResponse JSON when the prompt asks for one, a port plan or a
+# topology for the IP stages, and text otherwise. How long an answer takes follows a latency
+# profile (time to first token, prompt and completion tokens per second). It can also enforce
+# a requests-per-second limit and answer 429 like OpenAI does, and a context window (400
+# context_length_exceeded). Prompt tokens that start like an earlier prompt are counted as
+# cached the way OpenAI's prompt caching does (from 1024 tokens on, in steps of 128). Streamed
+# answers arrive in pieces at the profile's completion rate. With plans=True, stage-3 prompts get a
+# real IP plan of the topology they carry (from the graph allocator) instead of an empty one.
+#
+#   server = serve(FakeOpenAI(profile="gpt-3.5"))
+#   ... OPENAI_API_BASE=server.base_url ...
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from api.app.tokens import count_tokens
+
+# name -> (seconds to first token, prompt tokens per second, completion tokens per second, completion tokens)
+PROFILES = {
+    "instant": (0.0, None, None, 40),
+    "fast": (0.02, 100000, 2000, 80),
+    "gpt-3.5": (0.25, 10000, 90, 120),
+    "gpt-4": (0.6, 4000, 30, 160),
+}
+# Characters per piece of a streamed answer (a few tokens, like OpenAI's chunks).
+STREAM_PIECE = 16
+
+
+def _device(prompt: str) -> str:
+    for pattern in (r"configure device ([^\s?]+)", r"\"device\": \"([^\"]+)\"", r"device named? ([^\s.,]+)"):
+        match = re.search(pattern, prompt)
+        if match:
+            return match.group(1)
+    return "R1"
+
+
+def _plan(prompt: str) -> dict:
+    """The graph allocator's plan of the topology in a stage-3 prompt, in node order."""
+    from api.app.allocator import allocate_ips
+    from api.app.topology import load_topology
+
+    match = re.search(r"network topology ?: ?", prompt, re.IGNORECASE)
+    start = prompt.find("{", match.end()) if match else -1
+    if start < 0:
+        return {"port_info": []}
+    topology = load_topology(json.JSONDecoder().raw_decode(prompt, start)[0])
+    order = {node.name: index for index, node in enumerate(topology.nodes)}
+    entries = allocate_ips(topology)["port_info"]
+    return {"port_info": sorted(entries, key=lambda entry: order.get(entry["device"], len(order)))}
+
+
+def answer(prompt: str, completion_tokens: int, plans: bool = False) -> str:
+    """A deterministic answer the chain that sent `prompt` can parse."""
+    filler = " ".join(["configure"] * max(1, completion_tokens - 20))
+    # Prompts carry the topology, so the ChatResponse schema is looked for before the topology keys.
+    if '"command"' in prompt:
+        return json.dumps({"device": _device(prompt), "command": "enable\nconfigure terminal\nexit", "comment": filler})
+    if '"port_info"' in prompt:
+        return json.dumps(_plan(prompt), indent=2) if plans else json.dumps({"port_info": []})
+    if '"node_info"' in prompt and '"link_info"' in prompt:
+        return json.dumps({"node_info": [], "link_info": []})
+    return filler
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, profile: str = "instant", scale: float = 1.0, rps: Optional[int] = None, fail_first: int = 0, retry_after_ms: int = 200, context_window: Optional[int] = None, plans: bool = False):
+        super().__init__(("127.0.0.1", 0), FakeOpenAIHandler)
+        self.ttft, self.prefill, self.decode, self.completion_tokens = PROFILES[profile]
+        self.scale = scale
+        self.rps = rps
+        self.fail_first = fail_first
+        self.retry_after_ms = retry_after_ms
+        self.context_window = context_window
+        self.plans = plans
+        self.lock = threading.Lock()
+        self.served = []  # start times of accepted requests in the last second
+        self.reset()
+
+    def handle_error(self, request, client_address):
+        # A client that went away mid-call or before its body was sent (a cancelled request) is not an error of the fake.
+        if not isinstance(sys.exc_info()[1], (ConnectionError, json.JSONDecodeError)):
+            super().handle_error(request, client_address)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.requests = 0
+            self.rejected = 0
+            self.calls = 0
+            self.prompt_tokens = 0
+            self.cached_tokens = 0
+            self.too_long = 0
+            self.completion_tokens_total = 0
+            self.prompts = []  # recent prompts, for the prefix cache
+
+    def admit(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            self.served = [started for started in self.served if now - started < 1.0]
+            if self.requests <= self.fail_first or (self.rps is not None and len(self.served) >= self.rps):
+                self.rejected += 1
+                return False
+            self.served.append(now)
+            return True
+
+    def latency(self, prompt_tokens: int, completion_tokens: int) -> float:
+        seconds = self.ttft
+        if self.prefill:
+            seconds += prompt_tokens / self.prefill
+        if self.decode:
+            seconds += completion_tokens / self.decode
+        return seconds * self.scale
+
+    def cached(self, prompt: str) -> int:
+        """Tokens of `prompt` a prefix cache would serve: its longest common start with a recent prompt."""
+        with self.lock:
+            shared = max((len(os.path.commonprefix([prompt, earlier])) for earlier in self.prompts), default=0)
+            self.prompts = (self.prompts + [prompt])[-64:]
+        tokens = count_tokens(prompt[:shared])
+        return tokens // 128 * 128 if tokens >= 1024 else 0
+
+    def record(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> None:
+        with self.lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            self.completion_tokens_total += completion_tokens
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "rejected": self.rejected,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "too_long": self.too_long,
+                "completion_tokens": self.completion_tokens_total,
+            }
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        if not self.server.admit():
+            self.reply(429, {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+                       {"retry-after-ms": str(self.server.retry_after_ms)})
+            return
+
+        chat = self.path.endswith("/chat/completions")
+        if chat:
+            prompt = "\n".join(str(message.get("content") or "") for message in body.get("messages", []))
+        else:
+            prompt = body.get("prompt", "")
+            prompt = "\n".join(prompt) if isinstance(prompt, list) else prompt
+        content = answer(prompt, self.server.completion_tokens, self.server.plans)
+        prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(content)
+        window = self.server.context_window
+        if window is not None and prompt_tokens + completion_tokens > window:
+            with self.server.lock:
+                self.server.too_long += 1
+            self.reply(400, {"error": {"message": f"This model's maximum context length is {window} tokens. However, your messages resulted in {prompt_tokens} tokens.",
+                                       "type": "invalid_request_error", "param": "messages", "code": "context_length_exceeded"}})
+            return
+        cached_tokens = self.server.cached(prompt)
+        self.server.record(prompt_tokens, completion_tokens, cached_tokens)
+        if body.get("stream"):
+            # The first piece comes after the prompt is read, the rest at the completion rate.
+            time.sleep(self.server.latency(prompt_tokens - cached_tokens, 0))
+        else:
+            time.sleep(self.server.latency(prompt_tokens - cached_tokens, completion_tokens))
+
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        base = {"id": "fake", "created": int(time.time()), "model": body.get("model", "fake")}
+        if body.get("stream"):
+            pieces = [content[start:start + STREAM_PIECE] for start in range(0, len(content), STREAM_PIECE)] or [""]
+            chunks = [{**base, "object": "chat.completion.chunk" if chat else "text_completion",
+                       "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": "stop" if last else None} if chat
+                                   else {"index": 0, "text": piece, "finish_reason": "stop" if last else None, "logprobs": None}]}
+                      for position, piece in enumerate(pieces) for last in [position == len(pieces) - 1]]
+            decode = self.server.latency(0, completion_tokens) - self.server.latency(0, 0)
+            self.reply_stream(chunks, decode / len(chunks))
+        elif chat:
+            self.reply(200, {**base, "object": "chat.completion", "usage": usage,
+                             "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]})
+        else:
+            self.reply(200, {**base, "object": "text_completion", "usage": usage,
+                             "choices": [{"index": 0, "text": content, "finish_reason": "stop", "logprobs": None}]})
+
+    def reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def reply_stream(self, chunks, interval: float = 0.0):
+        events = [f"data: {json.dumps(chunk)}\n\n".encode() for chunk in chunks] + [b"data: [DONE]\n\n"]
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("content-length", str(sum(len(event) for event in events)))
+        self.end_headers()
+        for position, event in enumerate(events):
+            if position and interval:
+                time.sleep(interval)
+            self.wfile.write(event)
+            self.wfile.flush()
+
+
+def serve(server: FakeOpenAI) -> FakeOpenAI:
+    """Serve in a daemon thread; stop with server.shutdown()."""
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,51 @@
+# Stand-ins for the expensive parts of the server, for benchmarks that must run offline.
+import hashlib
+import time
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic unit vectors with the cost profile of an encoder forward pass.
+
+    Every call takes `call_seconds` plus `item_seconds` per text, like a batched model where the
+    fixed per-call overhead dominates small batches. time.sleep releases the GIL, as inference does.
+    `weights_mb` of memory are allocated and touched, like loaded weights.
+    """
+
+    def __init__(self, dim: int = 768, call_seconds: float = 0.0, item_seconds: float = 0.0, weights_mb: float = 0.0):
+        self.dim = dim
+        self.call_seconds = call_seconds
+        self.item_seconds = item_seconds
+        self.calls = 0
+        self.texts = 0
+        # Resident memory standing in for the model's weights (bge-base is about 440 MB in fp32).
+        self.weights = np.ones(int(weights_mb * 2 ** 20) // 4, dtype=np.float32)
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        self.texts += len(texts)
+        if self.call_seconds or self.item_seconds:
+            time.sleep(self.call_seconds + self.item_seconds * len(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def fake_corpus(size: int) -> List[str]:
+    """Short configuration-guide-like passages."""
+    topics = ["OSPF area", "VLAN trunk", "static route", "ACL", "NAT overload", "DHCP pool", "BGP neighbor", "RIP version 2"]
+    vendors = ["Cisco IOS", "Juniper Junos"]
+    return [
+        f"{vendors[i % 2]}: configuring {topics[i % len(topics)]} (section {i}). "
+        f"Enter configuration mode, select the interface and apply the {topics[(i * 7) % len(topics)]} settings."
+        for i in range(size)
+    ]
@@ -0,0 +1,341 @@
+# A local stand-in for a GNS3 server, for /v5/apply (api.app.twin) without a real lab.
+#
+# It serves the one REST call the twin makes (GET /v2/projects/{project_id}/nodes) and a telnet
+# console for each router and PC of a topology. The consoles behave enough like dynamips IOS and
+# VPCS for the twin: telnet option negotiation, echo, the IOS modes and their prompts (exec, enable,
+# config, config-if, config-router), "Destination filename [startup-config]?" after a copy, "Press
+# RETURN to get started." after an exit, "% Invalid input" for an unknown command or interface,
+# `show ip route` and ping. Every line takes `latency` seconds, like a slow emulated console; the
+# nodes in `stuck` accept the connection and never answer.
+#
+# Ping is approximate: it succeeds when the source has an address and the target address is set
+# on an interface that is up somewhere in the lab (the mock does not forward packets).
+#
+#   python -m api.bench.gns3_mock --size 20 --port 3080 --topology /tmp/lab.json
+import argparse
+import asyncio
+import ipaddress
+import json
+import re
+import socket
+import uuid
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from api.app.topology import Node, load_topology
+from api.app.twin import DO, ECHO, IAC, SB, SE, SUPPRESS_GO_AHEAD, WILL
+from api.app.validation import IOS_NODE_TYPES, VPCS_NODE_TYPES, find_port
+
+IOS_PROMPTS = {
+    "exec": ">",
+    "enable": "#",
+    "config": "(config)#",
+    "config-if": "(config-if)#",
+    "config-router": "(config-router)#",
+}
+INVALID = "% Invalid input detected at '^' marker."
+_VPCS_IP = re.compile(r"^ip\s+(\d+\.\d+\.\d+\.\d+)\s*(?:/\s*(\d+)|\s+(\d+\.\d+\.\d+\.\d+))?(?:\s+(\d+\.\d+\.\d+\.\d+))?$", re.IGNORECASE)
+
+
+def _strip_telnet(data: bytes) -> bytes:
+    """`data` without the client's telnet commands (the mock ignores what it negotiates)."""
+    text, index = bytearray(), 0
+    while index < len(data):
+        if data[index] != IAC:
+            text.append(data[index])
+            index += 1
+        elif index + 1 < len(data) and data[index + 1] == SB:
+            end = data.find(bytes((IAC, SE)), index)
+            index = len(data) if end < 0 else end + 2
+        elif index + 1 < len(data) and data[index + 1] >= 251:
+            index += 3
+        else:
+            index += 2
+    return bytes(text)
+
+
+class MockDevice:
+    """The configuration state of one node and its CLI."""
+
+    def __init__(self, node: Node, lab: "MockGns3"):
+        self.node = node
+        self.lab = lab
+        self.mode = "exec"
+        self.interface = None  # the port of the config-if mode
+        self.addresses: Dict[str, ipaddress.IPv4Interface] = {}  # port name -> address
+        self.up: Set[str] = set()
+        self.routes: List[Tuple[ipaddress.IPv4Network, str]] = []
+        self.gateway: Optional[str] = None
+        self.lines = 0
+
+    @property
+    def vpcs(self) -> bool:
+        return self.node.node_type in VPCS_NODE_TYPES
+
+    def prompt(self) -> str:
+        if self.vpcs:
+            return f"{self.node.name}> "
+        if self.mode in ("pressreturn", "copy"):
+            return ""
+        return self.node.name + IOS_PROMPTS[self.mode]
+
+    def live_addresses(self) -> Iterable[ipaddress.IPv4Interface]:
+        for port, address in self.addresses.items():
+            if self.vpcs or port in self.up:
+                yield address
+
+    def handle(self, line: str) -> str:
+        self.lines += 1
+        return self._vpcs(line.strip()) if self.vpcs else self._ios(line.strip())
+
+    def _ping(self, address: str, count: int) -> bool:
+        return any(True for _ in self.live_addresses()) and self.lab.reachable(address)
+
+    def _vpcs(self, line: str) -> str:
+        words = line.split()
+        if not words:
+            return ""
+        match = _VPCS_IP.match(line)
+        if match:
+            address, prefix, mask, gateway = match.groups()
+            interface = ipaddress.ip_interface(f"{address}/{prefix or mask or 24}")
+            self.addresses = { "Ethernet0": interface }
+            self.gateway = gateway
+            return f"Checking for duplicate address...\r\n{self.node.name} : {interface.ip} {interface.netmask}" + (f" gateway {gateway}" if gateway else "")
+        if words[0] == "ping" and len(words) > 1:
+            count = int(words[words.index("-c") + 1]) if "-c" in words[:-1] else 5
+            if self._ping(words[1], count):
+                return "\r\n".join(f"84 bytes from {words[1]} icmp_seq={i + 1} ttl=63 time=1.2 ms" for i in range(count))
+            return "\r\n".join(f"host ({words[1]}) not reachable" for _ in range(count))
+        if line == "show ip":
+            interface = self.addresses.get("Ethernet0")
+            return f"NAME        : {self.node.name}[1]\r\nIP/MASK     : {interface.with_prefixlen if interface else '0.0.0.0/0'}\r\nGATEWAY     : {self.gateway or '0.0.0.0'}"
+        if words[0] == "save":
+            return "Saving startup configuration to startup.vpc\r\n.  done"
+        return f'Bad command: "{line}". Use ? for help.'
+
+    def _ios(self, line: str) -> str:
+        mode = self.mode
+        if mode == "pressreturn":
+            self.mode = "exec"
+            return ""
+        if mode == "copy":
+            self.mode = "enable"
+            return "Building configuration...\r\n[OK]"
+        if not line:
+            return ""
+        words = line.split()
+        lower = line.lower()
+        if mode in ("exec", "enable"):
+            if lower in ("enable", "en"):
+                self.mode = "enable"
+            elif lower in ("disable",):
+                self.mode = "exec"
+            elif lower in ("configure terminal", "conf t", "config t", "configure") and mode == "enable":
+                self.mode = "config"
+                return "Enter configuration commands, one per line.  End with CNTL/Z."
+            elif lower in ("exit", "logout", "quit"):
+                self.mode = "pressreturn"
+                return f"\r\n\r\n{self.node.name} con0 is now available\r\n\r\n\r\n\r\n\r\nPress RETURN to get started.\r\n"
+            elif lower.startswith(("copy running-config startup-config", "copy run start")) and mode == "enable":
+                self.mode = "copy"
+                return "Destination filename [startup-config]? "
+            elif lower in ("write", "write memory", "wr"):
+                return "Building configuration...\r\n[OK]"
+            elif lower.startswith("terminal length"):
+                pass
+            elif lower == "show ip route":
+                return self._show_ip_route()
+            elif words[0] == "ping" and len(words) > 1:
+                count = int(words[words.index("repeat") + 1]) if "repeat" in words[:-1] else 5
+                success = self._ping(words[1], count)
+                return (
+                    f"Type escape sequence to abort.\r\nSending {count}, 100-byte ICMP Echos to {words[1]}, timeout is 2 seconds:\r\n"
+                    + ("!" if success else ".") * count
+                    + f"\r\nSuccess rate is {100 if success else 0} percent ({count if success else 0}/{count})"
+                    + (", round-trip min/avg/max = 1/2/4 ms" if success else "")
+                )
+            else:
+                return INVALID
+            return ""
+        if lower == "end":
+            self.mode, self.interface = "enable", None
+            return ""
+        if lower == "exit":
+            self.mode, self.interface = ("config" if mode != "config" else "enable"), None
+            return ""
+        if words[0].lower() in ("interface", "int"):
+            port = find_port(self.node, " ".join(words[1:]))
+            if port is None:
+                return INVALID
+            self.mode, self.interface = "config-if", port.name
+            return ""
+        if mode == "config-if":
+            if lower.startswith("ip address") and len(words) >= 4:
+                try:
+                    self.addresses[self.interface] = ipaddress.ip_interface(f"{words[2]}/{words[3]}")
+                except ValueError:
+                    return INVALID
+            elif lower in ("no shutdown", "no shut"):
+                self.up.add(self.interface)
+            elif lower in ("shutdown", "shut"):
+                self.up.discard(self.interface)
+            elif not lower.startswith(("description", "duplex", "speed", "no ip", "ip ")):
+                return INVALID
+            return ""
+        if mode == "config-router":
+            if not lower.startswith(("network", "passive-interface", "router-id", "redistribute", "default-information")):
+                return INVALID
+            return ""
+        # config
+        if lower.startswith("ip route") and len(words) >= 5:
+            try:
+                self.routes.append((ipaddress.ip_network(f"{words[2]}/{words[3]}"), words[4]))
+            except ValueError:
+                return INVALID
+        elif lower.startswith("router ospf"):
+            self.mode = "config-router"
+        elif not lower.startswith(("hostname", "no ip domain", "ip routing", "line ", "logging")):
+            return INVALID
+        return ""
+
+    def _show_ip_route(self) -> str:
+        lines = ["Codes: C - connected, S - static, O - OSPF", "", "Gateway of last resort is not set", ""]
+        for port in sorted(self.up):
+            address = self.addresses.get(port)
+            if address is not None:
+                lines.append(f"C    {address.network} is directly connected, {port}")
+        for network, next_hop in self.routes:
+            lines.append(f"S    {network} [1/0] via {next_hop}")
+        return "\r\n".join(lines)
+
+
+class MockGns3:
+    """REST API and node consoles of one GNS3 project, served on 127.0.0.1."""
+
+    def __init__(self, topology, latency: float = 0.0, stuck: Iterable[str] = (), project_id: Optional[str] = None):
+        self.topology = load_topology(topology)
+        self.latency = latency
+        self.stuck = set(stuck)
+        self.project_id = project_id or str(uuid.uuid4())
+        self.devices = {
+            node.name: MockDevice(node, self)
+            for node in self.topology.nodes if node.node_type in IOS_NODE_TYPES | VPCS_NODE_TYPES
+        }
+        self.consoles: Dict[str, int] = {}
+        self.connections = 0
+        self._servers: List[asyncio.AbstractServer] = []
+        self._rest = None
+        self._rest_task = None
+        self.url = ""
+
+    def reachable(self, address: str) -> bool:
+        try:
+            wanted = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(interface.ip == wanted for device in self.devices.values() for interface in device.live_addresses())
+
+    async def _console(self, device: MockDevice, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        writer.write(bytes((IAC, WILL, ECHO, IAC, WILL, SUPPRESS_GO_AHEAD, IAC, DO, 31)))  # 31: window size
+        buffer = b""
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                if device.node.name in self.stuck:
+                    continue
+                buffer += _strip_telnet(data)
+                while True:
+                    match = re.search(rb"\r\n|\r\x00|\n|\r(?=[^\n])", buffer)
+                    if match is None:
+                        break
+                    line, buffer = buffer[:match.start()].decode(errors="replace"), buffer[match.end():]
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    output = device.handle(line)
+                    writer.write((line + "\r\n" + (output + "\r\n" if output else "") + device.prompt()).encode())
+                    await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def _nodes(self) -> List[dict]:
+        nodes = []
+        for node in self.topology.nodes:
+            port = self.consoles.get(node.name)
+            nodes.append({
+                "name": node.name,
+                "node_id": node.node_id,
+                "node_type": node.node_type,
+                "project_id": self.project_id,
+                "console": port,
+                "console_host": "0.0.0.0",
+                "console_type": "telnet" if port else "none",
+                "status": "started",
+            })
+        return nodes
+
+    def _app(self):
+        from fastapi import FastAPI, HTTPException
+
+        app = FastAPI(title="GNS3 mock")
+
+        @app.get("/v2/version")
+        async def version():
+            return { "version": "2.2.44", "local": True }
+
+        @app.get("/v2/projects/{project_id}/nodes")
+        async def nodes(project_id: str):
+            if project_id != self.project_id:
+                raise HTTPException(status_code=404, detail=f"Project ID {project_id} doesn't exist")
+            return self._nodes()
+
+        return app
+
+    async def start(self, port: int = 0) -> "MockGns3":
+        import uvicorn
+
+        for name, device in self.devices.items():
+            server = await asyncio.start_server(lambda r, w, device=device: self._console(device, r, w), "127.0.0.1", 0)
+            self._servers.append(server)
+            self.consoles[name] = server.sockets[0].getsockname()[1]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", port))
+        self.url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        self._rest = uvicorn.Server(uvicorn.Config(self._app(), log_level="warning", lifespan="off"))
+        self._rest_task = asyncio.ensure_future(self._rest.serve(sockets=[sock]))
+        while not self._rest.started:
+            await asyncio.sleep(0.01)
+        return self
+
+    async def stop(self) -> None:
+        for server in self._servers:
+            server.close()
+        if self._rest is not None:
+            self._rest.should_exit = True
+            await self._rest_task
+
+
+async def serve(args) -> None:
+    from api.bench.topologies import generate_topology
+
+    topology = generate_topology(args.size)
+    if args.topology:
+        with open(args.topology, "w") as file:
+            json.dump(topology, file)
+    lab = await MockGns3(topology, latency=args.latency).start(args.port)
+    print(f"GNS3 mock at {lab.url}, project_id {lab.project_id}, {len(lab.devices)} consoles", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local GNS3 REST API and node consoles for /v5/apply.")
+    parser.add_argument("--size", type=int, default=20, help="nodes of the synthetic lab")
+    parser.add_argument("--port", type=int, default=3080)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per console line")
+    parser.add_argument("--topology", help="write the lab's topology (JSON) here")
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,292 @@
+# End-to-end load test of the API server, fully offline.
+#
+# The real server (api.app.server) runs under uvicorn in a background thread with every OpenAI
+# call going to a local fake (fake_openai.FakeOpenAI, with a latency profile) and the embedder
+# replaced by a stub (fakes.FakeEmbeddings over a synthetic guide corpus). Requests go over
+# HTTP: /v1 ~ /v3 through their langserve /invoke routes, /v4 and /v5 through /stream, so the
+# time of every stage event can be taken. Topologies come from topologies.generate_topology.
+#
+# The result is JSON (one entry per endpoint x topology size x concurrency) with throughput,
+# p50/p95/p99 latency, per-stage latency and the prompt tokens the fake LLM received, so two
+# commits can be compared:
+#
+#   python -m api.bench.harness run --endpoints v1 v4 v5 --sizes 5 50 --concurrency 8 --out base.json
+#   python -m api.bench.harness compare base.json new.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ENDPOINTS = ["v1", "v2", "v3", "v4", "v5"]
+QUESTIONS = ["connect PC1 to PC2.", "make every PC reach every other PC.", "configure OSPF area 0 on every router."]
+HISTORY = [["connect PC1 to PC2.", "Device: PC1\nCommand: ip 192.168.0.1 /24\nComment: set up ip address"]]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+def summarize(values) -> dict:
+    """Milliseconds: p50/p95/p99/mean/max of a list of seconds."""
+    if not values:
+        return {}
+    return {
+        "p50": round(percentile(values, 0.50) * 1000, 1),
+        "p95": round(percentile(values, 0.95) * 1000, 1),
+        "p99": round(percentile(values, 0.99) * 1000, 1),
+        "mean": round(statistics.fmean(values) * 1000, 1),
+        "max": round(max(values) * 1000, 1),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args):
+    """Fake OpenAI + stub embedder + the API server under uvicorn, all in this process."""
+    from api.bench.fake_openai import FakeOpenAI, serve
+
+    llm = serve(FakeOpenAI(args.profile, scale=args.latency_scale))
+    # Settings are read at import time, so they are set before anything from api.app is imported.
+    os.environ.update({
+        "OPENAI_API_BASE": llm.base_url,
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "offline",
+        "SWITCH_LLM_CACHE": "1" if args.llm_cache else "0",
+        "SWITCH_LLM_RPM": str(args.rpm),
+        "SWITCH_LLM_TPM": str(args.tpm),
+        "SWITCH_WARM_UP": "0",
+        "SWITCH_ENABLED_VERSIONS": ",".join(args.endpoints),
+    })
+
+    from langchain_community.vectorstores.faiss import FAISS
+
+    from api.app import retrieval
+    from api.bench.fakes import FakeEmbeddings, fake_corpus
+
+    embedding = FakeEmbeddings(dim=args.embedding_dim, call_seconds=args.embedding_ms / 1000)
+    store = retrieval.FaissStore(FAISS.from_texts(fake_corpus(args.corpus), embedding))
+    service = retrieval.RetrievalService(embedding, store)
+    retrieval.get_retrieval_service = lambda: service
+
+    import uvicorn
+
+    from api.app.registry import registry
+    from api.app.server import app
+
+    for version in args.endpoints:
+        registry.load(version)
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return llm, server, f"http://127.0.0.1:{port}"
+
+
+async def one_request(client, base_url, endpoint, body):
+    """Latency of one request and the offsets (seconds) of its stage events."""
+    started = time.perf_counter()
+    stages = {}
+    if endpoint in ("v4", "v5"):
+        async with client.stream("POST", f"{base_url}/{endpoint}/stream", json=body) as response:
+            response.raise_for_status()
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                    if event == "error":
+                        raise RuntimeError(f"{endpoint} stream failed")
+                elif line.startswith("data:") and event == "data":
+                    stage = json.loads(line[5:])["stage"]
+                    offset = time.perf_counter() - started
+                    if stage == "device":
+                        stages.setdefault("first_device", offset)
+                        stages["last_device"] = offset
+                    else:
+                        stages[stage] = offset
+    else:
+        response = await client.post(f"{base_url}/{endpoint}/invoke", json=body)
+        response.raise_for_status()
+    return time.perf_counter() - started, stages
+
+
+def stage_durations(offsets: dict) -> dict:
+    """Turn event offsets into how long each stage took."""
+    order = [stage for stage in ("summary", "diff", "design", "ip_plan", "first_device", "last_device") if stage in offsets]
+    durations, previous = {}, 0.0
+    for stage in order:
+        name = {"first_device": "first_device", "last_device": "devices"}.get(stage, stage)
+        if stage == "last_device" and "ip_plan" in offsets:
+            durations[name] = offsets[stage] - offsets["ip_plan"]
+        elif stage == "first_device":
+            durations[name] = offsets[stage] - offsets.get("ip_plan", 0.0)
+            continue
+        else:
+            durations[name] = offsets[stage] - previous
+        previous = offsets[stage]
+    return durations
+
+
+async def run_case(base_url, llm, endpoint, size, concurrency, requests):
+    import httpx
+
+    from api.bench.topologies import generate_topology_json
+
+    topology = generate_topology_json(size)
+    bodies = [
+        {"input": {"chat_history": HISTORY if index % 2 else [], "topology": topology, "question": QUESTIONS[index % len(QUESTIONS)]}, "config": {}, "kwargs": {}}
+        for index in range(requests)
+    ]
+    latencies, stages, errors = [], {}, 0
+    queue = list(enumerate(bodies))
+    llm.reset()
+
+    async def worker(client):
+        nonlocal errors
+        while queue:
+            _, body = queue.pop(0)
+            try:
+                latency, offsets = await one_request(client, base_url, endpoint, body)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(latency)
+            for stage, seconds in stage_durations(offsets).items():
+                stages.setdefault(stage, []).append(seconds)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+
+    usage = llm.stats()
+    return {
+        "endpoint": endpoint,
+        "nodes": size,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 3),
+        "latency_ms": summarize(latencies),
+        "stages_ms": {stage: summarize(values) for stage, values in stages.items()},
+        "llm": {
+            "calls": usage["calls"],
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "prompt_tokens_per_request": round(usage["prompt_tokens"] / max(1, requests)),
+        },
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(args):
+    llm, server, base_url = start_server(args)
+    results = []
+    try:
+        for endpoint in args.endpoints:
+            for size in args.sizes:
+                for concurrency in args.concurrency:
+                    result = await run_case(base_url, llm, endpoint, size, concurrency, args.requests)
+                    results.append(result)
+                    latency = result["latency_ms"]
+                    print(f"{endpoint:>4} {size:>5} nodes  c={concurrency:<3} {result['throughput_rps']:>8.2f} req/s  "
+                          f"p50 {latency.get('p50')} p95 {latency.get('p95')} p99 {latency.get('p99')} ms  "
+                          f"{result['llm']['prompt_tokens_per_request']} prompt tok/req  errors {result['errors']}", file=sys.stderr)
+    finally:
+        server.should_exit = True
+        llm.shutdown()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "profile": args.profile,
+            "latency_scale": args.latency_scale,
+            "llm_cache": args.llm_cache,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+def compare(args):
+    """Print the change of throughput, latency and prompt tokens between two reports."""
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+    key = lambda result: (result["endpoint"], result["nodes"], result["concurrency"])
+    previous = {key(result): result for result in base["results"]}
+
+    def change(old, value):
+        if not old or value is None:
+            return "   n/a"
+        return f"{(value - old) / old * 100:+6.1f}%"
+
+    print(f"{base['meta']['commit']} -> {new['meta']['commit']}")
+    print(f"{'case':>20} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'tokens':>8}")
+    for result in new["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        print(f"{'%s %dn c%d' % key(result):>20} "
+              f"{change(old['throughput_rps'], result['throughput_rps']):>8} "
+              f"{change(old['latency_ms'].get('p50'), result['latency_ms'].get('p50')):>8} "
+              f"{change(old['latency_ms'].get('p95'), result['latency_ms'].get('p95')):>8} "
+              f"{change(old['latency_ms'].get('p99'), result['latency_ms'].get('p99')):>8} "
+              f"{change(old['llm']['prompt_tokens'], result['llm']['prompt_tokens']):>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the API server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark and write a JSON report")
+    run_parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[5, 50], help="topology sizes (nodes), 5 to 1000")
+    run_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    run_parser.add_argument("--requests", type=int, default=16, help="requests per case")
+    run_parser.add_argument("--profile", default="fast", help="fake LLM latency profile (see fake_openai.PROFILES)")
+    run_parser.add_argument("--latency-scale", type=float, default=1.0, help="multiply every fake LLM latency")
+    run_parser.add_argument("--llm-cache", action="store_true", help="keep the LLM response cache on")
+    run_parser.add_argument("--rpm", type=float, default=10 ** 6, help="scheduler requests per minute")
+    run_parser.add_argument("--tpm", type=float, default=10 ** 9, help="scheduler tokens per minute")
+    run_parser.add_argument("--corpus", type=int, default=2000, help="documents in the stub guide store")
+    run_parser.add_argument("--embedding-dim", type=int, default=384)
+    run_parser.add_argument("--embedding-ms", type=float, default=5.0, help="stub encoder time per call")
+    run_parser.add_argument("--out", help="write the JSON report here instead of stdout")
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        asyncio.run(run(args))
+    else:
+        compare(args)
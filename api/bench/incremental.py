@@ -0,0 +1,87 @@
+# Stage-4 calls for a single-link edit of a lab, with and without a session.
+#
+# A 50-node lab is configured once, then asked again after (a) adding one PC to a switch and
+# (b) moving one PC to another switch. Without a session every request costs one stage-4 call
+# per device; with one, only the devices whose view of the lab changed go back to the LLM. Both
+# IP allocation modes are measured: the graph allocator, and the LLM (the default), faked by an
+# answer that plans the lab from scratch, or only the ports it is asked for after an edit.
+#
+#   python -m api.bench.incremental --size 50 --latency 0.2
+import argparse
+import asyncio
+import copy
+import json
+import time
+
+from langchain_core.messages import AIMessageChunk
+
+from api.app.allocator import allocate_ips
+from api.app.chains import chain_v4, chain_v5
+from api.app.utils import ChatRequest
+from api.bench.load_v5 import FakeStage, install_fakes
+from api.bench.topologies import generate_topology
+
+
+def add_pc(topology):
+    topology = copy.deepcopy(topology)
+    switch = next(node for node in topology["node_info"] if node["node_type"] == "ethernet_switch")
+    switch["ports"].append({"name": f"Ethernet{len(switch['ports'])}", "port_number": len(switch["ports"]), "link_type": "ethernet"})
+    topology["node_info"].append({"node_id": "pc-new", "name": "PCnew", "node_type": "vpcs", "ports": [{"name": "Ethernet0", "port_number": 0, "link_type": "ethernet"}]})
+    topology["link_info"].append({"link_id": "link-new", "link_type": "ethernet", "nodes": [{"node_id": "pc-new", "port_number": 0}, {"node_id": switch["node_id"], "port_number": switch["ports"][-1]["port_number"]}]})
+    return topology
+
+
+def move_pc(topology):
+    topology = copy.deepcopy(topology)
+    switches = [node for node in topology["node_info"] if node["node_type"] == "ethernet_switch"]
+    link = next(link for link in reversed(topology["link_info"]) if link["nodes"][1]["node_id"] == switches[0]["node_id"])
+    target = switches[-1]
+    target["ports"].append({"name": f"Ethernet{len(target['ports'])}", "port_number": len(target["ports"]), "link_type": "ethernet"})
+    link["nodes"][1] = {"node_id": target["node_id"], "port_number": target["ports"][-1]["port_number"]}
+    return topology
+
+
+LLM_ONLY = {"device_pruning": False, "cli_templates": False}
+
+
+async def run(chain, stage, topology, config):
+    calls = stage.calls
+    started = time.perf_counter()
+    outputs = await chain.invoke(ChatRequest(chat_history=[], topology=json.dumps(topology), question="make every PC reach every other PC."), config)
+    return len(outputs), stage.calls - calls, time.perf_counter() - started
+
+
+async def main(args):
+    install_fakes(args.latency)
+    v5_devices = FakeStage(args.latency, {"device": "", "command": "", "comment": ""})
+    v4_devices = FakeStage(args.latency, {"device": "", "command": "", "comment": ""})
+    chain_v5.fourth_step_chain = v5_devices.runnable()
+    chain_v4.second_chain = v4_devices.runnable()
+    # Stage 3 through the "LLM": a fresh plan of the whole lab, or (after an edit) the asked ports.
+    fresh = lambda topology: allocate_ips(topology, "10.0.0.0/16")
+    update = lambda topology, current_plan: allocate_ips(topology, "10.0.0.0/16", json.loads(current_plan))
+    chain_v5.third_step_chain = FakeStage(args.latency, lambda input: fresh(input["network_topology"])).runnable()
+    chain_v5.third_step_stream = FakeStage(args.latency, lambda input: AIMessageChunk(content=json.dumps(fresh(input["network_topology"])))).runnable()
+    chain_v5.third_step_update_chain = FakeStage(args.latency, lambda input: update(input["network_topology"], input["current_plan"])).runnable()
+    chain_v4.first_chain = FakeStage(args.latency, lambda input: fresh(input["topology"])).runnable()
+    chain_v4.update_chain = FakeStage(args.latency, lambda input: update(input["topology"], input["current_plan"])).runnable()
+
+    base = generate_topology(args.size)
+    print(f"{'chain':>5} {'ip plan':>7} {'edit':>8} {'mode':>11} {'devices':>8} {'stage-4':>8} {'wall(s)':>8}")
+    for name, chain, stage in (("v5", chain_v5, v5_devices), ("v4", chain_v4, v4_devices)):
+        for allocation in ("graph", "llm"):
+            for edit in (add_pc, move_pc):
+                # Every device goes to stage 4 (no pruning, no CLI templates), so only the session saves calls.
+                configurable = {**LLM_ONLY, "ip_allocation": allocation}
+                session = f"{name}-{allocation}-{edit.__name__}"
+                for mode, config in (("full", {"configurable": configurable}), ("incremental", {"configurable": {**configurable, "session_id": session}})):
+                    await run(chain, stage, base, config)
+                    devices, calls, elapsed = await run(chain, stage, edit(base), config)
+                    print(f"{name:>5} {allocation:>7} {edit.__name__:>8} {mode:>11} {devices:>8} {calls:>8} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage-4 calls for a single-link edit, with and without a session.")
+    parser.add_argument("--size", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per fake LLM call")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,81 @@
+# Recall vs. latency of the compressed guide stores against the current flat FAISS index.
+#
+# Vectors are synthetic: normalized points scattered around topic centroids (like chunk
+# embeddings of a manual), with queries drawn near existing chunks. Recall@k is measured
+# against the exact flat-index result.
+#
+#   python -m api.bench.index_recall --count 20000 --nprobe 1 4 16 64
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+
+from api.app.vectorstore import MmapVectorStore, build_store
+
+
+def synthetic_vectors(count, dim, topics, rng):
+    centroids = rng.standard_normal((topics, dim))
+    vectors = centroids[rng.integers(0, topics, count)] + 0.6 * rng.standard_normal((count, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def measure(search, queries, k):
+    latencies, results = [], []
+    for query in queries:
+        started = time.perf_counter()
+        results.append(search(query[None, :], k)[0])
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return results, np.mean(latencies) * 1000, latencies[int(0.99 * (len(latencies) - 1))] * 1000
+
+
+def recall(results, truth):
+    return np.mean([len(set(r) & set(t)) / len(t) for r, t in zip(results, truth)])
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name.startswith("index"))
+
+
+def main(args):
+    import faiss
+
+    rng = np.random.default_rng(0)
+    vectors = synthetic_vectors(args.count, args.dim, args.topics, rng)
+    queries = vectors[rng.integers(0, args.count, args.queries)] + 0.05 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+    documents = [Document(page_content=f"chunk {i}") for i in range(args.count)]
+
+    # What FAISS.from_texts builds today: an exact L2 index (same ranking as cosine on unit vectors).
+    flat = faiss.IndexFlatL2(args.dim)
+    flat.add(vectors)
+    flat_search = lambda q, k: [[int(i) for i in row] for row in flat.search(q, k)[1]]
+    truth, mean_ms, p99_ms = measure(flat_search, queries, args.k)
+
+    print(f"{'index':>16} {'size(MB)':>9} {'recall@k':>9} {'mean(ms)':>9} {'p99(ms)':>9}")
+    print(f"{'flat (current)':>16} {vectors.nbytes / 2**20:>9.1f} {1.0:>9.3f} {mean_ms:>9.3f} {p99_ms:>9.3f}")
+    with tempfile.TemporaryDirectory() as root:
+        for kind in ("ivfsq8", "ivfpq", "hnsw"):
+            path = os.path.join(root, kind)
+            build_store(path, documents, vectors, kind=kind)
+            size = directory_size(path) / 2**20
+            settings = [("nprobe", n) for n in args.nprobe] if kind != "hnsw" else [("ef", n) for n in args.ef_search]
+            for name, value in settings:
+                store = MmapVectorStore.open(path, nprobe=value if name == "nprobe" else None, ef_search=value if name == "ef" else None)
+                results, mean_ms, p99_ms = measure(store.search, queries, args.k)
+                print(f"{f'{kind} {name}={value}':>16} {size:>9.1f} {recall(results, truth):>9.3f} {mean_ms:>9.3f} {p99_ms:>9.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall and latency of the compressed guide stores vs. the flat index.")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[64, 256])
+    main(parser.parse_args())
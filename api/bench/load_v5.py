@@ -0,0 +1,100 @@
+# Load test for the /v5 execution engine.
+#
+# The four chains of chain_v5 are swapped for fakes that take a fixed time per call,
+# so no OpenAI key is needed. If /v5 awaited its stages properly, N concurrent requests
+# should finish in roughly the time of one; if any stage blocked the event loop they
+# would be serialized and take N times as long.
+#
+#   python -m api.bench.load_v5 --concurrency 1 2 4 8 16 --latency 0.2
+import argparse
+import asyncio
+import json
+import time
+
+from langchain.schema.runnable import RunnableLambda
+from langchain_core.messages import AIMessageChunk
+
+from api.app import config
+from api.app.chains import chain_v5
+
+
+class FakeStage:
+    """Sleeps like an LLM round trip and tracks how many calls are made and in flight."""
+
+    def __init__(self, latency, output):
+        self.latency = latency
+        self.output = output
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def respond(self, input):
+        return self.output(input) if callable(self.output) else self.output
+
+    def sync(self, input):
+        self.calls += 1
+        time.sleep(self.latency)
+        return self.respond(input)
+
+    async def async_(self, input):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return self.respond(input)
+
+    def runnable(self):
+        return RunnableLambda(self.sync, afunc=self.async_)
+
+
+def install_fakes(latency):
+    stages = {
+        "first_step_chain": FakeStage(latency, "summary"),
+        "second_step_chain": FakeStage(latency, "design"),
+        "third_step_chain": FakeStage(latency, {"port_info": []}),
+        "fourth_step_chain": FakeStage(latency, {"device": "", "command": "", "comment": ""}),
+        "repair_step_chain": FakeStage(latency, {"device": "", "command": "", "comment": ""}),
+    }
+    # Stage 3 streamed (chain_v5.stream_ip_plan): the same answer, as one chunk.
+    third = stages["third_step_chain"]
+    stages["third_step_stream"] = FakeStage(latency, lambda input: AIMessageChunk(content=json.dumps(third.respond(input))))
+    for name, stage in stages.items():
+        setattr(chain_v5, name, stage.runnable())
+    return stages
+
+
+async def run(concurrency, input):
+    started = time.perf_counter()
+    # Every device goes to stage 4 (no pruning, no CLI templates), as in the worst case.
+    config = {"configurable": {"device_pruning": False, "cli_templates": False}}
+    outputs = await asyncio.gather(*(chain_v5.invoke(input.copy(), config) for _ in range(concurrency)))
+    return time.perf_counter() - started, outputs
+
+
+async def main(args):
+    stages = install_fakes(args.latency)
+    input = chain_v5.DUMMY_INPUT_2
+    names = [node["name"] for node in json.loads(input.topology)["node_info"]]
+
+    baseline, _ = await run(1, input)
+    print(f"{'requests':>8} {'wall(s)':>8} {'x single':>8}")
+    for concurrency in args.concurrency:
+        elapsed, outputs = await run(concurrency, input)
+        print(f"{concurrency:>8} {elapsed:>8.3f} {elapsed / baseline:>8.2f}")
+        assert all(len(output) == len(names) for output in outputs)
+        # Concurrent requests must overlap instead of queueing behind each other.
+        assert elapsed < baseline * 2, f"{concurrency} requests were serialized ({elapsed:.2f}s)"
+
+    fourth = stages["fourth_step_chain"]
+    print(f"max concurrent stage-4 calls: {fourth.max_in_flight} (global cap {config.GLOBAL_DEVICE_CONCURRENCY})")
+    assert fourth.max_in_flight <= config.GLOBAL_DEVICE_CONCURRENCY
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the /v5 execution engine.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per fake LLM call")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,135 @@
+# /v5 under overload, with and without deadlines, cancellation and load shedding (api.app.guard).
+#
+# The OpenAI quota (--rpm) is the bottleneck: requests arrive open loop (a fixed rate, whatever
+# the server's backlog) faster than the quota can serve them, each about a different router and
+# with single-flight off, so every request pays for all of its own calls. A client gives up after
+# --patience seconds and closes its connection, as a user closing the GNS3 tab would.
+#
+#   off - SWITCH_REQUEST_TIMEOUT=0, SWITCH_CANCEL_ON_DISCONNECT=0, SWITCH_MAX_LLM_CALLS=0: every
+#         request runs to the end, whether anyone still waits for it or not;
+#   on  - the request carries "X-Request-Timeout: <patience - 0.5>" (so the client gets the 504
+#         before it gives up), a closed connection cancels it and
+#         new requests wait for, then are refused with 503, while --max-llm-calls are outstanding.
+#
+# For each: how the requests ended (answered, 503, 504, given up by the client), the latency of the
+# answered ones, and the tokens billed for nothing: all tokens billed (counted once the server has
+# nothing left to do) less the answered requests times the tokens of one request alone.
+#
+#   python -m api.bench.overload --rate 2 --duration 20 --patience 8 --rpm 600
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from api.bench.harness import percentile, start_server
+from api.bench.topologies import generate_topology
+
+CONFIGURABLE = { "device_pruning": False, "cli_templates": False, "validation": False }
+
+
+def body(topology: str, index: int) -> dict:
+    return { "input": { "chat_history": [], "topology": topology, "question": f"configure OSPF area 0 on R{index} and its neighbours." },
+             "config": { "configurable": CONFIGURABLE } }
+
+
+def billed(llm) -> int:
+    stats = llm.stats()
+    return stats["prompt_tokens"] + stats["completion_tokens"]
+
+
+async def idle(llm) -> None:
+    """Wait until the server makes no more OpenAI calls."""
+    from api.app.scheduler import scheduler
+
+    last = None
+    while True:
+        await asyncio.sleep(0.5)
+        now = (billed(llm), scheduler.outstanding())
+        if now == last and not now[1]:
+            return
+        last = now
+
+
+async def one(client, base_url, request, headers, patience) -> tuple:
+    started = time.perf_counter()
+    try:
+        response = await asyncio.wait_for(client.post(f"{base_url}/v5/invoke", json=request, headers=headers), patience)
+    except asyncio.TimeoutError:
+        return "gave up", None
+    seconds = time.perf_counter() - started
+    return { 200: "ok", 503: "503", 504: "504" }.get(response.status_code, str(response.status_code)), seconds
+
+
+async def run_mode(base_url, llm, topology, args, on: bool) -> dict:
+    from api.app import config
+
+    config.REQUEST_TIMEOUT = 0
+    config.CANCEL_ON_DISCONNECT = on
+    config.MAX_LLM_CALLS = (args.max_llm_calls or max(1, args.rpm // 60)) if on else 0
+    config.ADMISSION_WAIT = args.admission_wait
+    headers = { "x-request-timeout": str(args.patience - 0.5) } if on else None
+    before = billed(llm)
+    tasks = []
+    async with httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=None)) as client:
+        for index in range(int(args.rate * args.duration)):
+            tasks.append(asyncio.ensure_future(one(client, base_url, body(topology, args.first + index), headers, args.patience)))
+            await asyncio.sleep(1 / args.rate)
+        results = await asyncio.gather(*tasks)
+    await idle(llm)
+    args.first += len(tasks)
+    outcomes = {}
+    for outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    latencies = [seconds for outcome, seconds in results if outcome == "ok"]
+    tokens = billed(llm) - before
+    return { "outcomes": outcomes, "latencies": latencies, "tokens": tokens, "wasted": tokens - outcomes.get("ok", 0) * args.per_request }
+
+
+async def run(args, llm, base_url):
+    from api.app import config
+
+    topology = json.dumps(generate_topology(args.size))
+    # One request alone: its latency and what an answered request costs (after a first one, which
+    # also pays for what every request shares: the lab's design, the guide queries).
+    config.MAX_LLM_CALLS, config.SINGLE_FLIGHT = 0, False
+    async with httpx.AsyncClient(timeout=None) as client:
+        for index in range(2):
+            before, calls, started = billed(llm), llm.stats()["calls"], time.perf_counter()
+            (await client.post(f"{base_url}/v5/invoke", json=body(topology, index))).raise_for_status()
+            alone = time.perf_counter() - started
+            await idle(llm)
+    args.per_request, args.first = billed(llm) - before, 2
+    print(f"one request alone: {alone:.2f}s, {llm.stats()['calls'] - calls} OpenAI calls, {args.per_request} tokens; "
+          f"{args.rate}/s for {args.duration}s, patience {args.patience}s, {args.rpm} calls/min\n")
+    print(f"{'mode':>4} {'ok':>4} {'503':>4} {'504':>4} {'gave up':>8} {'p50(s)':>7} {'p95(s)':>7} {'p99(s)':>7} {'tokens':>9} {'wasted':>9} {'wasted %':>9}")
+    for on in (False, True):
+        result = await run_mode(base_url, llm, topology, args, on)
+        outcomes, latencies = result["outcomes"], result["latencies"]
+        quantiles = [percentile(latencies, q) for q in (0.50, 0.95, 0.99)]
+        print(f"{'on' if on else 'off':>4} {outcomes.get('ok', 0):>4} {outcomes.get('503', 0):>4} {outcomes.get('504', 0):>4} {outcomes.get('gave up', 0):>8} "
+              + " ".join(f"{value:>7.2f}" if value is not None else f"{'-':>7}" for value in quantiles)
+              + f" {result['tokens']:>9} {result['wasted']:>9} {result['wasted'] / max(1, result['tokens']):>9.0%}")
+
+
+def main(args):
+    args.endpoints, args.llm_cache, args.tpm = ["v5"], False, 10 ** 9
+    args.corpus, args.embedding_dim, args.embedding_ms = 2000, 384, 5.0
+    llm, server, base_url = start_server(args)
+    asyncio.run(run(args, llm, base_url))
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/v5 under overload: deadlines, cancellation and load shedding off and on.")
+    parser.add_argument("--rate", type=float, default=2.0, help="requests per second, open loop")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of arrivals")
+    parser.add_argument("--patience", type=float, default=8.0, help="seconds a client waits before it gives up")
+    parser.add_argument("--rpm", type=int, default=600, help="OpenAI requests per minute (the bottleneck)")
+    parser.add_argument("--max-llm-calls", type=int, help="SWITCH_MAX_LLM_CALLS when on (default: its default, rpm / 60)")
+    parser.add_argument("--admission-wait", type=float, default=1.0, help="SWITCH_ADMISSION_WAIT when on")
+    parser.add_argument("--size", type=int, default=10, help="topology size (nodes)")
+    parser.add_argument("--profile", default="gpt-3.5", help="fake LLM latency profile (see fake_openai.PROFILES)")
+    parser.add_argument("--latency-scale", type=float, default=0.2)
+    main(parser.parse_args())
@@ -0,0 +1,79 @@
+# The /v5 pipeline end to end, strictly sequential against pipelined (api.app.executor.StageGraph,
+# TaskPool and the streamed IP plan of chain_v5.stream_ip_plan).
+#
+# A generated lab goes through /v5 with the IP plan from the LLM (the fake answers stage 3 with the
+# graph allocator's plan of the topology in the prompt, streamed at the profile's completion rate)
+# and every device sent to the LLM. "sequential" waits for the whole plan before the first device
+# call (SWITCH_STREAM_IP_PLAN=0); "pipelined" starts each device as soon as the addresses its view
+# shows are in. For each: when the plan was complete, when the first device answer came, the
+# total, and the OpenAI calls and prompt tokens (the same in both runs: the device views are
+# final when their calls start, so the prompts are identical).
+#
+#   python -m api.bench.pipeline --sizes 50 --runs 3
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from api.bench.fake_openai import FakeOpenAI, serve
+from api.bench.topologies import generate_topology
+
+QUESTION = "connect PC1 to PC2 and make sure they can ping each other."
+
+
+async def run_once(chain_v5, request, streamed: bool, llm: FakeOpenAI) -> dict:
+    configurable = { "ip_allocation": "llm", "stream_ip_plan": streamed, "device_pruning": False, "cli_templates": False, "validation": False }
+    before = llm.stats()
+    started = time.perf_counter()
+    plan_done = first_device = None
+    outputs = {}
+    async for event in chain_v5.astream(request, { "configurable": configurable }):
+        now = time.perf_counter() - started
+        if event["stage"] == "ip_plan":
+            plan_done = now
+        elif event["stage"] == "device":
+            first_device = first_device if first_device is not None else now
+            outputs[event["index"]] = event["output"]
+    stats = { key: value - before[key] for key, value in llm.stats().items() }
+    return { "plan": plan_done, "first": first_device, "total": time.perf_counter() - started, "calls": stats["calls"],
+             "prompt_tokens": stats["prompt_tokens"], "outputs": [outputs[index] for index in sorted(outputs)] }
+
+
+async def run(args, llm: FakeOpenAI) -> None:
+    from api.app.chains import chain_v5
+    from api.app.utils import ChatRequest
+
+    print(f"{'lab':>8} {'mode':>10} {'plan(s)':>8} {'1st dev(s)':>10} {'total(s)':>9} {'calls':>6} {'prompt tok':>11}")
+    for size in args.sizes:
+        request = ChatRequest(chat_history=[["configure R1", "done"]], topology=json.dumps(generate_topology(size)), question=QUESTION)
+        # The conversation summary is cached after the first request: a warm-up run pays for it.
+        await run_once(chain_v5, request, False, llm)
+        results = {}
+        for streamed in (False, True):
+            runs = [await run_once(chain_v5, request, streamed, llm) for _ in range(args.runs)]
+            median = lambda key: statistics.median(result[key] for result in runs)
+            results[streamed] = runs[0]
+            print(f"{f'lab-{size}':>8} {'pipelined' if streamed else 'sequential':>10} {median('plan'):>8.2f} {median('first'):>10.2f} "
+                  f"{median('total'):>9.2f} {runs[0]['calls']:>6} {runs[0]['prompt_tokens']:>11}")
+        same = results[False]["outputs"] == results[True]["outputs"] and results[False]["prompt_tokens"] == results[True]["prompt_tokens"]
+        speedup = (results[False]["total"] - results[True]["total"]) / results[False]["total"]
+        print(f"{'':>8} {'':>10} same answers and prompts: {'yes' if same else 'NO'}; end to end {speedup:.0%} faster\n")
+
+
+def main(args):
+    llm = serve(FakeOpenAI(args.profile, scale=args.latency_scale, plans=True))
+    # Settings are read at import time, so they are set before anything from api.app is imported.
+    os.environ.update({ "OPENAI_API_BASE": llm.base_url, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "offline", "SWITCH_LLM_CACHE": "0",
+                        "SWITCH_WARM_UP": "0", "SWITCH_LLM_TPM": "100000000", "SWITCH_LLM_RPM": "1000000", "SWITCH_SINGLE_FLIGHT": "0" })
+    asyncio.run(run(args, llm))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sequential vs pipelined stage 3 -> stage 4 on /v5.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50], help="topology sizes (nodes)")
+    parser.add_argument("--runs", type=int, default=3, help="runs per mode (the median is shown)")
+    parser.add_argument("--profile", default="gpt-3.5", help="fake LLM latency profile (see fake_openai.PROFILES)")
+    parser.add_argument("--latency-scale", type=float, default=0.2)
+    main(parser.parse_args())
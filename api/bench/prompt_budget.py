@@ -0,0 +1,145 @@
+# Prompt token budgets and the static-prefix layout of the prompts (api.app.prompts).
+#
+#   layout  - for each budgeted prompt: the tokens before its first field (byte-identical in every
+#             call) and the tokens two calls share from the start (two devices of one fan-out, two
+#             questions about one lab), against the whole prompt.
+#   budgets - exported GNS3 labs and long chats through the /v5 design and /v3 answer budgets:
+#             tokens before and after, what was trimmed and the time it took.
+#   e2e     - /v5 end to end against the fake OpenAI (gpt-3.5 latency profile, 16k context window,
+#             prefix cache) with a 5-turn chat and a lab too large for the window: budgets off (it
+#             fails at the design call, after the summary), on, and the next question about the lab,
+#             whose design and IP plan prompts start with the same instructions and topology.
+#
+#   python -m api.bench.prompt_budget --sizes 50 200 800 --turns 10 100 1000
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from api.bench.fake_openai import FakeOpenAI, serve
+
+HISTORY_TURN = ("connect PC{0} to PC{1} and make sure they can ping each other.",
+                "Device: PC{0}\nCommand: ip 192.168.{0}.2 /24 192.168.{0}.1\nComment: set up the ip address and default gateway of PC{0}")
+
+
+def chat(turns: int):
+    return [[human.format(i, i + 1), ai.format(i)] for i in range(turns) for human, ai in [HISTORY_TURN]]
+
+
+def layout() -> None:
+    from api.app.chains import chain_v3, chain_v4, chain_v5
+    from api.app.prompts import static_prefix
+    from api.app.tokens import count_tokens
+    from api.app.utils import format_chat_history
+
+    sample = chain_v5.DUMMY_INPUT_1
+    design = " ".join(["Assign addresses to every connected port and add static routes on the routers."] * 20)
+    values = {
+        "prev_conversation": format_chat_history(chat(3)), "prev_conversation_summary": "PC1 and PC2 were connected.",
+        "new_conversation": format_chat_history(chat(1)), "network_topology": sample.topology,
+        "question": sample.question, "design_of_network": design, "device_view": '{"device":"R1","ports":[]}', "device_name": "R1",
+        "chat_history": format_chat_history(chat(3)), "request": design, "previous_output": "{}", "problems": "- R1 has no interface 'Serial9/0'",
+    }
+    # Another call of the same prompt: the next device of the same fan-out ...
+    next_device = { **values, "device_view": '{"device":"R2","ports":[]}', "device_name": "R2", "previous_output": '{"device":"R2"}' }
+    # ... or the next question about the same lab.
+    next_question = {
+        **values, "prev_conversation": format_chat_history(chat(4)), "prev_conversation_summary": "PC1, PC2 and PC3 were connected.",
+        "new_conversation": format_chat_history(chat(2)[1:]), "question": "connect PC3 to PC4.", "design_of_network": "Use OSPF. " + design,
+        "chat_history": format_chat_history(chat(4)),
+    }
+    prompts = {
+        "v5 summary": chain_v5.first_step_prompt, "v5 design": chain_v5.second_step_prompt, "v5 ip_plan": chain_v5.third_step_prompt,
+        "v5 device": chain_v5.forth_step_prompt, "v5 repair": chain_v5.repair_step_prompt,
+        "v4 ip_plan": chain_v4.PROMPT_FOR_PORT_PLAN, "v4 device": chain_v4.PROMPT_FOR_ANSWER, "v3 answer": chain_v3.PROMPT_FOR_ANSWER,
+    }
+    print(f"{'prompt':>12} {'static':>7} {'shared':>7} {'prompt':>7} {'share':>6}")
+    for name, prompt in prompts.items():
+        other = next_device if name in ("v5 device", "v5 repair") else next_question
+        first, second = (prompt.format(**{ key: given[key] for key in prompt.input_variables }) for given in (values, other))
+        shared = count_tokens(os.path.commonprefix([first, second]))
+        total = count_tokens(first)
+        print(f"{name:>12} {count_tokens(static_prefix(prompt)):>7} {shared:>7} {total:>7} {shared / total:>6.0%}")
+
+
+def budgets(sizes, turns) -> None:
+    from api.app.chains import chain_v3, chain_v5
+    from api.app.prompts import TOPOLOGY, HISTORY, PromptBudget, PromptTooLarge
+    from api.app.utils import format_chat_history
+    from api.bench.topologies import exported, generate_topology
+
+    cases = []
+    for size in sizes:
+        cases.append((f"design lab-{size}", PromptBudget("v5", "design", chain_v5.second_step_prompt, "gpt-3.5-turbo-1106", { "network_topology": TOPOLOGY }), {
+            "prev_conversation_summary": "It dose not exist.", "question": "connect PC1 to PC2.", "network_topology": json.dumps(exported(generate_topology(size))),
+        }))
+    for count in turns:
+        cases.append((f"v3 chat-{count}", PromptBudget("v3", "answer", chain_v3.PROMPT_FOR_ANSWER, "gpt-3.5-turbo", { "chat_history": HISTORY, "network_topology": TOPOLOGY }), {
+            "chat_history": format_chat_history(chat(count)), "question": "connect PC1 to PC2.", "network_topology": chain_v5.DUMMY_INPUT_1.topology,
+        }))
+    print(f"{'case':>16} {'budget':>7} {'before':>8} {'after':>8} {'ms':>7}  trimmed")
+    for name, budget, values in cases:
+        started = time.perf_counter()
+        try:
+            _, report = budget.fit(values)
+            after, actions = report["tokens"], "; ".join(f"{a['field']}: {a['action']}" for a in report["actions"]) or "-"
+            before = report["tokens"] + sum(a["tokens_before"] - a["tokens_after"] for a in report["actions"])
+            budget_tokens = report["budget"]
+        except PromptTooLarge as error:
+            before, after, actions, budget_tokens = "-", error.tokens, "rejected before the call", error.budget
+        print(f"{name:>16} {budget_tokens:>7} {before!s:>8} {after:>8} {(time.perf_counter() - started) * 1000:>7.1f}  {actions}")
+
+
+async def end_to_end(llm: FakeOpenAI, size: int) -> None:
+    from api.app import config
+    from api.app.chains import chain_v5
+    from api.app.prompts import PromptTooLarge
+    from api.app.utils import ChatRequest
+    from api.bench.topologies import exported, generate_topology
+
+    topology = json.dumps(exported(generate_topology(size)))
+    configurable = { "cli_templates": False, "validation": False }
+    runs = (
+        ("budgets off", "connect PC1 to PC2.", { "v5.design": 10 ** 9, "v5.ip_plan": 10 ** 9 }),
+        ("budgets on", "connect PC1 to PC2.", {}),
+        ("next question", "connect PC3 to PC4.", {}),
+    )
+    for label, question, overrides in runs:
+        config.PROMPT_BUDGETS.clear()
+        config.PROMPT_BUDGETS.update(overrides)
+        request = ChatRequest(chat_history=chat(5), topology=topology, question=question)
+        # The fake's prefix cache is kept from one run to the next: only its counters are compared.
+        before = llm.stats()
+        started = time.perf_counter()
+        try:
+            outputs = await chain_v5.invoke(request, { "configurable": configurable })
+            result = f"{len(outputs)} devices"
+        except PromptTooLarge as error:
+            result = f"413 ({error.stage})"
+        except Exception as error:
+            result = f"failed: {type(error).__name__}"
+        stats = { key: value - before[key] for key, value in llm.stats().items() }
+        print(f"lab-{size:<5} {label:>13}: {result:<22} {time.perf_counter() - started:>6.2f}s  "
+              f"{stats['calls']} calls, {stats['too_long']} over the window, {stats['prompt_tokens']} prompt tokens, {stats['cached_tokens']} cached")
+    config.PROMPT_BUDGETS.clear()
+
+
+def main(args):
+    llm = serve(FakeOpenAI("gpt-3.5", scale=args.latency_scale, context_window=16385))
+    # Settings are read at import time, so they are set before anything from api.app is imported.
+    os.environ.update({ "OPENAI_API_BASE": llm.base_url, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "offline", "SWITCH_LLM_CACHE": "0", "SWITCH_WARM_UP": "0", "SWITCH_LLM_TPM": "100000000" })
+    layout()
+    print()
+    budgets(args.sizes, args.turns)
+    print()
+    asyncio.run(end_to_end(llm, args.e2e_size))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prompt token budgets and prefix layout.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200, 800])
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--latency-scale", type=float, default=0.2)
+    parser.add_argument("--e2e-size", type=int, default=300, help="lab of the end-to-end run that does not fit the window")
+    main(parser.parse_args())
@@ -0,0 +1,75 @@
+# Stage-4 LLM calls avoided by intent-aware pruning (api.app.intent).
+#
+# A set of typical questions, each with the kind of design stage 2 gives for it, is scoped on
+# DUMMY_INPUT_1 and on synthetic labs: how many devices still get an LLM call, and how many are
+# answered locally. Then /v5 runs end to end on DUMMY_INPUT_1 (fake stages, no OpenAI key) with
+# pruning off and on, counting the stage-4 calls actually made.
+#
+#   python -m api.bench.pruning --sizes 50 200
+import argparse
+import asyncio
+import json
+
+from api.app.chains import chain_v5
+from api.app.intent import device_scope
+from api.app.topology import load_topology
+from api.bench.load_v5 import install_fakes
+from api.bench.topologies import generate_topology
+
+STATIC = "Assign an address to every connected port and add static routes on the routers in between."
+OSPF = "Run OSPF area 0 on every router and advertise the connected subnets."
+
+
+def intents(pcs: int, routers: int) -> list:
+    """(question, design) pairs, naming devices that exist in a lab with that many PCs and routers."""
+    return [
+        ("connect PC1 to PC2.", STATIC),
+        (f"PC3 cannot ping PC{pcs}, fix it.", STATIC),
+        ("set the hostname of R2 to core-2.", "Change the hostname of R2."),
+        ("block telnet from PC4 to R1 with an access list.", "An extended access list on R1 denying TCP 23 from PC4."),
+        (f"add a default route on R{routers} pointing to R{routers - 1}.", "A static default route on the last router."),
+        ("give PC5 a new address.", STATIC),
+        ("configure OSPF area 0 on every router.", OSPF),
+        ("make every PC reach every other PC.", OSPF),
+        (f"connect PC1 to PC{pcs}.", OSPF),
+    ]
+
+
+def table(name: str, topology: dict) -> None:
+    parsed = load_topology(topology)
+    pcs = sum(node.node_type == "vpcs" for node in parsed.nodes)
+    routers = sum(node.node_type == "dynamips" for node in parsed.nodes)
+    total = saved = 0
+    for question, design in intents(pcs, routers):
+        scope = device_scope(parsed, question, design)
+        calls = len(scope["devices"]) if scope["devices"] is not None else len(parsed)
+        total += len(parsed)
+        saved += len(parsed) - calls
+        reason = "network-wide" if scope["network_wide"] else ("no device named" if scope["devices"] is None else "")
+        print(f"{name:>14} {question[:48]:<48} {len(parsed):>6} {calls:>6} {len(parsed) - calls:>7}  {reason}")
+    print(f"{name:>14} {'all intents':<48} {total:>6} {total - saved:>6} {saved:>7}  ({saved / total:.0%} of the calls avoided)")
+
+
+async def end_to_end() -> None:
+    stages = install_fakes(0.0)
+    stages["second_step_chain"].output = STATIC
+    for pruning in (False, True):
+        stages["fourth_step_chain"].calls = 0
+        input = chain_v5.DUMMY_INPUT_1.copy()
+        outputs = await chain_v5.invoke(input, { "configurable": { "device_pruning": pruning, "cli_templates": False } })
+        print(f"DUMMY_INPUT_1 end to end, pruning {'on ' if pruning else 'off'}: {len(outputs)} devices answered, "
+              f"{stages['fourth_step_chain'].calls} stage-4 calls")
+
+
+def main(args):
+    print(f"{'topology':>14} {'question':<48} {'devices':>6} {'calls':>6} {'avoided':>7}")
+    table("DUMMY_INPUT_1", json.loads(chain_v5.DUMMY_INPUT_1.topology))
+    for size in args.sizes:
+        table(f"synthetic-{size}", generate_topology(size))
+    asyncio.run(end_to_end())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage-4 calls avoided by intent-aware pruning.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200])
+    main(parser.parse_args())
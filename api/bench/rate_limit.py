@@ -0,0 +1,97 @@
+# Checks the OpenAI scheduler against a local stub server that enforces its own rate limit.
+#
+# The stub (fake_openai.FakeOpenAI) answers like OpenAI, but only `--server-rps` requests per second;
+# beyond that (and for the first `--fail-first` requests) it answers 429 with Retry-After.
+# Three checks, each asserted:
+#   retry     - with the scheduler's limit above the server's, every call still succeeds after retries;
+#   throttle  - with the scheduler's limit below the server's, no call is rate limited at all;
+#   priority  - an interactive call queued behind a batch backlog is sent before the backlog (the
+#               order the scheduler sends calls in; api/tests/test_scheduler.py checks the same
+#               without a server).
+#
+#   python -m api.bench.rate_limit
+import argparse
+import asyncio
+import time
+
+import openai
+
+from api.app.scheduler import BATCH, INTERACTIVE, LLMScheduler, ScheduledResource, llm_priority
+from api.bench.fake_openai import FakeOpenAI, serve
+
+
+class Recorded:
+    """A completions resource that notes the order in which its calls are sent."""
+
+    def __init__(self, resource, sent):
+        self.resource = resource
+        self.sent = sent
+
+    def create(self, **kwargs):
+        self.sent.append(kwargs["messages"][0]["content"])
+        return self.resource.create(**kwargs)
+
+
+async def fire(scheduler, server, calls, priority=INTERACTIVE, tag="call", sent=None):
+    resource = openai.AsyncOpenAI(base_url=server.base_url, api_key="stub", max_retries=0).chat.completions
+    resource = ScheduledResource(Recorded(resource, sent if sent is not None else []), scheduler, is_async=True)
+
+    async def one(index):
+        with llm_priority(priority):
+            response = await resource.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": f"{tag} {index}"}])
+        return response.choices[0].message.content, time.perf_counter()
+
+    return await asyncio.gather(*(one(index) for index in range(calls)))
+
+
+async def main(args):
+    print(f"{'check':>9} {'calls':>6} {'wall(s)':>8} {'429s':>5} {'retries':>8}")
+
+    # The scheduler believes it may send 4x what the server takes: the 429s must be absorbed by retries.
+    server = serve(FakeOpenAI("fast", rps=args.server_rps, fail_first=args.fail_first))
+    scheduler = LLMScheduler(rpm=args.server_rps * 60 * 4, tpm=10 ** 9, backoff_base=0.1, max_retries=10, burst=1.0)
+    started = time.perf_counter()
+    results = await fire(scheduler, server, args.calls)
+    elapsed = time.perf_counter() - started
+    print(f"{'retry':>9} {len(results):>6} {elapsed:>8.2f} {server.rejected:>5} {scheduler.counts['retries']:>8}")
+    assert len(results) == args.calls and server.rejected > 0 and scheduler.counts["failed"] == 0
+    server.shutdown()
+
+    # The scheduler's own limit is below the server's: it must throttle so that nothing is rejected.
+    # (A bucket lets `burst` seconds' worth through on top of its rate, hence the small burst
+    # against the stub's one-second sliding window.)
+    server = serve(FakeOpenAI("fast", rps=args.server_rps))
+    scheduler = LLMScheduler(rpm=args.server_rps * 60 * 0.8, tpm=10 ** 9, burst=0.2)
+    started = time.perf_counter()
+    results = await fire(scheduler, server, args.calls)
+    elapsed = time.perf_counter() - started
+    print(f"{'throttle':>9} {len(results):>6} {elapsed:>8.2f} {server.rejected:>5} {scheduler.counts['retries']:>8}")
+    assert server.rejected == 0
+    assert elapsed >= (args.calls - args.server_rps) / args.server_rps * 0.8, "calls were not spread out"
+    server.shutdown()
+
+    # A backlog of batch calls, then one interactive call: it must not wait for the backlog. What
+    # counts is the order the calls are first sent in (the stub takes everything, so a retry only
+    # comes from a transient error, and does not change it), not when their answers come back.
+    server = serve(FakeOpenAI("fast"))
+    scheduler = LLMScheduler(rpm=args.server_rps * 60 * 0.8, tpm=10 ** 9, burst=0.2)
+    started, sent = time.perf_counter(), []
+    backlog = asyncio.ensure_future(fire(scheduler, server, args.calls, BATCH, "batch", sent))
+    await asyncio.sleep(0.05)
+    queued = scheduler.stats()["queued"]
+    await fire(scheduler, server, 1, INTERACTIVE, "interactive", sent)
+    await backlog
+    ahead = sent.index("interactive 0")
+    print(f"{'priority':>9} {args.calls + 1:>6} {time.perf_counter() - started:>8.2f} {server.rejected:>5} {scheduler.counts['retries']:>8}"
+          f"   queued {queued}, interactive sent after {ahead}/{args.calls} batch calls")
+    # Only the batch calls already sent when it arrived (and one the dispatcher may start meanwhile) go first.
+    assert ahead <= args.calls - queued["batch"] + 1, "the interactive call waited for the backlog"
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retry, throttling and priority checks of the OpenAI scheduler.")
+    parser.add_argument("--calls", type=int, default=40)
+    parser.add_argument("--server-rps", type=int, default=20, help="requests per second the stub accepts")
+    parser.add_argument("--fail-first", type=int, default=5, help="requests the stub rejects up front")
+    asyncio.run(main(parser.parse_args()))
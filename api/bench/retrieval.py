@@ -0,0 +1,69 @@
+# Retrieval throughput and latency: one encoder call per query (docsearch.as_retriever())
+# vs. RetrievalService micro-batching, at several concurrency levels.
+#
+# The embedder is a stub with a fixed per-call cost, so the numbers show the effect of
+# batching, not the speed of a particular model.
+#
+#   python -m api.bench.retrieval --concurrency 1 8 64 --requests 256
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from langchain_community.vectorstores.faiss import FAISS
+
+from api.app.retrieval import FaissStore, RetrievalService, ServiceRetriever
+from api.bench.fakes import FakeEmbeddings, fake_corpus
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def drive(retriever, queries, concurrency):
+    latencies = []
+    queue = list(queries)
+
+    async def worker():
+        while queue:
+            query = queue.pop()
+            started = time.perf_counter()
+            await retriever.ainvoke(query)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, latencies
+
+
+def report(name, concurrency, elapsed, latencies):
+    print(f"{name:>10} {concurrency:>5} {len(latencies) / elapsed:>10.1f} {statistics.median(latencies) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f}")
+
+
+async def main(args):
+    embedding = FakeEmbeddings(call_seconds=args.call_ms / 1000, item_seconds=args.item_ms / 1000)
+    docsearch = FAISS.from_texts(fake_corpus(args.corpus), embedding)
+    rng = random.Random(0)
+    # A share of the queries repeats, as "configure OSPF on R1" does in practice.
+    distinct = [f"how do I configure {topic} on R{i}" for i in range(args.requests) for topic in ("OSPF", "VLAN")]
+    queries = [rng.choice(distinct[: args.requests // 4]) if rng.random() < args.repeat else distinct[i] for i in range(args.requests)]
+
+    print(f"{'retriever':>10} {'conc':>5} {'qps':>10} {'p50(ms)':>9} {'p99(ms)':>9}")
+    for concurrency in args.concurrency:
+        report("per-query", concurrency, *await drive(docsearch.as_retriever(), queries, concurrency))
+        service = RetrievalService(embedding, FaissStore(docsearch), window=args.window_ms / 1000)
+        report("batched", concurrency, *await drive(ServiceRetriever(service=service), queries, concurrency))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrieval throughput and p99 latency with and without micro-batching.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--corpus", type=int, default=2000)
+    parser.add_argument("--repeat", type=float, default=0.3, help="share of queries that repeat an earlier one")
+    parser.add_argument("--call-ms", type=float, default=15, help="fixed cost of one encoder call")
+    parser.add_argument("--item-ms", type=float, default=1, help="extra cost per text in a call")
+    parser.add_argument("--window-ms", type=float, default=5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,148 @@
+# Memory and retrieval throughput of N API workers: each loading the model and the index
+# in-process, against all of them querying one retrieval sidecar (api.app.sidecar).
+#
+# Workers are separate processes, like `uvicorn --workers N`. The embedding model is the offline
+# stand-in of api.bench.fakes, holding --model-mb of weights and taking a fixed time per batch plus
+# a little per query; the index is a real FAISS index over --corpus passages. Each worker loads
+# what its mode needs, then all of them send --queries distinct queries (--concurrency at a time).
+# Memory is the proportional set size (PSS) of every process involved, sidecar included.
+#
+#   python -m api.bench.sidecar --workers 1 4 8 --model-mb 440
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROLE_ARGS = ("--model-mb", "--corpus", "--embedding-ms", "--item-ms", "--queries", "--concurrency", "--threads")
+
+
+def pss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/smaps_rollup") as rollup:
+        for line in rollup:
+            if line.startswith("Pss:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def local_service(args):
+    from langchain_community.vectorstores.faiss import FAISS
+
+    from api.app.retrieval import FaissStore, RetrievalService
+    from api.bench.fakes import FakeEmbeddings
+
+    embedding = FakeEmbeddings(call_seconds=args.embedding_ms / 1000, item_seconds=args.item_ms / 1000, weights_mb=args.model_mb)
+    return RetrievalService(embedding, FaissStore(FAISS.load_local(args.index, embedding)), parallel=args.threads)
+
+
+def run_sidecar(args) -> None:
+    from api.app.sidecar import serve
+    serve(local_service(args), args.address, args.threads)
+
+
+def run_worker(args) -> None:
+    if args.mode == "local":
+        service = local_service(args)
+    else:
+        from api.app.sidecar import RemoteRetrievalService
+        service = RemoteRetrievalService(args.address)
+
+    async def load(offset: int, count: int) -> float:
+        queue = [f"worker {args.worker} asks about OSPF and VLAN setup, variant {offset + i}" for i in range(count)]
+
+        async def client():
+            while queue:
+                await service.search(queue.pop())
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+        return time.perf_counter() - started
+
+    asyncio.run(load(-args.concurrency, args.concurrency))  # warm up (connections, first batch)
+    print("ready", flush=True)
+    sys.stdin.readline()
+    elapsed = asyncio.run(load(0, args.queries))
+    print(json.dumps({ "seconds": elapsed, "pss": pss_mb(os.getpid()) }), flush=True)
+
+
+def spawn(args, *role) -> subprocess.Popen:
+    passed = [item for name in ROLE_ARGS for item in (name, str(getattr(args, name[2:].replace("-", "_"))))]
+    return subprocess.Popen(
+        [sys.executable, "-m", "api.bench.sidecar", *role, "--index", args.index, *passed],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+    )
+
+
+def wait_for_socket(path: str, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"the sidecar did not open {path}")
+        time.sleep(0.05)
+
+
+def measure(args, workers: int, mode: str) -> None:
+    sidecar = None
+    address = f"unix:{tempfile.gettempdir()}/switch-bench-{os.getpid()}.sock"
+    if mode == "sidecar":
+        if os.path.exists(address[5:]):
+            os.unlink(address[5:])
+        sidecar = spawn(args, "--role", "sidecar", "--address", address)
+        wait_for_socket(address[5:])
+    processes = [spawn(args, "--role", "worker", "--mode", mode, "--address", address, "--worker", str(index)) for index in range(workers)]
+    try:
+        for process in processes:
+            assert process.stdout.readline().strip() == "ready"
+        for process in processes:
+            process.stdin.write("go\n")
+            process.stdin.flush()
+        results = [json.loads(process.stdout.readline()) for process in processes]
+        memory = sum(result["pss"] for result in results) + (pss_mb(sidecar.pid) if sidecar else 0.0)
+        wall = max(result["seconds"] for result in results)
+        queries = workers * args.queries
+        print(f"{workers:>7} {mode:>8} {memory:>10.0f} {memory / workers:>10.0f} {queries / wall:>9.0f}")
+    finally:
+        for process in processes + ([sidecar] if sidecar else []):
+            process.kill()
+            process.wait()
+
+
+def main(args):
+    from langchain_community.vectorstores.faiss import FAISS
+
+    from api.bench.fakes import FakeEmbeddings, fake_corpus
+
+    with tempfile.TemporaryDirectory() as index:
+        FAISS.from_texts(fake_corpus(args.corpus), FakeEmbeddings()).save_local(index)
+        args.index = index
+        print(f"{'workers':>7} {'mode':>8} {'memory MB':>10} {'MB/worker':>10} {'queries/s':>9}")
+        for workers in args.workers:
+            for mode in ("local", "sidecar"):
+                measure(args, workers, mode)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-process retrieval vs. one retrieval sidecar for N workers.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--model-mb", type=float, default=110, help="weights held by the stand-in model (bge-base: ~440)")
+    parser.add_argument("--corpus", type=int, default=20000, help="passages in the index")
+    parser.add_argument("--embedding-ms", type=float, default=20, help="fixed cost of one encoder batch")
+    parser.add_argument("--item-ms", type=float, default=1, help="extra cost per query in a batch")
+    parser.add_argument("--queries", type=int, default=200, help="queries per worker")
+    parser.add_argument("--concurrency", type=int, default=8, help="queries in flight per worker")
+    parser.add_argument("--threads", type=int, default=4, help="encoder batches running at once (per process)")
+    parser.add_argument("--role", choices=["sidecar", "worker"], help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=["local", "sidecar"], help=argparse.SUPPRESS)
+    parser.add_argument("--address", help=argparse.SUPPRESS)
+    parser.add_argument("--worker", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--index", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.role == "sidecar":
+        run_sidecar(args)
+    elif args.role == "worker":
+        run_worker(args)
+    else:
+        main(args)
@@ -0,0 +1,109 @@
+# Single-flight (api.app.singleflight) through the API server, against the fake OpenAI.
+#
+# For each endpoint, --copies identical requests are sent at the same moment (engineers asking the
+# same thing, or the UI retrying), with single-flight off and on: wall time, OpenAI calls and prompt
+# tokens billed. "no-cache" sends the same copies where every other one carries Cache-Control:
+# no-cache, so the requests differ and only their identical OpenAI calls can be shared. Last, the
+# copies of a /v5 stream are all closed after their first event: the pipeline they shared has to be
+# cancelled, so no OpenAI call is made after that.
+#
+#   python -m api.bench.singleflight --copies 8 --size 50
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from api.bench.harness import start_server
+from api.bench.topologies import generate_topology
+
+QUESTION = "connect PC1 to PC2 and make sure they can ping each other."
+
+
+async def send(client, base_url, endpoint, body, headers=None):
+    if endpoint in ("v4", "v5"):
+        async with client.stream("POST", f"{base_url}/{endpoint}/stream", json=body, headers=headers) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.startswith("event:") and line[6:].strip() == "error":
+                    raise RuntimeError(f"{endpoint} stream failed")
+    else:
+        response = await client.post(f"{base_url}/{endpoint}/invoke", json=body, headers=headers)
+        response.raise_for_status()
+
+
+async def burst(base_url, llm, endpoint, body, copies, no_cache=False):
+    before = llm.stats()
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=600) as client:
+        await asyncio.gather(*(
+            send(client, base_url, endpoint, body, { "cache-control": "no-cache" } if no_cache and index % 2 else None)
+            for index in range(copies)
+        ))
+    after = llm.stats()
+    return time.perf_counter() - started, after["calls"] - before["calls"], after["prompt_tokens"] - before["prompt_tokens"]
+
+
+async def abandoned(base_url, llm, body, copies):
+    """Close every copy of a /v5 stream after its first event; OpenAI calls made after that."""
+    from api.app import metrics
+
+    cancelled = metrics.SINGLE_FLIGHT.values.get(("request", "cancelled"), 0) + metrics.SINGLE_FLIGHT.values.get(("stream", "cancelled"), 0)
+
+    async def first_event(client):
+        async with client.stream("POST", f"{base_url}/v5/stream", json=body) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    return
+
+    async with httpx.AsyncClient(timeout=600) as client:
+        await asyncio.gather(*(first_event(client) for _ in range(copies)))
+    await asyncio.sleep(0.5)  # the server notices the closed connections
+    calls = llm.stats()["calls"]
+    await asyncio.sleep(3)
+    now = metrics.SINGLE_FLIGHT.values.get(("request", "cancelled"), 0) + metrics.SINGLE_FLIGHT.values.get(("stream", "cancelled"), 0)
+    return llm.stats()["calls"] - calls, now - cancelled
+
+
+async def run(args, llm, base_url):
+    from api.app import config
+
+    body = { "input": { "chat_history": [[f"configure R{i}", "done"] for i in range(3)], "topology": json.dumps(generate_topology(args.size)), "question": QUESTION } }
+    # Every device goes to the LLM, so the stage-4 fan-out is the bulk of the work.
+    v5_body = { **body, "config": { "configurable": { "device_pruning": False, "cli_templates": False, "validation": False } } }
+    print(f"{'case':>14} {'single-flight':>13} {'wall(s)':>8} {'calls':>6} {'prompt tok':>11}")
+    cases = [(endpoint, body, False) for endpoint in args.endpoints if endpoint != "v5"]
+    if "v5" in args.endpoints:
+        cases += [("v5", v5_body, False), ("v5", v5_body, True)]
+    for endpoint, request, no_cache in cases:
+        for enabled in (False, True):
+            config.SINGLE_FLIGHT = enabled
+            # A request of its own first, so the summaries and embeddings are warm in both runs.
+            if not enabled:
+                await burst(base_url, llm, endpoint, request, 1)
+            wall, calls, tokens = await burst(base_url, llm, endpoint, request, args.copies, no_cache)
+            name = f"{endpoint}{' no-cache' if no_cache else ''}"
+            print(f"{name:>14} {'on' if enabled else 'off':>13} {wall:>8.2f} {calls:>6} {tokens:>11}")
+    if "v5" in args.endpoints:
+        config.SINGLE_FLIGHT = True
+        late_calls, cancelled = await abandoned(base_url, llm, v5_body, args.copies)
+        print(f"\n/v5 stream x{args.copies} closed after the first event: {cancelled:.0f} shared stream(s) cancelled, {late_calls} OpenAI calls afterwards")
+
+
+def main(args):
+    args.llm_cache, args.rpm, args.tpm = False, 10 ** 6, 10 ** 9
+    args.corpus, args.embedding_dim, args.embedding_ms = 2000, 384, 5.0
+    llm, server, base_url = start_server(args)
+    asyncio.run(run(args, llm, base_url))
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Single-flight of identical requests and LLM calls.")
+    parser.add_argument("--endpoints", nargs="+", default=["v1", "v3", "v4", "v5"])
+    parser.add_argument("--copies", type=int, default=8, help="identical requests sent at once")
+    parser.add_argument("--size", type=int, default=50, help="topology size (nodes)")
+    parser.add_argument("--profile", default="gpt-3.5", help="fake LLM latency profile (see fake_openai.PROFILES)")
+    parser.add_argument("--latency-scale", type=float, default=0.2)
+    main(parser.parse_args())
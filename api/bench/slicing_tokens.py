@@ -0,0 +1,62 @@
+# Stage-4 prompt tokens with the full topology vs. with per-device slices.
+#
+#   python -m api.bench.slicing_tokens --sizes 100 500
+import argparse
+import json
+
+from api.app.allocator import allocate_ips
+from api.app.chains.chain_v5 import DUMMY_INPUT_1, INSTRUCTION, forth_step_prompt
+from api.app.slicing import TopologySlicer
+from api.app.tokens import count_tokens
+from api.bench.topologies import generate_topology
+
+DESIGN = "Use static addressing on every connected port and OSPF area 0 between the routers."
+
+# The stage-4 prompt before slicing, in the layout of chain_v5.FOURTH_STEP_TEMPLATE: the whole
+# topology and IP plan for every device.
+FULL_TEMPLATE = INSTRUCTION + '\n' + """You are currently in stage 4.
+
+You will be given the overall network design, the current network topology, the ip address / subnet mask of every connected port and the node_name of one device.
+Create a CLI command for that device according to the design. In this step, you should assign the ip address and subnet mask to the every port of the device.
+
+{format_instructions}
+
+{example_command}
+
+Details on the overall network design are as follows.
+
+- Network design: {design_of_network}
+
+The current network topology is as follows.
+
+- network topology: {network_topology}
+- ip address / subnet mask : {port_identification}
+
+The node_name that you need to configure is {device_name}."""
+
+
+def measure(topology: dict) -> tuple:
+    port_identification = allocate_ips(topology)
+    slicer = TopologySlicer(topology, port_identification)
+    partials = forth_step_prompt.partial_variables
+    full = sliced = 0
+    for node in topology["node_info"]:
+        name = node["name"]
+        full += count_tokens(FULL_TEMPLATE.format(design_of_network=DESIGN, network_topology=topology, port_identification=port_identification, device_name=name, **partials))
+        sliced += count_tokens(forth_step_prompt.format(design_of_network=DESIGN, device_view=slicer.view_json(name), device_name=name))
+    return full, sliced
+
+
+def main(args):
+    cases = [("DUMMY_INPUT_1", json.loads(DUMMY_INPUT_1.topology))]
+    cases += [(f"synthetic-{size}", generate_topology(size)) for size in args.sizes]
+    print(f"{'topology':>16} {'devices':>8} {'full':>12} {'sliced':>10} {'reduction':>10}")
+    for name, topology in cases:
+        full, sliced = measure(topology)
+        print(f"{name:>16} {len(topology['node_info']):>8} {full:>12} {sliced:>10} {1 - sliced / full:>10.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage-4 prompt tokens with and without topology slicing.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500])
+    main(parser.parse_args())
@@ -0,0 +1,36 @@
+# Server cold-start cost: time to import api.app.server and the resulting peak RSS,
+# optionally followed by loading chain versions through the registry.
+# Each measurement runs in a fresh interpreter.
+#
+#   python -m api.bench.startup --repeat 3 --load v5 v1
+import argparse
+import json
+import subprocess
+import sys
+
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+import api.app.server
+imported = time.perf_counter() - started
+result = {"import_seconds": imported, "import_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+from api.app.registry import registry
+for version in sys.argv[1:]:
+    registry.load(version)
+    result[f"{version}_load_seconds"] = registry.load_seconds[version]
+result["total_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps(result))
+"""
+
+
+def main(args):
+    for _ in range(args.repeat):
+        output = subprocess.run([sys.executable, "-c", PROBE, *args.load], capture_output=True, text=True, check=True)
+        print(output.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure server import time and RSS.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--load", nargs="*", default=[], help="chain versions to load after import")
+    main(parser.parse_args())
@@ -0,0 +1,48 @@
+# Per-turn stage-1 latency as a conversation grows: re-summarizing the whole history every
+# turn vs. rolling summaries. The fake LLM takes time proportional to its prompt length.
+#
+#   python -m api.bench.summary_turns --turns 40
+import argparse
+import asyncio
+import time
+
+from langchain.schema.runnable import RunnableLambda
+
+from api.app.chains import chain_v5
+from api.app.tokens import count_tokens
+from api.app.utils import format_chat_history
+
+
+def fake_llm(prompt, base, per_token):
+    async def call(input):
+        await asyncio.sleep(base + per_token * count_tokens(prompt.format(**input)))
+        return "A one-paragraph summary of the conversation about configuring the lab network."
+    return RunnableLambda(lambda input: None, afunc=call)
+
+
+async def main(args):
+    chain_v5.first_step_chain = fake_llm(chain_v5.first_step_prompt, args.base, args.per_token)
+    chain_v5.first_step_update_chain = fake_llm(chain_v5.first_step_update_prompt, args.base, args.per_token)
+    exchange = ("connect PC{0} to PC{1} through R{0} and make sure they can ping each other. " * 3,
+                "Device: R{0}\nCommand: enable\nconfigure terminal\ninterface GigabitEthernet1/0\nip address 192.168.{0}.1 255.255.255.0\nno shutdown\n" * 2)
+
+    history = []
+    print(f"{'turn':>5} {'full(ms)':>9} {'rolling(ms)':>12}")
+    for turn in range(1, args.turns + 1):
+        history.append((exchange[0].format(turn, turn + 1), exchange[1].format(turn)))
+        started = time.perf_counter()
+        await chain_v5.first_step_chain.ainvoke({ "prev_conversation": format_chat_history(history) })
+        full = time.perf_counter() - started
+        started = time.perf_counter()
+        await chain_v5.summarize_conversation(list(history))
+        rolling = time.perf_counter() - started
+        if turn in (1, 2, 5) or turn % 10 == 0:
+            print(f"{turn:>5} {full * 1000:>9.0f} {rolling * 1000:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage-1 latency per turn, full vs. rolling summaries.")
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--base", type=float, default=0.05, help="fixed seconds per LLM call")
+    parser.add_argument("--per-token", type=float, default=0.0001, help="seconds per prompt token")
+    asyncio.run(main(parser.parse_args()))
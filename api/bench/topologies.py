@@ -0,0 +1,96 @@
+# Synthetic GNS3 topologies for the benchmarks.
+#
+# Routers form a chain, every switch hangs off one router and the PCs are spread over the
+# switches, which is roughly what the labs built in the web UI look like. Node and link ids
+# are UUIDs, as in real exports.
+import json
+import uuid
+
+ROUTER_PORTS = ["FastEthernet0/0"] + [f"GigabitEthernet{i}/0" for i in range(1, 7)]
+
+
+def _uuid(*parts) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, "/".join(map(str, parts))))
+
+
+def generate_topology(size: int, seed: str = "s-witch") -> dict:
+    """A topology with `size` nodes: about 10% routers, 10% switches and the rest PCs."""
+    routers = max(2, size // 10)
+    switches = max(1, size // 10)
+    pcs = max(0, size - routers - switches)
+
+    node_info, link_info = [], []
+    used_ports = {}
+
+    def add_node(name, node_type, ports):
+        node = {"node_id": _uuid(seed, name), "name": name, "node_type": node_type, "ports": ports}
+        node_info.append(node)
+        used_ports[name] = 0
+        return node
+
+    def next_port(node):
+        index = used_ports[node["name"]]
+        if index >= len(node["ports"]):
+            # Big labs need more ports than the default templates have.
+            number = len(node["ports"])
+            name = f"GigabitEthernet{number}/0" if node["node_type"] == "dynamips" else f"Ethernet{number}"
+            node["ports"].append({"name": name, "port_number": 0 if node["node_type"] == "dynamips" else number, "link_type": "ethernet"})
+        used_ports[node["name"]] += 1
+        return node["ports"][index]["port_number"]
+
+    def connect(a, b):
+        link_info.append({
+            "link_id": _uuid(seed, "link", len(link_info)),
+            "link_type": "ethernet",
+            "nodes": [{"node_id": a["node_id"], "port_number": next_port(a)}, {"node_id": b["node_id"], "port_number": next_port(b)}],
+        })
+
+    router_nodes = [
+        add_node(f"R{i + 1}", "dynamips", [{"name": name, "port_number": 0, "link_type": "ethernet"} for name in ROUTER_PORTS])
+        for i in range(routers)
+    ]
+    switch_nodes = [
+        add_node(f"Switch{i + 1}", "ethernet_switch", [{"name": f"Ethernet{p}", "port_number": p, "link_type": "ethernet"} for p in range(8)])
+        for i in range(switches)
+    ]
+    pc_nodes = [
+        add_node(f"PC{i + 1}", "vpcs", [{"name": "Ethernet0", "port_number": 0, "link_type": "ethernet"}])
+        for i in range(pcs)
+    ]
+
+    for a, b in zip(router_nodes, router_nodes[1:]):
+        connect(a, b)
+    for i, switch in enumerate(switch_nodes):
+        connect(router_nodes[i % routers], switch)
+    for i, pc in enumerate(pc_nodes):
+        connect(pc, switch_nodes[i % switches])
+    return {"node_info": node_info, "link_info": link_info}
+
+
+def generate_topology_json(size: int, seed: str = "s-witch") -> str:
+    return json.dumps(generate_topology(size, seed))
+
+
+def exported(topology: dict) -> dict:
+    """`topology` with the fields a GNS3 project export also carries (position, symbol, label,
+    console, emulator properties), none of which the chains read."""
+    node_info = []
+    for index, node in enumerate(topology["node_info"]):
+        node_info.append({
+            **node,
+            "compute_id": "local",
+            "project_id": _uuid("project"),
+            "console": 5000 + index,
+            "console_host": "127.0.0.1",
+            "console_type": "telnet",
+            "status": "started",
+            "x": (index % 20) * 90 - 900,
+            "y": (index // 20) * 90 - 400,
+            "z": 1,
+            "symbol": f":/symbols/{'router' if node['node_type'] == 'dynamips' else 'computer' if node['node_type'] == 'vpcs' else 'ethernet_switch'}.svg",
+            "label": {"text": node["name"], "x": 10, "y": -25, "rotation": 0, "style": "font-family: TypeWriter;font-size: 10.0;font-weight: bold;fill: #000000;fill-opacity: 1.0;"},
+            "properties": {"ram": 256, "nvram": 256, "image": "c7200-adventerprisek9-mz.124-24.T5.image", "idlepc": "0x606df838", "platform": "c7200"} if node["node_type"] == "dynamips" else {},
+            "ports": [{**port, "adapter_number": 0, "short_name": port["name"][:1].lower() + port["name"].split("Ethernet")[-1], "data_link_types": {"Ethernet": "DLT_EN10MB"}} for port in node["ports"]],
+        })
+    link_info = [{**link, "capturing": False, "filters": {}, "suspend": False, "link_style": {}} for link in topology["link_info"]]
+    return {"node_info": node_info, "link_info": link_info}
@@ -0,0 +1,106 @@
+# Parse, serialize and lookup costs of the Topology model on big labs.
+#
+# For each size: json.loads of the request string, building the indexed Topology, the canonical
+# JSON and hash (first use and cached), a parse-cache hit for a repeated string, the memory the
+# records add on top of the parsed JSON, and node/peer lookups through the indexes against the
+# linear scans over node_info/link_info they replace. Finally the whole stage-3/4 preparation
+# of a /v5 request (load, allocate, slice every device).
+#
+#   python -m api.bench.topology_parse --sizes 100 1000
+import argparse
+import json
+import time
+import tracemalloc
+
+from api.app.allocator import _allocate, allocate_ips
+from api.app.slicing import TopologySlicer
+from api.app.topology import Topology, _parse, load_topology
+from api.bench.topologies import generate_topology
+
+
+def best(function, repeat: int = 5) -> float:
+    """Fastest of `repeat` runs, in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return min(times) * 1000
+
+
+def best_of(setup, function, repeat: int = 5) -> float:
+    """Fastest of `repeat` runs of function(setup()), in milliseconds, setup excluded."""
+    times = []
+    for _ in range(repeat):
+        value = setup()
+        started = time.perf_counter()
+        function(value)
+        times.append(time.perf_counter() - started)
+    return min(times) * 1000
+
+
+def primed(data: dict) -> Topology:
+    """A Topology whose canonical JSON is already computed."""
+    topology = Topology(data)
+    topology.json
+    return topology
+
+
+def scan_peer(data: dict, node_id: str):
+    """What a link lookup cost before the adjacency index: a scan over link_info."""
+    for link in data["link_info"]:
+        ends = link["nodes"]
+        if ends[0]["node_id"] == node_id:
+            return ends[1]["node_id"]
+        if ends[1]["node_id"] == node_id:
+            return ends[0]["node_id"]
+    return None
+
+
+def main(args):
+    print(f"{'nodes':>6} {'json.loads':>10} {'build':>8} {'canonical':>10} {'hash':>7} {'cached':>8} {'cache hit':>10} "
+          f"{'+memory':>9} {'scans':>9} {'indexed':>8} {'v5 prep':>8}")
+    for size in args.sizes:
+        text = json.dumps(generate_topology(size))
+        data = json.loads(text)
+        names = [node["name"] for node in data["node_info"]]
+
+        loads = best(lambda: json.loads(text))
+        build = best_of(lambda: json.loads(text), Topology)
+        canonical = best_of(lambda: Topology(data), lambda topology: topology.json)
+        digest = best_of(lambda: primed(data), lambda topology: topology.hash)
+        topology = Topology(data)
+        topology.hash
+        cached = best(lambda: (topology.json, topology.hash)) * 1000  # microseconds
+        _parse.cache_clear()
+        load_topology(text)
+        hit = best(lambda: load_topology(text)) * 1000
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        kept = Topology(data)
+        overhead = (tracemalloc.get_traced_memory()[0] - before) / 2 ** 20
+        tracemalloc.stop()
+        del kept
+
+        # One name lookup and one peer lookup per device, as stage 4 does.
+        scans = best(lambda: [(next(node for node in data["node_info"] if node["name"] == name), scan_peer(data, node["node_id"]))
+                              for name, node in zip(names, data["node_info"])], repeat=1)
+        indexed = best(lambda: [(topology.by_name[name], [topology.peer(port) for port in topology.by_name[name].ports]) for name in names])
+
+        def prepare():
+            _parse.cache_clear()
+            _allocate.cache_clear()
+            parsed = load_topology(text)
+            slicer = TopologySlicer(parsed, allocate_ips(parsed, pool="10.0.0.0/8"))
+            return [slicer.view_json(node.name) for node in parsed.nodes]
+        prep = best(prepare, repeat=3)
+
+        print(f"{size:>6} {loads:>8.2f}ms {build:>6.2f}ms {canonical:>8.2f}ms {digest:>5.2f}ms {cached:>6.1f}us {hit:>8.1f}us "
+              f"{overhead:>7.2f}MB {scans:>7.1f}ms {indexed:>6.2f}ms {prep:>6.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Topology parse/serialize/lookup costs.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+    main(parser.parse_args())
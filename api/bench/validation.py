@@ -0,0 +1,102 @@
+# Targeted repair of broken stage-4 answers (api.app.validation) against retrying whole requests.
+#
+# Stage 4 of /v5 is swapped for a fake that answers each device correctly (the CLI templates'
+# rendering) except for a fraction of devices, whose first answer is broken in one of the ways
+# the LLM breaks them: output that is not JSON, an interface the node does not have, an address
+# outside the port's subnet, a missing "no shutdown", a gateway outside the host's subnet. The
+# repair call answers correctly. For each fault rate: requests lost and broken answers returned
+# without validation, answers repaired and stage-4 calls with it, and the stage-4 calls the client
+# would make by resending the whole request until no device fails (n / (1 - p) ** n on average).
+#
+#   python -m api.bench.validation --size 50 --rates 0.02 0.05 0.1 0.2
+import argparse
+import asyncio
+import json
+import random
+
+from langchain_core.exceptions import OutputParserException
+
+from api.app.allocator import allocate_ips
+from api.app.chains import chain_v5
+from api.app.cli_templates import CliRenderer, design_spec
+from api.app.slicing import TopologySlicer
+from api.app.topology import load_topology
+from api.app.utils import ChatRequest
+from api.bench.load_v5 import install_fakes
+from api.bench.topologies import generate_topology
+
+DESIGN = "Assign addresses to every connected port and add static routes on the routers."
+FAULTS = ("json", "interface", "address", "shutdown", "gateway")
+
+
+def break_answer(answer: dict, fault: str) -> dict:
+    command = answer["command"]
+    if fault == "json":
+        raise OutputParserException(f"Invalid json output: {json.dumps(answer)[:-2]}")
+    if fault == "interface" and "interface " in command:
+        command = command.replace("interface ", "interface Serial9/", 1)
+    elif fault == "shutdown" and "no shutdown" in command:
+        command = command.replace("no shutdown\n", "")
+    elif fault == "gateway" and command.startswith("ip "):
+        command = " ".join(command.split()[:3] + ["10.99.0.254"])
+    elif command.startswith("ip "):  # a host's address in another subnet
+        command = command.replace(command.split()[1], "10.99.0.1", 1)
+    else:
+        command = command.replace("ip address 192.168.", "ip address 10.99.", 1)
+    return { **answer, "command": command }
+
+
+def install(size: int, rate: float, seed: int):
+    topology = generate_topology(size)
+    parsed = load_topology(json.dumps(topology))
+    renderer = CliRenderer(TopologySlicer(parsed, allocate_ips(parsed)), design_spec(DESIGN))
+    stages = install_fakes(0.0)
+    stages["second_step_chain"].output = DESIGN
+    rng = random.Random(seed)
+    broken = {node.name: rng.choice(FAULTS) for node in parsed.nodes if node.node_type != "ethernet_switch" and rng.random() < rate}
+
+    def first(input):
+        answer = renderer.render(input["device_name"])
+        fault = broken.get(input["device_name"])
+        return break_answer(answer, fault) if fault else answer
+
+    stages["fourth_step_chain"].output = first
+    stages["repair_step_chain"].output = lambda input: renderer.render(input["device_name"])
+    input = ChatRequest(chat_history=[], topology=json.dumps(topology), question="make PC1 reach PC2.")
+    return stages, input, broken, renderer
+
+
+async def run(size: int, rate: float, seed: int) -> None:
+    configurable = { "ip_allocation": "graph", "device_pruning": False, "cli_templates": False }
+    stages, input, broken, renderer = install(size, rate, seed)
+    devices = size
+    try:
+        outputs = await chain_v5.invoke(input, { "configurable": { **configurable, "validation": False } })
+        lost = 0
+        wrong = sum(output != renderer.render(output["device"]) for output in outputs if output.get("device"))
+    except OutputParserException:
+        lost, wrong = 1, "-"
+
+    stages["fourth_step_chain"].calls = stages["repair_step_chain"].calls = 0
+    events = [event async for event in chain_v5.astream(input, { "configurable": { **configurable, "validation": True } })]
+    repaired = sum(bool(event.get("repaired")) for event in events)
+    invalid = sum(bool(event.get("invalid")) for event in events)
+    correct = sum(event["output"] == renderer.render(event["output"]["device"]) for event in events if event["stage"] == "device")
+    calls = stages["fourth_step_chain"].calls + stages["repair_step_chain"].calls
+    full_retry = devices / (1 - rate) ** devices
+    print(f"{rate:>6.2f} {len(broken):>6} {lost:>5} {wrong!s:>6} {repaired:>8} {invalid:>7} {correct:>4}/{devices:<4} {calls:>6} {full_retry:>11.0f}")
+
+
+def main(args):
+    print(f"{'rate':>6} {'broken':>6} {'lost':>5} {'wrong':>6} {'repaired':>8} {'invalid':>7} {'correct':>9} {'calls':>6} {'full retry':>11}")
+    print(f"{'':>6} {'':>6} {'(no validation)':>12} {'(validation + targeted repair)':>34} {'(avg calls)':>11}")
+    for rate in args.rates:
+        asyncio.run(run(args.size, rate, args.seed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Targeted repair vs. whole-request retries.")
+    parser.add_argument("--size", type=int, default=50)
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.02, 0.05, 0.1, 0.2])
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
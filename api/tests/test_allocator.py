@@ -0,0 +1,78 @@
+# The stage-3 graph allocator (api.app.allocator) on small hand-built topologies.
+import ipaddress
+
+import pytest
+
+from api.app.allocator import allocate_ips, broadcast_domains, prefix_length
+from api.app.topology import load_topology
+
+
+def node(name: str, node_type: str, ports: int) -> dict:
+    prefix = "Ethernet" if node_type != "dynamips" else "FastEthernet0/"
+    return { "node_id": name, "name": name, "node_type": node_type,
+             "ports": [{ "name": f"{prefix}{index}", "port_number": index } for index in range(ports)] }
+
+
+def link(a: str, a_port: int, b: str, b_port: int) -> dict:
+    return { "link_id": f"{a}-{b}", "nodes": [{ "node_id": a, "port_number": a_port }, { "node_id": b, "port_number": b_port }] }
+
+
+def lab(*extra_links) -> dict:
+    """R1 - R2 on a point-to-point link, R1 - Switch1 - PC1, PC2 on a LAN."""
+    return {
+        "node_info": [node("R1", "dynamips", 3), node("R2", "dynamips", 3), node("Switch1", "ethernet_switch", 4),
+                      node("PC1", "vpcs", 1), node("PC2", "vpcs", 1), node("PC3", "vpcs", 1)],
+        "link_info": [link("R1", 0, "R2", 0), link("R1", 1, "Switch1", 0), link("PC1", 0, "Switch1", 1), link("PC2", 0, "Switch1", 2),
+                      *extra_links],
+    }
+
+
+def by_port(plan: dict) -> dict:
+    return { (entry["device"], entry["port"]): ipaddress.ip_interface(f"{entry['ip']}/{entry['subnet']}") for entry in plan["port_info"] }
+
+
+def test_prefix_length():
+    assert prefix_length(2) == 30
+    assert prefix_length(3) == 29
+    assert prefix_length(6) == 29
+    assert prefix_length(7) == 28
+
+
+def test_switches_are_transparent():
+    domains = broadcast_domains(load_topology(lab()))
+    assert sorted(sorted(f"{port.node.name} {port.name}" for port in domain) for domain in domains) == [
+        ["PC1 Ethernet0", "PC2 Ethernet0", "R1 FastEthernet0/1"],
+        ["R1 FastEthernet0/0", "R2 FastEthernet0/0"],
+    ]
+
+
+def test_every_connected_l3_port_gets_an_address_on_its_domain_subnet():
+    plan = by_port(allocate_ips(lab(), "10.0.0.0/24"))
+    assert set(plan) == { ("R1", "FastEthernet0/0"), ("R2", "FastEthernet0/0"), ("R1", "FastEthernet0/1"),
+                          ("PC1", "Ethernet0"), ("PC2", "Ethernet0") }
+    assert len({ address.ip for address in plan.values() }) == len(plan)
+    assert plan["R1", "FastEthernet0/0"].network == plan["R2", "FastEthernet0/0"].network
+    assert plan["R1", "FastEthernet0/0"].network.prefixlen == 30
+    lan = plan["R1", "FastEthernet0/1"].network
+    assert lan.prefixlen == 29 and plan["PC1", "Ethernet0"].network == lan == plan["PC2", "Ethernet0"].network
+    assert not lan.overlaps(plan["R1", "FastEthernet0/0"].network)
+    assert all(address.network.subnet_of(ipaddress.ip_network("10.0.0.0/24")) for address in plan.values())
+    # The router is the LAN's gateway: it gets the first address.
+    assert plan["R1", "FastEthernet0/1"].ip == next(lan.hosts())
+
+
+def test_the_same_topology_gets_the_same_plan():
+    assert allocate_ips(lab(), "10.0.0.0/24") == allocate_ips(lab(), "10.0.0.0/24")
+
+
+def test_previous_plan_keeps_its_addresses_when_a_link_is_added():
+    first = allocate_ips(lab(), "10.0.0.0/24")
+    second = by_port(allocate_ips(lab(link("PC3", 0, "Switch1", 3)), "10.0.0.0/24", previous=first))
+    for port, address in by_port(first).items():
+        assert second[port] == address
+    assert second["PC3", "Ethernet0"].network == second["R1", "FastEthernet0/1"].network
+
+
+def test_pool_too_small():
+    with pytest.raises(ValueError):
+        allocate_ips(lab(), "10.0.0.0/30")
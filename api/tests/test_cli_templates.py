@@ -0,0 +1,55 @@
+# What the stage-4 templates (api.app.cli_templates) agree to render for a design.
+import pytest
+
+from api.app.cli_templates import ROUTER_TYPES, VPCS_TYPES, design_spec, unrecognised
+
+NAMES = ["R1", "R2", "Switch1", "PC1", "PC2"]
+
+
+def test_addressing_only():
+    spec = design_spec("Assign an IP address and subnet mask to every connected port, with R1 as the default gateway of PC1 and PC2.",
+                       "make PC1 and PC2 reach each other", NAMES)
+    assert spec["routing"] == "none"
+    assert spec["covers"] >= VPCS_TYPES | ROUTER_TYPES
+
+
+def test_static_routing():
+    spec = design_spec("Configure static routes on R1 and R2 so that every LAN is reachable; the next hop is the directly connected router.",
+                       names=NAMES)
+    assert spec["routing"] == "static"
+    assert spec["covers"] >= ROUTER_TYPES
+
+
+def test_single_area_ospf():
+    spec = design_spec("Enable OSPF process 1 on R1 and R2 and advertise every connected network in area 0.", names=NAMES)
+    assert spec == { "routing": "ospf", "area": "0", "covers": spec["covers"] }
+    assert spec["covers"] >= VPCS_TYPES | ROUTER_TYPES
+
+
+def test_multi_area_ospf_leaves_routers_to_the_llm():
+    spec = design_spec("Run OSPF with R1 in area 0 and R2 in area 1.", names=NAMES)
+    assert spec["routing"] == "ospf"
+    assert VPCS_TYPES <= spec["covers"] and not ROUTER_TYPES & spec["covers"]
+
+
+@pytest.mark.parametrize("requirement", [
+    "apply a route-map on R1 to set the metric of routes from R2",
+    "add a prefix-list that only lets 10.0.0.0/24 through",
+    "use PBR to send the traffic of PC1 through R2",
+    "configure ip helper-address 10.0.0.5 on the LAN interface of R1",
+    "add access control so that PC2 cannot reach R2",
+    "set the MTU of the link between R1 and R2 to 1400",
+    "give every interface a description",
+])
+def test_anything_else_goes_to_the_llm(requirement):
+    spec = design_spec(f"Assign an IP address to every port and configure static routes. Also {requirement}.", names=NAMES)
+    assert spec["covers"] == set()
+
+
+def test_route_map_is_not_a_route():
+    assert design_spec("apply a route-map on R1", names=NAMES)["routing"] == "none"
+
+
+def test_names_and_addresses_are_recognised():
+    assert unrecognised("Assign 10.0.0.1/30 to Gi0/0 of R1 and connect it to Switch1", NAMES) == set()
+    assert unrecognised("Assign a description to Gi0/0 of R1", NAMES) == { "description" }
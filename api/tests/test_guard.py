@@ -0,0 +1,32 @@
+# Load shedding of the chain requests (api.app.guard.admit), without a server.
+import asyncio
+
+from api.app import config, guard
+
+
+def test_a_burst_of_new_requests_does_not_all_get_in(monkeypatch):
+    # No LLM call made yet: only the admitted requests count.
+    monkeypatch.setattr(config, "MAX_LLM_CALLS", 2)
+    monkeypatch.setattr(config, "ADMISSION_WAIT", 0.1)
+    monkeypatch.setattr(guard, "_outstanding_llm_calls", lambda: 0)
+
+    async def run():
+        burst = await asyncio.gather(*(guard.admit() for _ in range(4)))
+        guard.leave()
+        after_one_left = await guard.admit()
+        for _ in range(2):
+            guard.leave()
+        return burst, after_one_left
+
+    burst, after_one_left = asyncio.run(run())
+    assert burst == [True, True, False, False]
+    assert after_one_left
+    assert guard._admitted == 0
+
+
+def test_outstanding_llm_calls_count_too(monkeypatch):
+    monkeypatch.setattr(config, "MAX_LLM_CALLS", 2)
+    monkeypatch.setattr(config, "ADMISSION_WAIT", 0.05)
+    monkeypatch.setattr(guard, "_outstanding_llm_calls", lambda: 2)
+    assert asyncio.run(guard.admit()) is False
+    assert guard._admitted == 0
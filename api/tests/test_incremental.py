@@ -0,0 +1,67 @@
+# Sticky IP plans of edited labs (api.app.incremental), with a scripted LLM answer.
+import asyncio
+import copy
+
+from api.app.incremental import diff_topologies, is_empty, sticky_plan, updated_plan
+
+LAB = {
+    "node_info": [
+        { "node_id": "r1", "name": "R1", "node_type": "dynamips",
+          "ports": [{ "name": "FastEthernet0/0", "port_number": 0 }, { "name": "FastEthernet0/1", "port_number": 1 }] },
+        { "node_id": "sw1", "name": "Switch1", "node_type": "ethernet_switch", "ports": [{ "name": f"Ethernet{index}", "port_number": index } for index in range(4)] },
+        { "node_id": "sw2", "name": "Switch2", "node_type": "ethernet_switch", "ports": [{ "name": f"Ethernet{index}", "port_number": index } for index in range(4)] },
+        { "node_id": "pc1", "name": "PC1", "node_type": "vpcs", "ports": [{ "name": "Ethernet0", "port_number": 0 }] },
+        { "node_id": "pc2", "name": "PC2", "node_type": "vpcs", "ports": [{ "name": "Ethernet0", "port_number": 0 }] },
+    ],
+    "link_info": [
+        { "link_id": "1", "nodes": [{ "node_id": "r1", "port_number": 0 }, { "node_id": "sw1", "port_number": 0 }] },
+        { "link_id": "2", "nodes": [{ "node_id": "r1", "port_number": 1 }, { "node_id": "sw2", "port_number": 0 }] },
+        { "link_id": "3", "nodes": [{ "node_id": "pc1", "port_number": 0 }, { "node_id": "sw1", "port_number": 1 }] },
+        { "link_id": "4", "nodes": [{ "node_id": "pc2", "port_number": 0 }, { "node_id": "sw1", "port_number": 2 }] },
+    ],
+}
+PLAN = { "port_info": [
+    { "device": "R1", "port": "FastEthernet0/0", "ip": "10.0.1.1", "subnet": "255.255.255.0" },
+    { "device": "R1", "port": "FastEthernet0/1", "ip": "10.0.2.1", "subnet": "255.255.255.0" },
+    { "device": "PC1", "port": "Ethernet0", "ip": "10.0.1.2", "subnet": "255.255.255.0" },
+    { "device": "PC2", "port": "Ethernet0", "ip": "10.0.1.3", "subnet": "255.255.255.0" },
+] }
+
+
+def moved_pc2():
+    """PC2 moved from Switch1 to Switch2."""
+    lab = copy.deepcopy(LAB)
+    lab["link_info"][3]["nodes"][1] = { "node_id": "sw2", "port_number": 1 }
+    return lab
+
+
+def test_unchanged_links_keep_their_addresses():
+    kept, missing = sticky_plan(LAB, moved_pc2(), PLAN)
+    assert kept == { "port_info": PLAN["port_info"][:3] }
+    assert missing == [("PC2", "Ethernet0")]
+
+
+def test_nothing_is_asked_when_every_port_keeps_its_address():
+    async def ask(current_plan, new_ports):
+        raise AssertionError("nothing to ask")
+
+    assert asyncio.run(updated_plan(LAB, LAB, PLAN, ask)) == PLAN
+
+
+def test_only_the_asked_ports_are_taken_from_the_answer():
+    asked = []
+
+    async def ask(current_plan, new_ports):
+        asked.append((current_plan, new_ports))
+        # An answer that also renumbers a kept port: that entry is ignored.
+        return { "port_info": [{ "device": "PC2", "port": "Ethernet0", "ip": "10.0.2.2", "subnet": "255.255.255.0" },
+                               { "device": "R1", "port": "FastEthernet0/0", "ip": "10.9.9.9", "subnet": "255.255.255.0" }] }
+
+    plan = asyncio.run(updated_plan(LAB, moved_pc2(), PLAN, ask))
+    assert asked == [({ "port_info": PLAN["port_info"][:3] }, [{ "device": "PC2", "port": "Ethernet0" }])]
+    assert plan["port_info"] == PLAN["port_info"][:3] + [{ "device": "PC2", "port": "Ethernet0", "ip": "10.0.2.2", "subnet": "255.255.255.0" }]
+
+
+def test_diff():
+    assert is_empty(diff_topologies(LAB, copy.deepcopy(LAB)))
+    assert diff_topologies(LAB, moved_pc2())["links_changed"] == ["4"]
@@ -0,0 +1,61 @@
+# Which devices a request has to touch (api.app.intent), on a small hand-built lab:
+#
+#   PC1, PC2 - Switch1 - R1 - R2 - R3 - Switch2 - PC3
+#                              |
+#                           Switch3 - PC4          PC5 (not connected)
+from api.app.intent import device_scope, mentioned_devices, relevant_devices
+from api.app.topology import load_topology
+
+NODES = { "R1": "dynamips", "R2": "dynamips", "R3": "dynamips", "Switch1": "ethernet_switch", "Switch2": "ethernet_switch",
+          "Switch3": "ethernet_switch", "PC1": "vpcs", "PC2": "vpcs", "PC3": "vpcs", "PC4": "vpcs", "PC5": "vpcs" }
+LINKS = [("R1", "R2"), ("R2", "R3"), ("R1", "Switch1"), ("PC1", "Switch1"), ("PC2", "Switch1"), ("R3", "Switch2"), ("PC3", "Switch2"),
+         ("R2", "Switch3"), ("PC4", "Switch3")]
+
+
+def lab():
+    used = { name: 0 for name in NODES }
+
+    def end(name):
+        used[name] += 1
+        return { "node_id": name, "port_number": used[name] - 1 }
+
+    link_info = [{ "link_id": f"{a}-{b}", "nodes": [end(a), end(b)] } for a, b in LINKS]
+    node_info = [{ "node_id": name, "name": name, "node_type": node_type,
+                   "ports": [{ "name": f"Ethernet{index}", "port_number": index } for index in range(4)] }
+                 for name, node_type in NODES.items()]
+    return load_topology({ "node_info": node_info, "link_info": link_info })
+
+
+def relevant(*names):
+    topology = lab()
+    return relevant_devices(topology, [topology.by_name[name] for name in names])
+
+
+def test_hosts_on_different_lans_take_the_path_between_them():
+    assert relevant("PC1", "PC3") == { "PC1", "Switch1", "R1", "R2", "R3", "Switch2", "PC3" }
+
+
+def test_hosts_on_one_lan_take_their_switch_and_gateway():
+    assert relevant("PC1", "PC2") == { "PC1", "PC2", "Switch1", "R1" }
+
+
+def test_a_router_takes_its_switches_but_not_the_hosts_behind_them():
+    assert relevant("R2") == { "R2", "Switch3" }
+
+
+def test_unconnected_endpoints_add_nothing_in_between():
+    assert relevant("PC4", "PC5") == { "PC4", "Switch3", "R2", "PC5" }
+
+
+def test_mentioned_devices_in_order_of_mention():
+    assert [node.name for node in mentioned_devices(lab(), "connect pc3 to PC1, then PC3 to R1")] == ["PC3", "PC1", "R1"]
+
+
+def test_device_scope():
+    topology = lab()
+    assert device_scope(topology, "connect PC1 to PC2")["devices"] == ["R1", "Switch1", "PC1", "PC2"]
+    # Nothing named, something network-wide, or pruning off: every device.
+    assert device_scope(topology, "make every PC reach the others")["devices"] is None
+    assert device_scope(topology, "connect PC1 to PC2", "run OSPF on R1")["devices"] is None
+    assert device_scope(topology, "connect PC1 to PC2", pruning=False)["devices"] is None
+    assert device_scope(topology, "connect PC1 to PC2", "run OSPF on R1", pruning=True)["devices"] == ["R1", "Switch1", "PC1", "PC2"]
@@ -0,0 +1,170 @@
+# The OpenAI scheduler (api.app.scheduler) against a stub resource: no server, no network.
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from api.app.scheduler import BATCH, INTERACTIVE, LLMScheduler, ScheduledResource, _retry_after, estimate_tokens, llm_priority
+from api.app.tokens import count_tokens
+
+
+class Stub:
+    """A completions resource that notes the order calls are sent in, failing the first ones with `errors`."""
+
+    def __init__(self, errors=()):
+        self.sent = []
+        self.errors = list(errors)
+
+    async def create(self, **kwargs):
+        self.sent.append(kwargs["messages"][0]["content"])
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+class StubStream:
+    """A streamed answer: one chunk per piece of text."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.closed = False
+
+    async def __aiter__(self):
+        for piece in self.pieces:
+            await asyncio.sleep(0)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+
+    async def close(self):
+        self.closed = True
+
+
+def rate_limited(headers=None) -> openai.RateLimitError:
+    response = httpx.Response(429, headers=headers or {}, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def call(resource: ScheduledResource, content: str, priority: int = INTERACTIVE):
+    async def one():
+        with llm_priority(priority):
+            return await resource.create(model="gpt-3.5-turbo", messages=[{ "role": "user", "content": content }])
+    return asyncio.ensure_future(one())
+
+
+def test_interactive_call_is_sent_before_queued_batch_calls():
+    async def run():
+        # One call at a time, 20 a second: the backlog stays queued while the interactive call arrives.
+        stub = Stub()
+        resource = ScheduledResource(stub, LLMScheduler(rpm=20 * 60, tpm=10 ** 9, burst=0.05), is_async=True)
+        backlog = [call(resource, f"batch {index}", BATCH) for index in range(10)]
+        await asyncio.sleep(0.01)
+        sent_before = len(stub.sent)
+        await call(resource, "interactive")
+        await asyncio.gather(*backlog)
+        return stub.sent, sent_before
+
+    sent, sent_before = asyncio.run(run())
+    assert sent.index("interactive") == sent_before
+    assert sent[sent_before + 1:] == sorted(sent[sent_before + 1:], key=lambda content: int(content.split()[1]))
+
+
+def test_same_priority_is_served_in_arrival_order():
+    async def run():
+        stub = Stub()
+        resource = ScheduledResource(stub, LLMScheduler(rpm=50 * 60, tpm=10 ** 9, burst=0.02), is_async=True)
+        await asyncio.gather(*(call(resource, f"call {index}") for index in range(8)))
+        return stub.sent
+
+    assert asyncio.run(run()) == [f"call {index}" for index in range(8)]
+
+
+def test_rate_limit_is_retried_after_its_retry_after():
+    async def run():
+        stub = Stub([rate_limited({ "retry-after-ms": "50" })])
+        scheduler = LLMScheduler(rpm=10 ** 6, tpm=10 ** 9, backoff_base=0.001)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await ScheduledResource(stub, scheduler, is_async=True).create(model="gpt-3.5-turbo", messages=[{ "role": "user", "content": "x" }])
+        return result, loop.time() - started, scheduler.counts, len(stub.sent)
+
+    result, elapsed, counts, attempts = asyncio.run(run())
+    assert result == "ok" and attempts == 2
+    assert elapsed >= 0.05
+    assert counts["retries"] == 1 and counts["rate_limited"] == 1 and counts["failed"] == 0
+
+
+def test_retries_stop_at_max_retries():
+    async def run():
+        stub = Stub([rate_limited() for _ in range(3)])
+        scheduler = LLMScheduler(rpm=10 ** 6, tpm=10 ** 9, max_retries=2, backoff_base=0.001, backoff_max=0.001)
+        with pytest.raises(openai.RateLimitError):
+            await ScheduledResource(stub, scheduler, is_async=True).create(model="gpt-3.5-turbo", messages=[{ "role": "user", "content": "x" }])
+        return scheduler.counts, len(stub.sent)
+
+    counts, attempts = asyncio.run(run())
+    assert attempts == 3 and counts["retries"] == 2 and counts["failed"] == 1
+
+
+def test_other_errors_are_not_retried():
+    async def run():
+        stub = Stub([ValueError("bad request")])
+        scheduler = LLMScheduler(rpm=10 ** 6, tpm=10 ** 9)
+        with pytest.raises(ValueError):
+            await ScheduledResource(stub, scheduler, is_async=True).create(model="gpt-3.5-turbo", messages=[{ "role": "user", "content": "x" }])
+        return scheduler.counts, len(stub.sent)
+
+    counts, attempts = asyncio.run(run())
+    assert attempts == 1 and counts["retries"] == 0 and counts["failed"] == 1
+
+
+def test_backoff_grows_within_its_bounds_and_honours_retry_after():
+    scheduler = LLMScheduler(backoff_base=0.5, backoff_max=4.0)
+    error = openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    for attempt in range(6):
+        delay = scheduler._backoff(attempt, error)
+        bound = min(4.0, 0.5 * 2 ** attempt)
+        assert bound / 2 <= delay <= bound
+    assert scheduler._backoff(0, rate_limited({ "retry-after": "7" })) >= 7
+    assert scheduler.paused_until > 0
+
+
+def test_retry_after_headers():
+    assert _retry_after(rate_limited({ "retry-after-ms": "250" })) == 0.25
+    assert _retry_after(rate_limited({ "retry-after": "2" })) == 2.0
+    assert _retry_after(rate_limited()) is None
+    assert _retry_after(ValueError()) is None
+
+
+def test_a_streamed_call_is_in_flight_until_its_stream_ends_and_is_charged_what_it_streamed():
+    pieces = ["The plan ", "is ready", "."] * 20
+    kwargs = { "model": "gpt-3.5-turbo", "messages": [{ "role": "user", "content": "x" }], "stream": True, "max_tokens": 500 }
+
+    async def run():
+        stub = Stub()
+        stub.create = lambda **_: asyncio.sleep(0, StubStream(pieces))
+        scheduler = LLMScheduler(rpm=10 ** 6, tpm=6000, burst=60)
+        stream = await ScheduledResource(stub, scheduler, is_async=True).create(**kwargs)
+        during = scheduler.outstanding()
+        level = scheduler.tokens.level
+        chunks = [chunk async for chunk in stream]
+        return during, scheduler.outstanding(), level, scheduler.tokens.level, len(chunks)
+
+    during, after, level_during, level_after, chunks = asyncio.run(run())
+    assert during == 1 and after == 0 and chunks == len(pieces)
+    # The estimate charged max_tokens; the stream gives back what it did not use.
+    used = estimate_tokens({ **kwargs, "max_tokens": 0 }) + count_tokens("".join(pieces))
+    assert level_after - level_during == pytest.approx(estimate_tokens(kwargs) - used, abs=1)
+
+
+def test_a_failed_call_gives_its_tokens_back():
+    async def run():
+        stub = Stub([ValueError("bad request")])
+        scheduler = LLMScheduler(rpm=10 ** 6, tpm=6000, burst=60)
+        level = scheduler.tokens.level
+        with pytest.raises(ValueError):
+            await ScheduledResource(stub, scheduler, is_async=True).create(model="gpt-3.5-turbo", messages=[{ "role": "user", "content": "x" * 2000 }])
+        return level, scheduler.tokens.level
+
+    before, after = asyncio.run(run())
+    assert after == pytest.approx(before, abs=1)
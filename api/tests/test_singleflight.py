@@ -0,0 +1,133 @@
+# Single-flight (api.app.singleflight): identical calls that overlap run once.
+import asyncio
+
+from api.app import config
+from api.app.singleflight import SingleFlight, canonical_key, request_key
+
+
+class Work:
+    """A call that counts its runs and finishes when `release` is set (or raises `error`)."""
+
+    def __init__(self, error=None):
+        self.runs = 0
+        self.cancelled = 0
+        self.error = error
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.runs += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        return { "design": ["R1", "R2"] }
+
+    async def stream(self):
+        for index in range(3):
+            yield { "index": index }
+            if index == 0:
+                await self.release.wait()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_overlapping_calls_run_once_and_get_their_own_copy():
+    async def run():
+        flights, work = SingleFlight("test"), Work()
+        callers = [asyncio.ensure_future(flights.run("key", work)) for _ in range(3)]
+        await settle()
+        work.release.set()
+        results = await asyncio.gather(*callers)
+        return work.runs, results, len(flights)
+
+    runs, results, left = asyncio.run(run())
+    assert runs == 1 and left == 0
+    assert results == [{ "design": ["R1", "R2"] }] * 3
+    results[0]["design"].append("R3")
+    assert results[1] == { "design": ["R1", "R2"] }
+
+
+def test_different_keys_and_later_calls_run_again():
+    async def run():
+        flights, work = SingleFlight("test"), Work()
+        work.release.set()
+        await asyncio.gather(flights.run("a", work), flights.run("b", work))
+        await flights.run("a", work)
+        return work.runs
+
+    assert asyncio.run(run()) == 3
+
+
+def test_every_caller_gets_the_exception():
+    async def run():
+        flights, work = SingleFlight("test"), Work(ValueError("bad design"))
+        callers = [asyncio.ensure_future(flights.run("key", work)) for _ in range(2)]
+        await settle()
+        work.release.set()
+        return work.runs, await asyncio.gather(*callers, return_exceptions=True)
+
+    runs, results = asyncio.run(run())
+    assert runs == 1 and all(isinstance(result, ValueError) for result in results)
+
+
+def test_the_work_is_cancelled_only_when_every_caller_is_gone():
+    async def run():
+        flights, work = SingleFlight("test"), Work()
+        first, second = (asyncio.ensure_future(flights.run("key", work)) for _ in range(2))
+        await settle()
+        first.cancel()
+        await settle()
+        still_running = work.cancelled == 0
+        second.cancel()
+        await settle()
+        return still_running, work.cancelled, len(flights)
+
+    still_running, cancelled, left = asyncio.run(run())
+    assert still_running and cancelled == 1 and left == 0
+
+
+def test_a_late_stream_caller_first_gets_what_was_sent():
+    async def run():
+        flights, work = SingleFlight("test"), Work()
+
+        async def consume():
+            return [item async for item in flights.stream("key", work.stream)]
+
+        first = asyncio.ensure_future(consume())
+        await settle()
+        second = asyncio.ensure_future(consume())
+        await settle()
+        work.release.set()
+        return await asyncio.gather(first, second)
+
+    first, second = asyncio.run(run())
+    assert first == second == [{ "index": 0 }, { "index": 1 }, { "index": 2 }]
+
+
+def test_off(monkeypatch):
+    monkeypatch.setattr(config, "SINGLE_FLIGHT", False)
+
+    async def run():
+        flights, work = SingleFlight("test"), Work()
+        work.release.set()
+        await asyncio.gather(flights.run("key", work), flights.run("key", work))
+        return work.runs
+
+    assert asyncio.run(run()) == 2
+
+
+def test_keys():
+    assert canonical_key({ "a": 1, "b": [1, 2] }) == canonical_key({ "b": [1, 2], "a": 1 })
+    assert canonical_key({ "a": 1 }) != canonical_key({ "a": 2 })
+    # The topology is compared parsed: its JSON formatting does not matter.
+    compact = { "topology": '{"node_info":[],"link_info":[]}', "question": "connect PC1 to PC2" }
+    spaced = { "topology": '{ "link_info": [], "node_info": [] }', "question": "connect PC1 to PC2" }
+    assert request_key("v5", "invoke", compact, None) == request_key("v5", "invoke", spaced, {})
+    assert request_key("v5", "invoke", compact, None) != request_key("v4", "invoke", compact, None)
+    assert request_key("v5", "invoke", compact, None) != request_key("v5", "invoke", compact, { "configurable": { "validation": True } })
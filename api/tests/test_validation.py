@@ -0,0 +1,106 @@
+# Checks and targeted repair of the stage-4 answers (api.app.validation), with scripted LLM answers.
+import asyncio
+
+from langchain_core.exceptions import OutputParserException
+
+from api.app.slicing import TopologySlicer
+from api.app.validation import FAILED_COMMENT, checked
+
+TOPOLOGY = {
+    "node_info": [
+        { "node_id": "r1", "name": "R1", "node_type": "dynamips",
+          "ports": [{ "name": "FastEthernet0/0", "port_number": 0 }, { "name": "FastEthernet0/1", "port_number": 1 }] },
+        { "node_id": "r2", "name": "R2", "node_type": "dynamips", "ports": [{ "name": "FastEthernet0/0", "port_number": 0 }] },
+        { "node_id": "pc1", "name": "PC1", "node_type": "vpcs", "ports": [{ "name": "Ethernet0", "port_number": 0 }] },
+    ],
+    "link_info": [
+        { "link_id": "1", "nodes": [{ "node_id": "r1", "port_number": 0 }, { "node_id": "r2", "port_number": 0 }] },
+        { "link_id": "2", "nodes": [{ "node_id": "r1", "port_number": 1 }, { "node_id": "pc1", "port_number": 0 }] },
+    ],
+}
+PLAN = { "port_info": [
+    { "device": "R1", "port": "FastEthernet0/0", "ip": "10.0.0.1", "subnet": "255.255.255.252" },
+    { "device": "R1", "port": "FastEthernet0/1", "ip": "10.0.0.9", "subnet": "255.255.255.248" },
+    { "device": "R2", "port": "FastEthernet0/0", "ip": "10.0.0.2", "subnet": "255.255.255.252" },
+    { "device": "PC1", "port": "Ethernet0", "ip": "10.0.0.10", "subnet": "255.255.255.248" },
+] }
+GOOD_R1 = "enable\nconfigure terminal\ninterface Fa0/0\nip address 10.0.0.1 255.255.255.252\nno shutdown\nexit\ninterface Fa0/1\nip address 10.0.0.9 255.255.255.248\nno shutdown\nend"
+
+
+class Script:
+    """Answers in turn: a dict, or an exception to raise. Notes what each repair was told."""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.repairs = []
+
+    async def generate(self):
+        return self.next()
+
+    async def repair(self, previous_output, problems):
+        self.repairs.append((previous_output, problems))
+        return self.next()
+
+    def next(self):
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def run(device: str, script: Script, attempts: int = 2):
+    slicer = TopologySlicer(TOPOLOGY, PLAN)
+    return asyncio.run(checked("v5", slicer.topology.by_name[device], slicer, script.generate, script.repair, attempts))
+
+
+def answer(device: str, command: str) -> dict:
+    return { "device": device, "command": command, "comment": "" }
+
+
+def test_a_valid_answer_is_not_repaired():
+    script = Script(answer("r1", GOOD_R1))
+    response, report = run("R1", script)
+    assert response == answer("R1", GOOD_R1)
+    assert report == { "repair_calls": 0, "repaired": False }
+    assert script.repairs == []
+
+
+def test_an_unknown_interface_is_repaired():
+    script = Script(answer("R1", GOOD_R1.replace("Fa0/1", "Gi3/0")), answer("R1", GOOD_R1))
+    response, report = run("R1", script)
+    assert response == answer("R1", GOOD_R1)
+    assert report == { "repair_calls": 1, "repaired": True }
+    (previous_output, problems), = script.repairs
+    assert "Gi3/0" in previous_output and "R1 has no interface 'Gi3/0'" in problems
+
+
+def test_an_unparsable_answer_is_repaired_from_its_raw_output():
+    error = OutputParserException("Invalid json output: device R1 ...", llm_output="device R1 ...")
+    script = Script(error, answer("R1", GOOD_R1))
+    response, report = run("R1", script)
+    assert report == { "repair_calls": 1, "repaired": True }
+    assert script.repairs[0][0] == "device R1 ..."
+
+
+def test_address_and_shutdown_problems():
+    command = "enable\nconfigure terminal\ninterface Fa0/0\nip address 10.0.0.5 255.255.255.252\nno shutdown\nexit\ninterface Fa0/1\nip address 10.0.0.9 255.255.255.248\nend"
+    script = Script(answer("R1", command), answer("R1", GOOD_R1))
+    run("R1", script)
+    problems = script.repairs[0][1]
+    assert "10.0.0.5/30 on FastEthernet0/0 is outside its subnet 10.0.0.0/30" in problems
+    assert "FastEthernet0/1 gets an ip address but is never brought up" in problems
+
+
+def test_a_vpcs_gateway_outside_its_subnet():
+    script = Script(answer("PC1", "ip 10.0.0.10/29 10.0.0.1"), answer("PC1", "ip 10.0.0.10/29 10.0.0.9"))
+    response, report = run("PC1", script)
+    assert response["command"] == "ip 10.0.0.10/29 10.0.0.9" and report["repaired"]
+    assert "the gateway 10.0.0.1 of PC1 is outside its subnet 10.0.0.8/29" in script.repairs[0][1]
+
+
+def test_a_device_still_invalid_after_its_repairs_comes_back_empty():
+    script = Script(*[{ "device": "R2", "command": ["not a string"] }] * 3)
+    response, report = run("R2", script, attempts=2)
+    assert response["device"] == "R2" and response["command"] == "" and response["comment"].startswith(FAILED_COMMENT)
+    assert report == { "repair_calls": 2, "invalid": True, "problems": ["the key 'command' is missing or is not a string", "the key 'comment' is missing or is not a string"] }
+    assert len(script.repairs) == 2